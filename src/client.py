@@ -1,10 +1,47 @@
 import asyncio
+import contextlib
+import itertools
 import logging
+import re
 import typing as tp
 import uuid
+from pathlib import Path
 
-from config import SERVER_HOST, SERVER_PORT, CLIENT_HELP_MESSAGE, CLIENT_MESSAGE_TEMPLATE
+from config import (
+    SERVER_HOST,
+    SERVER_PORT,
+    CLIENT_HELP_MESSAGE,
+    CLIENT_MESSAGE_TEMPLATE,
+    MAX_FRAME_SIZE,
+    CORRELATION_PREFIX,
+    HANDSHAKE_PREFIX,
+    HANDSHAKE_BINARY,
+    HANDSHAKE_COMPRESSION,
+    KEEPALIVE_PING_MESSAGE,
+    KEEPALIVE_PONG,
+    FILES_MAX_SIZE,
+)
+from core import binary
+from core.compression import inflate_stream
 from core.schemas import Command
+from core.utils import prepare_message
+
+
+# Заголовок ответа на /download, за ним идет содержимое файла: ровно size байт
+FILE_HEADER_PATTERN = re.compile(r"\[\*\] File ([0-9a-f]{32}) (\d+) bytes ")
+
+
+async def _stop_task(task: asyncio.Task | None) -> None:
+    if task is not None:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+def _start_inflating(reader: asyncio.StreamReader) -> tuple[asyncio.StreamReader, asyncio.Task]:
+    """Поток с распакованными ответами сервера и задача, которая его наполняет"""
+    output = asyncio.StreamReader(limit=MAX_FRAME_SIZE)
+    return output, asyncio.create_task(inflate_stream(reader, output))
 
 
 class Client:
@@ -14,23 +51,44 @@ class Client:
         server_port: int = SERVER_PORT,
         butch_size: int = 1024,
         logging_level: int = logging.CRITICAL,
+        compression: bool = False,
     ) -> None:
         self.idx = str(uuid.uuid4())
         self._server_host = server_host
         self._server_port = server_port
         self._butch_size = butch_size
+        # Сервер сжимает все, что отправляет клиенту. Полезно для медленных каналов и длинной истории
+        self._compression = compression
+        self._inflate_task: asyncio.Task | None = None
 
         self.logger = logging.getLogger(f"{self.__class__.__name__}[{self.idx}]")
         self.logger.setLevel(logging_level)
 
+        # Строки сервера без идентификатора запроса: сообщения чата и ответы на обычные команды.
+        # None в очереди означает, что сервер закрыл соединение
+        self._pushes: asyncio.Queue[str | None] = asyncio.Queue()
+        self._is_closed = False
+        # Содержимое скачанных файлов: id файла -> байты
+        self._downloads: dict[str, bytes] = {}
+        # Ответы на запросы с идентификатором: id -> (future, строки ответа)
+        self._pending: dict[str, tuple[asyncio.Future[list[str]], list[str]]] = {}
+        self._request_ids: tp.Iterator[int] = itertools.count(1)
+        self._reader_task: asyncio.Task | None = None
+
     async def __aenter__(self) -> tp.Self:
-        self._reader, self._writer = await asyncio.open_connection(self._server_host, self._server_port)
+        self._reader, self._writer = await asyncio.open_connection(
+            self._server_host, self._server_port, limit=MAX_FRAME_SIZE
+        )
+        if self._compression:
+            self._writer.write(bytes([HANDSHAKE_PREFIX | HANDSHAKE_COMPRESSION]))
+            self._reader, self._inflate_task = _start_inflating(self._reader)
+        self._reader_task = asyncio.create_task(self._read_frames())
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb) -> bool:
         self.logger.info("Close context manager")
         await self.__close_connection()
-        return True
+        return False
 
     async def __close_connection(self) -> None:
         """
@@ -40,25 +98,127 @@ class Client:
         if not self._writer.is_closing():
             self._writer.close()
             await self._writer.wait_closed()
+        await _stop_task(self._inflate_task)
+        await _stop_task(self._reader_task)
+
+    def _dispatch_line(self, line: str) -> None:
+        """Строка "#<id> ..." - часть ответа на запрос <id>, строка "#<id>" - конец ответа, остальное - в очередь"""
+        if line.startswith(CORRELATION_PREFIX):
+            request_id, separator, payload = line[len(CORRELATION_PREFIX):].partition(" ")
+            pending = self._pending.get(request_id)
+            if pending is not None:
+                future, lines = pending
+                if separator:
+                    lines.append(payload)
+                else:
+                    del self._pending[request_id]
+                    if not future.done():
+                        future.set_result(lines)
+                return
+        if line == KEEPALIVE_PING_MESSAGE:
+            # Отвечаем на пинг сами, иначе сервер закроет молчащее соединение
+            self._writer.write(prepare_message(KEEPALIVE_PONG).encode())
+            return
+        self._pushes.put_nowait(line)
+
+    async def _read_frames(self) -> None:
+        """Фоновая задача: делим поток на строки и раскладываем их по ответам и очереди сообщений"""
+        try:
+            while True:
+                try:
+                    data = await self._reader.readuntil(b"\n")
+                except asyncio.IncompleteReadError as err:
+                    if err.partial:
+                        self._dispatch_line(err.partial.decode())
+                    break
+                line = data.decode().rstrip("\n")
+                self._dispatch_line(line)
+                await self._read_download(line)
+        except (ConnectionError, asyncio.IncompleteReadError) as err:
+            self.logger.info(CLIENT_MESSAGE_TEMPLATE.format(err))
+        finally:
+            self._is_closed = True
+            self._pushes.put_nowait(None)
+            for future, _ in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Server closed the connection"))
+            self._pending.clear()
+
+    async def _read_download(self, line: str) -> None:
+        """Содержимое файла после заголовка не делится на строки, читаем его целиком"""
+        if line.startswith(CORRELATION_PREFIX):
+            line = line.partition(" ")[2]
+        match = FILE_HEADER_PATTERN.match(line)
+        if match is not None:
+            self._downloads[match[1]] = await self._reader.readexactly(int(match[2]))
 
     async def read(self) -> str:
-        """Считываем определенное количество байт (_butch_size) с сервера и возвращаем ответ в виде строки"""
+        """
+        Ждем до секунды первую строку от сервера и возвращаем ее вместе со всеми уже полученными строками.
+        Если ничего не пришло - "No data", если сервер закрыл соединение - пустая строка.
+        """
         try:
-            received_data = await asyncio.wait_for(self._reader.read(self._butch_size), timeout=1)
+            first_line = await asyncio.wait_for(self.read_line(), timeout=1)
         except asyncio.TimeoutError:
-            decode_data = "No data"
-        else:
-            decode_data = received_data.decode().strip()
-        return decode_data
+            return "No data"
+
+        lines = [first_line]
+        while lines[-1] and not self._pushes.empty():
+            lines.append(await self.read_line())
+        return "\n".join(lines).strip()
+
+    async def read_line(self) -> str:
+        """Считываем один ответ сервера (до перевода строки). Пустая строка означает, что сервер закрыл соединение"""
+        if self._is_closed and self._pushes.empty():
+            return ""
+        line = await self._pushes.get()
+        return line if line is not None else ""
+
+    async def messages(self) -> tp.AsyncIterator[str]:
+        """
+        Сообщения, которые сервер присылает без запроса (и ответы на команды без идентификатора).
+        Использование: async for message in client.messages(): ...
+        """
+        while True:
+            line = await self.read_line()
+            if not line:
+                return
+            yield line
+
+    def submit(self, request: str) -> asyncio.Future[list[str]]:
+        """
+        Отправляем команду с идентификатором и сразу возвращаем future с будущими строками ответа.
+        Можно отправить сотни команд подряд и дождаться ответов потом: await asyncio.gather(*futures).
+        """
+        request_id = str(next(self._request_ids))
+        future: asyncio.Future[list[str]] = asyncio.get_running_loop().create_future()
+        if self._is_closed:
+            future.set_exception(ConnectionError("Server closed the connection"))
+            return future
+        self._pending[request_id] = (future, [])
+        self._writer.write(prepare_message(f"{CORRELATION_PREFIX}{request_id} {request}").encode())
+        return future
+
+    async def request(self, request: str) -> list[str]:
+        """Отправляем команду с идентификатором и ждем строки ответа именно на нее"""
+        future = self.submit(request)
+        await self._writer.drain()
+        return await future
 
     async def _send(self, message: str) -> None:
-        """Вспомогательный метод для отправки сообщения на сервер"""
-        self._writer.write(message.encode())
+        """Вспомогательный метод для отправки сообщения на сервер. Каждая команда завершается переводом строки"""
+        self._writer.write(prepare_message(message).encode())
         await self._writer.drain()
 
-    async def connect(self):
-        """Отправляем /connect команду на сервер"""
-        await self._send(message="/connect")
+    async def connect(self, token: str | None = None):
+        """
+        Отправляем /connect команду на сервер.
+        Чтобы восстановить сессию (например, с другого устройства), указываем токен, выданный сервером.
+        """
+        if token is None:
+            await self._send(message="/connect")
+        else:
+            await self._send(message=f"/connect {token}")
 
     async def disconnect(self) -> None:
         """Отправляем /disconnect команду на сервер"""
@@ -73,20 +233,123 @@ class Client:
         result_message = f"{command} {user_id}"
         await self._send(result_message)
 
-    async def status(self):
-        """Отправляем /status команду на сервер"""
-        await self._send(message="/status")
+    async def status(self, limit: int | None = None, before: int | None = None, after: int | None = None):
+        """
+        Отправляем /status команду на сервер.
+        Опционально указываем размер страницы и курсор (before или after) для постраничного запроса истории.
+        """
+        arguments = []
+        if limit is not None:
+            arguments.append(str(limit))
+        if before is not None:
+            arguments.extend(("before", str(before)))
+        elif after is not None:
+            arguments.extend(("after", str(after)))
+        await self._send(" ".join(["/status", *arguments]))
+
+    async def status_summary(self):
+        """Отправляем /status summary команду на сервер"""
+        await self._send("/status summary")
 
-    async def send(self, message: str):
+    async def send(self, message: str, user_id: str | None = None, at: str | None = None):
         """
         Отправляем /send команду на сервер.
         В качестве параметра указываем сообщение, которое хотим отправить.
+        Если указан айди юзера, то сообщение уйдет ему в приватный чат.
+        Если указано время (ISO, HH:MM или +секунды), то сообщение будет отправлено в это время.
         """
         command = "/send"
+        if at is not None:
+            command = f"{command} --at {at}"
+        if user_id is not None:
+            command = f"{command} @{user_id}"
         result_message = f"{command} {message}"
         await self._send(result_message)
 
+    async def cancel(self, message_id: str) -> list[str]:
+        """Отправляем /cancel команду. Отменяем запланированное сообщение и возвращаем строки ответа"""
+        return await self.request(f"/cancel {message_id}")
+
+    async def room(self, action: str, *arguments: str) -> list[str]:
+        """
+        Отправляем /room команду: create, invite, join, leave или send с ее аргументами.
+        Возвращаем строки ответа.
+        """
+        return await self.request(" ".join(["/room", action, *arguments]))
+
+    async def upload(self, path: Path, user_id: str | None = None) -> list[str]:
+        """
+        Отправляем /upload команду, а сразу за ней содержимое файла.
+        Файл передается через loop.sendfile и не читается в память. Если указан айди юзера, файл уйдет ему в приват.
+        """
+        target = f"@{user_id} " if user_id is not None else ""
+        future = self.submit(f"/upload {target}{path.stat().st_size} {path.name}")
+        with path.open("rb") as file:
+            await asyncio.get_running_loop().sendfile(self._writer.transport, file)
+        return await future
+
+    async def download(self, file_id: str) -> tuple[list[str], bytes | None]:
+        """Отправляем /download команду. Возвращаем строки ответа и содержимое файла (None, если файла нет)"""
+        lines = await self.request(f"/download {file_id}")
+        return lines, self._downloads.pop(file_id, None)
+
+    def _log_lines(self, lines: list[str]) -> None:
+        self.logger.info(CLIENT_MESSAGE_TEMPLATE.format("\n".join(lines)))
+
+    async def _help_command(self, arguments: list[str]) -> None:
+        self.logger.info(CLIENT_HELP_MESSAGE)
+
+    async def _connect_command(self, arguments: list[str]) -> None:
+        await self.connect(arguments[0] if arguments else None)
+
+    async def _send_command(self, arguments: list[str]) -> None:
+        at = arguments[1] if arguments[:1] == ["--at"] and len(arguments) > 1 else None
+        if at is not None:
+            del arguments[:2]
+        user_id = arguments.pop(0)[1:] if arguments and arguments[0].startswith("@") else None
+        await self.send(" ".join(arguments), user_id=user_id, at=at)
+
+    async def _room_command(self, arguments: list[str]) -> None:
+        self._log_lines(await self.room(*arguments))
+
+    async def _cancel_command(self, arguments: list[str]) -> None:
+        self._log_lines(await self.cancel(arguments[0]))
+
+    async def _status_command(self, arguments: list[str]) -> None:
+        await self.status()
+
+    async def _report_command(self, arguments: list[str]) -> None:
+        await self.report(arguments[0])
+
+    async def _upload_command(self, arguments: list[str]) -> None:
+        user_id = arguments.pop(0)[1:] if arguments and arguments[0].startswith("@") else None
+        try:
+            lines = await self.upload(Path(" ".join(arguments)), user_id=user_id)
+        except OSError as err:
+            self.logger.info(CLIENT_MESSAGE_TEMPLATE.format(err))
+            return
+        self._log_lines(lines)
+
+    async def _download_command(self, arguments: list[str]) -> None:
+        file_id, *path_parts = arguments
+        lines, content = await self.download(file_id)
+        if content is not None:
+            Path(" ".join(path_parts) or file_id).write_bytes(content)
+        self._log_lines(lines)
+
     async def run(self):
+        # Команда -> (обработчик, нужны ли ей аргументы)
+        commands = {
+            "/help": (self._help_command, False),
+            "/connect": (self._connect_command, False),
+            "/send": (self._send_command, False),
+            "/room": (self._room_command, True),
+            "/cancel": (self._cancel_command, True),
+            "/status": (self._status_command, False),
+            "/report": (self._report_command, True),
+            "/upload": (self._upload_command, False),
+            "/download": (self._download_command, True),
+        }
         self.logger.info(CLIENT_HELP_MESSAGE)
         while True:
             data = await self.read()
@@ -99,28 +362,173 @@ class Client:
             if self._writer.is_closing():
                 break
 
-            if command.name == "/help":
-                self.logger.info(CLIENT_HELP_MESSAGE)
-            elif command.name == "/connect":
-                await self.connect()
-            elif command.name == "/send":
-                message = command.arguments[0]
-                await self.send(message)
-            elif command.name == "/status":
-                await self.status()
-            elif command.name == "/report":
-                user_id = command.arguments[0]
-                await self.report(user_id)
-            elif command.name == "/exit":
+            if command.name == "/exit":
                 await self.disconnect()
                 self.logger.info(CLIENT_MESSAGE_TEMPLATE.format("Close client!"))
                 break
-            else:
+
+            handler, needs_arguments = commands.get(command.name, (None, False))
+            if handler is None or (needs_arguments and not command.arguments):
                 self.logger.info(CLIENT_MESSAGE_TEMPLATE.format("Invalid request!"))
+                continue
+            await handler(list(command.arguments))
 
         await self.__close_connection()
 
 
+class BinaryClient:
+    """
+    Клиент бинарного протокола для программ, а не для людей.
+    Все команды отправляются кадрами с идентификатором запроса, ответ на команду - список кадров до REPLY_END.
+    Сообщения чата приходят кадрами MESSAGE с айди отправителя и sequence id, их не нужно разбирать из строк.
+    """
+
+    def __init__(
+        self,
+        server_host: str = SERVER_HOST,
+        server_port: int = SERVER_PORT,
+        logging_level: int = logging.CRITICAL,
+        compression: bool = False,
+    ) -> None:
+        self.idx = str(uuid.uuid4())
+        self._server_host = server_host
+        self._server_port = server_port
+        self._compression = compression
+        self._inflate_task: asyncio.Task | None = None
+
+        self.logger = logging.getLogger(f"{self.__class__.__name__}[{self.idx}]")
+        self.logger.setLevel(logging_level)
+
+        # Кадры без флага ответа. None в очереди означает, что сервер закрыл соединение
+        self._pushes: asyncio.Queue[binary.Frame | None] = asyncio.Queue()
+        # Ответы приходят в порядке запросов: request id -> (future, кадры ответа)
+        self._pending: dict[int, tuple[asyncio.Future[list[binary.Frame]], list[binary.Frame]]] = {}
+        self._request_ids: tp.Iterator[int] = itertools.count(1)
+        self._reader_task: asyncio.Task | None = None
+        self._is_closed = False
+
+    async def __aenter__(self) -> tp.Self:
+        self._reader, self._writer = await asyncio.open_connection(self._server_host, self._server_port)
+        if self._compression:
+            self._writer.write(bytes([HANDSHAKE_PREFIX | HANDSHAKE_BINARY | HANDSHAKE_COMPRESSION]))
+            self._reader, self._inflate_task = _start_inflating(self._reader)
+        else:
+            self._writer.write(bytes([HANDSHAKE_PREFIX | HANDSHAKE_BINARY]))
+        self._reader_task = asyncio.create_task(self._read_frames())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> bool:
+        self.logger.info("Close context manager")
+        if not self._writer.is_closing():
+            self._writer.close()
+            await self._writer.wait_closed()
+        await _stop_task(self._inflate_task)
+        await _stop_task(self._reader_task)
+        return False
+
+    def _dispatch_frame(self, frame: binary.Frame) -> None:
+        if frame.opcode == binary.PING:
+            self._writer.write(binary.encode_frame(binary.PONG))
+        elif frame.opcode == binary.REPLY_END:
+            future, frames = self._pending.pop(frame.seq)
+            if not future.done():
+                future.set_result(frames)
+        elif frame.flags & binary.FLAG_REPLY and self._pending:
+            # Запросы обрабатываются по очереди, поэтому кадр ответа относится к самому старому запросу
+            _, frames = next(iter(self._pending.values()))
+            frames.append(frame)
+        else:
+            self._pushes.put_nowait(frame)
+
+    async def _read_frames(self) -> None:
+        """Фоновая задача: раскладываем кадры по ответам и очереди сообщений"""
+        try:
+            while True:
+                # Кадр FILE несет файл целиком и может быть больше обычного кадра
+                frame = await binary.read_frame(self._reader, max(MAX_FRAME_SIZE, FILES_MAX_SIZE))
+                if frame is None:
+                    break
+                self._dispatch_frame(frame)
+        except ConnectionError as err:
+            self.logger.info(CLIENT_MESSAGE_TEMPLATE.format(err))
+        finally:
+            self._is_closed = True
+            self._pushes.put_nowait(None)
+            for future, _ in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Server closed the connection"))
+            self._pending.clear()
+
+    async def messages(self) -> tp.AsyncIterator[binary.Frame]:
+        """Кадры, которые сервер присылает без запроса. Использование: async for frame in client.messages(): ..."""
+        while True:
+            frame = await self._pushes.get()
+            if frame is None:
+                return
+            yield frame
+
+    def submit(
+        self,
+        opcode: int,
+        payload: bytes = b"",
+        user_id: str | None = None,
+    ) -> asyncio.Future[list[binary.Frame]]:
+        """Отправляем кадр запроса и сразу возвращаем future с будущими кадрами ответа"""
+        request_id = next(self._request_ids)
+        future: asyncio.Future[list[binary.Frame]] = asyncio.get_running_loop().create_future()
+        if self._is_closed:
+            future.set_exception(ConnectionError("Server closed the connection"))
+            return future
+        self._pending[request_id] = (future, [])
+        encoded_user_id = binary.encode_user_id(user_id) if user_id is not None else binary.NO_USER_ID
+        self._writer.write(binary.encode_frame(opcode, payload, seq=request_id, user_id=encoded_user_id))
+        return future
+
+    async def request(self, opcode: int, payload: bytes = b"", user_id: str | None = None) -> list[binary.Frame]:
+        future = self.submit(opcode, payload, user_id)
+        await self._writer.drain()
+        return await future
+
+    async def connect(self, token: str | None = None) -> list[binary.Frame]:
+        return await self.request(binary.CONNECT, (token or "").encode())
+
+    async def disconnect(self) -> list[binary.Frame]:
+        return await self.request(binary.DISCONNECT)
+
+    async def send(self, message: str, user_id: str | None = None) -> list[binary.Frame]:
+        return await self.request(binary.SEND, message.encode(), user_id=user_id)
+
+    async def status(
+        self,
+        limit: int | None = None,
+        before: int | None = None,
+        after: int | None = None,
+    ) -> list[binary.Frame]:
+        if limit is None and before is None and after is None:
+            return await self.request(binary.STATUS)
+
+        cursor, cursor_seq = (1, before) if before is not None else (2, after) if after is not None else (0, 0)
+        return await self.request(binary.STATUS, binary.STATUS_REQUEST.pack(limit or 0, cursor, cursor_seq or 0))
+
+    async def status_summary(self) -> list[binary.Frame]:
+        return await self.request(binary.STATUS, binary.STATUS_REQUEST.pack(0, 3, 0))
+
+    async def report(self, user_id: str) -> list[binary.Frame]:
+        return await self.request(binary.REPORT, user_id=user_id)
+
+    async def upload(self, path: Path, user_id: str | None = None) -> list[binary.Frame]:
+        """Кадр UPLOAD с размером и именем файла, за ним содержимое файла через loop.sendfile"""
+        payload = binary.UPLOAD_REQUEST.pack(path.stat().st_size) + path.name.encode()
+        future = self.submit(binary.UPLOAD, payload, user_id=user_id)
+        with path.open("rb") as file:
+            await asyncio.get_running_loop().sendfile(self._writer.transport, file)
+        return await future
+
+    async def download(self, file_id: str) -> list[binary.Frame]:
+        """Ответ - кадр TEXT с заголовком и кадр FILE с содержимым файла"""
+        return await self.request(binary.DOWNLOAD, file_id.encode())
+
+
 async def run_client() -> None:
     async with Client(logging_level=logging.INFO) as client:
         await client.run()
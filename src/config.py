@@ -1,4 +1,5 @@
 import logging
+import os
 import sys
 from pathlib import Path
 
@@ -13,12 +14,55 @@ with config_path.open("r", encoding="utf8") as f:
 logging.basicConfig(**config["logging"], stream=sys.stdout)
 
 ALREADY_CONNECTED_MESSAGE_TEMPLATE = "[*] You are already connected."
+SESSION_TOKEN_MESSAGE_TEMPLATE = "[*] Your session token: {token}"
+INVALID_SESSION_MESSAGE_TEMPLATE = "[*] Session does not exist or expired. Request /connect without token."
 NO_MESSAGE_TEMPLATE = "[*] No messages yet."
 ERROR_REQUEST_MESSAGE_TEMPLATE = "[*] Invalid request. Try again."
 NOT_CONNECTED_MESSAGE_TEMPLATE = "[*] You are not connected. Please, request /connect command."
 BAN_MESSAGE_TEMPLATE = "[*] You banned to {banned_to}."
-BLOCK_CHATING_MESSAGE_TEMPLATE = "[*] You have no message limit. Try again at {block_to}."
+RATE_LIMIT_MESSAGE_TEMPLATE = "[*] Too many {command} requests. Try again in {retry_after:.1f} seconds."
 USER_NO_FOUND_MESSAGE_TEMPLATE = "[*] User with {user_id} id does not exists."
+STATUS_SUMMARY_MESSAGE_TEMPLATE = "[*] Users online: {users_count}. Messages: {messages_count}. Last seq: {last_seq}."
+STATUS_CURSOR_MESSAGE_TEMPLATE = "[*] Cursor: before {before} after {after}."
+FRAME_TOO_LARGE_MESSAGE_TEMPLATE = "[*] Request is too large. Max request size is {max_size} bytes."
+METRICS_DISABLED_MESSAGE_TEMPLATE = "[*] Metrics are disabled."
+MISSED_MESSAGES_MESSAGE_TEMPLATE = "[*] You missed {count} messages. Request /status to read them."
+SERVER_FULL_MESSAGE_TEMPLATE = "[*] Server is full. Try again later."
+TOO_MANY_CONNECTIONS_MESSAGE_TEMPLATE = "[*] Too many connections from {host}. Try again later."
+# Keepalive ping of a quiet connection. Client answers with KEEPALIVE_PONG, which is not replied to
+KEEPALIVE_PING_MESSAGE = "[*] Ping"
+KEEPALIVE_PONG = "/pong"
+SCHEDULED_MESSAGE_TEMPLATE = (
+    "[*] Message {message_id} is scheduled to {send_at}. Request /cancel {message_id} to cancel it."
+)
+CANCELLED_MESSAGE_TEMPLATE = "[*] Scheduled message {message_id} is cancelled."
+SCHEDULED_NOT_FOUND_MESSAGE_TEMPLATE = "[*] Scheduled message {message_id} does not exist or is already sent."
+SCHEDULED_UNAVAILABLE_MESSAGE_TEMPLATE = "[*] Scheduled messages are not available on a cluster server."
+INVALID_SEND_TIME_MESSAGE_TEMPLATE = (
+    "[*] Invalid send time {send_at}. Use a future time: ISO date and time, HH:MM[:SS] or +<seconds>."
+)
+ROOM_CREATED_MESSAGE_TEMPLATE = "[*] Room {room_id} ({name}) is created. Invite link: /room join {invite_code}"
+ROOM_NOT_FOUND_MESSAGE_TEMPLATE = "[*] Room {room_id} does not exist or you are not its member."
+ROOM_OWNER_ONLY_MESSAGE_TEMPLATE = "[*] Only the owner of room {room_id} can invite users."
+ROOM_INVITED_MESSAGE_TEMPLATE = "[*] User {user_id} is a member of room {room_id} now."
+ROOM_JOINED_MESSAGE_TEMPLATE = (
+    "[*] You are a member of room {room_id} ({name}) now. Request /room send {room_id} <message> to write there."
+)
+ROOM_ALREADY_MEMBER_MESSAGE_TEMPLATE = "[*] You are a member of room {room_id} already."
+ROOM_INVALID_INVITE_MESSAGE_TEMPLATE = "[*] Invite link {invite_code} is invalid."
+ROOM_JOIN_REQUESTED_MESSAGE_TEMPLATE = "[*] Request to join room {room_id} ({name}) is sent to its owner."
+ROOM_JOIN_REQUEST_MESSAGE_TEMPLATE = (
+    "[*] User {user_id} asks to join room {room_id} ({name}). Request /room invite {room_id} @{user_id} to approve."
+)
+ROOM_LEFT_MESSAGE_TEMPLATE = "[*] You left room {room_id}."
+ROOMS_UNAVAILABLE_MESSAGE_TEMPLATE = "[*] Rooms are not available on a cluster server."
+FILE_MESSAGE_TEMPLATE = "[file] {name} ({size} bytes). Request /download {file_id}"
+FILE_UPLOADED_MESSAGE_TEMPLATE = "[*] File {file_id} is uploaded. sha256 {sha256}."
+# Download reply: the header line is followed by exactly {size} bytes of the file
+FILE_HEADER_MESSAGE_TEMPLATE = "[*] File {file_id} {size} bytes sha256 {sha256}: {name}"
+FILE_TOO_LARGE_MESSAGE_TEMPLATE = "[*] File is too large. Max file size is {max_size} bytes."
+FILE_NOT_FOUND_MESSAGE_TEMPLATE = "[*] File {file_id} does not exist or expired."
+FILE_TRANSFER_UNAVAILABLE_MESSAGE_TEMPLATE = "[*] Files can not be transferred over this connection."
 
 DATE_FORMAT = config["logging"]["datefmt"]
 
@@ -29,20 +73,142 @@ SERVER_HOST = server_config.get("SERVER_HOST", "127.0.0.1")
 SERVER_PORT = server_config.get("SERVER_PORT", 8000)
 
 SHOW_LAST_MESSAGES_COUNT = server_config.get("show_last_messages_count", 20)
+STATUS_PAGE_SIZE = server_config.get("status_page_size", 50)
+STATUS_MAX_PAGE_SIZE = server_config.get("status_max_page_size", 500)
 MESSAGE_LIFETIME_SECONDS = server_config.get("message_lifetime_seconds", 3600)
-USER_MESSAGE_LIMIT = server_config.get("user_message_limit", 20)
-CHATING_BLOCK_LIFETIME_SECONDS = server_config.get("chating_block_lifetime_seconds", 3600)
 MAX_REPORTS_COUNT = server_config.get("max_reports_count", 3)
 BAN_LIFETIME_SECONDS = server_config.get("ban_lifetime_seconds", 14400)
+SESSION_LIFETIME_SECONDS = server_config.get("session_lifetime_seconds", 86400)
+INBOX_MAX_SIZE = server_config.get("inbox_max_size", 1000)
+OUTBOUND_QUEUE_SIZE = server_config.get("outbound_queue_size", 1024)
+MAX_FRAME_SIZE = server_config.get("max_frame_size", 65536)
+FRAME_DELIMITER = b"\n"
+# Optional first byte of a connection: HANDSHAKE_PREFIX with option bits. Text requests never start with it,
+# because 0xB0-0xBF bytes can not start UTF-8 text. Without handshake the connection speaks plain text
+HANDSHAKE_PREFIX = 0xB0
+HANDSHAKE_BINARY = 0x01
+HANDSHAKE_COMPRESSION = 0x02
+CORRELATION_PREFIX = "#"
+REPLAY_CHUNK_SIZE_BYTES = server_config.get("replay_chunk_size_bytes", 65536)
+EXPIRY_RESOLUTION_SECONDS = server_config.get("expiry_resolution_seconds", 0.1)
+
+# Rate limits. A command can be requested "capacity" times in a burst,
+# then the capacity is refilled evenly over "period_seconds"
+RATE_LIMITS = {
+    "/send": {"capacity": 20, "period_seconds": 3600},
+    "/report": {"capacity": 10, "period_seconds": 3600},
+    "/status": {"capacity": 30, "period_seconds": 60},
+    "/upload": {"capacity": 5, "period_seconds": 60},
+    "/room": {"capacity": 30, "period_seconds": 60},
+}
+RATE_LIMITS.update(config.get("rate_limits") or {})
+
+# Storage
+storage_config = config.get("storage", {})
+
+STORAGE_BACKEND = storage_config.get("backend", "memory")
+SQLITE_PATH = BASE_DIR / storage_config.get("sqlite_path", "data/chat.sqlite3")
+SQLITE_CACHE_SIZE = storage_config.get("sqlite_cache_size", 10000)
+
+# Uploaded files. They are streamed to the spool directory and expire together with messages
+files_config = config.get("files", {})
+
+FILES_DIR = BASE_DIR / files_config.get("directory", "data/files")
+FILES_MAX_SIZE = files_config.get("max_size", 5242880)
+FILES_CHUNK_SIZE = files_config.get("chunk_size", 65536)
+
+# Rooms. Every room keeps up to max_messages latest messages, older ones are dropped before they expire
+rooms_config = config.get("rooms", {})
+
+ROOM_MAX_MESSAGES = rooms_config.get("max_messages", 1000)
+
+# Persistence of the in-memory storage. SQLite storage is persistent by itself
+persistence_config = config.get("persistence", {})
+
+PERSISTENCE_ENABLED = persistence_config.get("enabled", False) and STORAGE_BACKEND == "memory"
+PERSISTENCE_DIR = BASE_DIR / persistence_config.get("directory", "data")
+PERSISTENCE_FLUSH_INTERVAL_SECONDS = persistence_config.get("flush_interval_seconds", 1)
+PERSISTENCE_SNAPSHOT_INTERVAL_SECONDS = persistence_config.get("snapshot_interval_seconds", 300)
+
+# Cluster
+cluster_config = config.get("cluster", {})
+
+CLUSTER_WORKERS = cluster_config.get("workers") or os.cpu_count() or 1
+CLUSTER_BROKER_PATH = BASE_DIR / cluster_config.get("broker_path", "data/broker.sock")
+
+# Metrics
+metrics_config = config.get("metrics", {})
+
+METRICS_ENABLED = metrics_config.get("enabled", False)
+# Prometheus text listener is not started without port. Cluster worker N listens on port + N
+METRICS_PROMETHEUS_PORT = metrics_config.get("prometheus_port")
+# Without token any connected user can request /metrics
+METRICS_ADMIN_TOKEN = metrics_config.get("admin_token")
+METRICS_LOOP_LAG_INTERVAL_SECONDS = metrics_config.get("loop_lag_interval_seconds", 0.5)
+
+# Slow consumers. Connection output is bounded by the outbox (writes queued by the server)
+# and by the transport buffer (writes the kernel has not accepted yet)
+slow_consumer_config = config.get("slow_consumer", {})
+
+# What to do with a push when the outbox is full:
+# "drop_oldest" - drop queued writes to make room, "coalesce" - skip the push and later send
+# the number of missed messages, "disconnect" - close the connection
+SLOW_CONSUMER_OVERFLOW_POLICY = slow_consumer_config.get("overflow_policy", "coalesce")
+SLOW_CONSUMER_OUTBOX_MAX_BYTES = slow_consumer_config.get("outbox_max_bytes", 1048576)
+SLOW_CONSUMER_WRITE_HIGH_WATERMARK = slow_consumer_config.get("write_high_watermark", 65536)
+SLOW_CONSUMER_WRITE_LOW_WATERMARK = slow_consumer_config.get("write_low_watermark", 16384)
+# Connection which does not take a write for this long is closed
+SLOW_CONSUMER_DRAIN_TIMEOUT_SECONDS = slow_consumer_config.get("drain_timeout_seconds", 10)
+
+# Admission control of line protocol and HTTP connections. Limits are counted by every cluster worker
+admission_config = config.get("admission", {})
+
+ADMISSION_MAX_CONNECTIONS = admission_config.get("max_connections", 10000)
+ADMISSION_MAX_CONNECTIONS_PER_IP = admission_config.get("max_connections_per_ip", 256)
+# Connection which sent nothing for keepalive_interval_seconds is pinged,
+# connection which sent nothing (not even a pong) for idle_timeout_seconds is closed and its session is purged
+ADMISSION_KEEPALIVE_INTERVAL_SECONDS = admission_config.get("keepalive_interval_seconds", 60)
+ADMISSION_IDLE_TIMEOUT_SECONDS = admission_config.get("idle_timeout_seconds", 300)
+
+# Compression of connection output, requested by the client handshake
+compression_config = config.get("compression", {})
+
+COMPRESSION_LEVEL = compression_config.get("level", 6)
+# Smaller writes are sent uncompressed
+COMPRESSION_MIN_SIZE = compression_config.get("min_size", 256)
+
+# HTTP front end. It listens next to the line protocol and maps HTTP requests onto the same handlers
+http_config = config.get("http", {})
+
+HTTP_ENABLED = http_config.get("enabled", False)
+HTTP_PORT = http_config.get("port", 8080)
+HTTP_MAX_BODY_SIZE = http_config.get("max_body_size", 65536)
+HTTP_KEEPALIVE_TIMEOUT_SECONDS = http_config.get("keepalive_timeout_seconds", 15)
+# HTTP session without requests and open event streams is closed after this timeout
+HTTP_SESSION_IDLE_SECONDS = http_config.get("session_idle_seconds", 300)
+HTTP_LONG_POLL_TIMEOUT_SECONDS = http_config.get("long_poll_timeout_seconds", 25)
+HTTP_SSE_KEEPALIVE_SECONDS = http_config.get("sse_keepalive_seconds", 15)
 
 # Client
 CLIENT_HELP_MESSAGE = (
     "\nAvailable commands:\n"
     "/help - help command (no arguments)\n"
-    "/connect - connect to server (no arguments)\n"
-    "/send - send message to server (no arguments)\n"
-    "/status - get general chat status (no arguments)\n"
+    "/connect - connect to server (arguments: [session_token:str] to restore session)\n"
+    "/send - send message to general chat (arguments: <message:str>)\n"
+    "/send @<user_id> - send private message to user (arguments: <message:str>)\n"
+    "/send --at <time> - schedule message (arguments: [@<user_id>] <message:str>, time: ISO, HH:MM or +seconds)\n"
+    "/cancel - cancel scheduled message (arguments: <message_id:str>)\n"
+    "/room create - create room (arguments: <name:str>)\n"
+    "/room invite - invite user to room or approve join request (arguments: <room_id:str> @<user_id>)\n"
+    "/room join - ask room owner to let you in (arguments: <invite_code:str>)\n"
+    "/room leave - leave room (arguments: <room_id:str>)\n"
+    "/room send - send message to room (arguments: <room_id:str> <message:str>)\n"
+    "/status - get general chat messages page (arguments: [limit:int] [before|after <seq:int>])\n"
+    "/status summary - get general chat summary without messages\n"
     "/report - user report (arguments: <user_id:str>)\n"
+    "/upload - send file to general chat (arguments: [@<user_id>] <path:str>)\n"
+    "/download - download file (arguments: <file_id:str> [path:str])\n"
+    "/metrics - server metrics (arguments: [admin_token:str])\n"
     "/exit - close client (no arguments)"
 )
 CLIENT_MESSAGE_TEMPLATE = "\n{}"
@@ -0,0 +1,45 @@
+import collections
+
+__all__ = ("SERVER_FULL", "HOST_LIMIT", "AdmissionControl")
+
+# Rejection reasons
+SERVER_FULL = "server_full"
+HOST_LIMIT = "host_limit"
+
+
+class AdmissionControl:
+    """
+    Open connections counted in total and by peer host.
+
+    A connection is checked before the server reads anything from it, so a rejected peer costs one short write
+    and a close. Hosts without open connections are removed from the counter, it does not grow with reconnects.
+    """
+
+    def __init__(self, max_connections: int, max_connections_per_host: int) -> None:
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.count = 0
+        self._by_host: collections.Counter[str] = collections.Counter()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def admit(self, host: str) -> str | None:
+        """Count a new connection of host. Returns None if it is admitted, otherwise the rejection reason"""
+        if self.count >= self.max_connections:
+            return SERVER_FULL
+        if self._by_host[host] >= self.max_connections_per_host:
+            return HOST_LIMIT
+
+        self.count += 1
+        self._by_host[host] += 1
+        return None
+
+    def release(self, host: str) -> None:
+        self.count -= 1
+        self._by_host[host] -= 1
+        if self._by_host[host] <= 0:
+            del self._by_host[host]
+
+    def get_host_count(self, host: str) -> int:
+        return self._by_host.get(host, 0)
@@ -0,0 +1,214 @@
+import asyncio
+import struct
+import typing as tp
+from asyncio import StreamReader
+from dataclasses import dataclass
+
+__all__ = (
+    "FRAME_HEADER",
+    "CONNECT",
+    "DISCONNECT",
+    "SEND",
+    "STATUS",
+    "REPORT",
+    "METRICS",
+    "PONG",
+    "UPLOAD",
+    "DOWNLOAD",
+    "MESSAGE",
+    "TEXT",
+    "REPLY_END",
+    "PING",
+    "FILE",
+    "FLAG_REPLY",
+    "FLAG_PRIVATE",
+    "FLAG_ROOM",
+    "STATUS_REQUEST",
+    "UPLOAD_REQUEST",
+    "NO_USER_ID",
+    "Frame",
+    "FrameTooLargeError",
+    "encode_frame",
+    "encode_user_id",
+    "decode_user_id",
+    "read_frame",
+    "frame_to_command",
+    "message_payload",
+    "split_message_payload",
+)
+
+# Frame: <payload length:uint32><opcode:uint8><flags:uint8><seq:uint64><user id:16 bytes><payload>.
+# Requests carry a client chosen request id in seq, replies to the request echo it.
+# MESSAGE frames carry the message sequence id in seq and the sender id in user id,
+# requests carry the target user (receiver of a private message, reported user)
+FRAME_HEADER = struct.Struct("!IBBQ16s")
+NO_USER_ID = bytes(16)
+
+# Client requests
+CONNECT = 1
+DISCONNECT = 2
+SEND = 3
+STATUS = 4
+REPORT = 5
+METRICS = 6
+# Answer to PING. It only marks the connection as active and gets no reply
+PONG = 7
+# UPLOAD frame is followed by the file content outside of the frame, see UPLOAD_REQUEST
+UPLOAD = 8
+DOWNLOAD = 9
+
+# Server frames
+MESSAGE = 16
+TEXT = 17
+REPLY_END = 18
+PING = 19
+# FILE payload is the file content. It is written with sendfile and is not limited by the max frame size
+FILE = 20
+
+# Frame is a part of the reply to the oldest request which has not got REPLY_END yet
+FLAG_REPLY = 1
+FLAG_PRIVATE = 2
+# Message of a room. Rooms are managed with the text protocol, the frame does not say which room it is
+FLAG_ROOM = 4
+
+# MESSAGE payload: <created at:float64 unix time><UTF-8 content>
+MESSAGE_PAYLOAD_HEADER = struct.Struct("!d")
+
+# STATUS payload is empty (last page) or <limit:uint32><cursor:uint8><cursor seq:uint64>
+STATUS_REQUEST = struct.Struct("!IBQ")
+STATUS_CURSORS = {0: (), 1: ("before",), 2: ("after",), 3: ("summary",)}
+
+# UPLOAD payload: <content size:uint64><UTF-8 file name>. User id is the receiver of a private file
+UPLOAD_REQUEST = struct.Struct("!Q")
+
+
+class FrameTooLargeError(Exception):
+    def __init__(self, seq: int) -> None:
+        super().__init__("Frame of request %s is too large" % seq)
+        self.seq = seq
+
+
+@dataclass(frozen=True, slots=True)
+class Frame:
+    opcode: int
+    flags: int
+    seq: int
+    user_id: bytes
+    payload: bytes
+
+
+def encode_frame(
+    opcode: int,
+    payload: bytes = b"",
+    *,
+    seq: int = 0,
+    user_id: bytes = NO_USER_ID,
+    flags: int = 0,
+) -> bytes:
+    return FRAME_HEADER.pack(len(payload), opcode, flags, seq, user_id) + payload
+
+
+def encode_user_id(idx: str) -> bytes:
+    """User ids are uuid4 hex strings, on the wire they take 16 raw bytes"""
+    return bytes.fromhex(idx)
+
+
+def decode_user_id(user_id: bytes) -> str:
+    return user_id.hex()
+
+
+async def read_frame(reader: StreamReader, max_size: int) -> Frame | None:
+    """
+    Read one frame. None means that the peer closed the connection.
+    Payload of a too large frame is skipped, so the next frame can be read after FrameTooLargeError.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+
+    length, opcode, flags, seq, user_id = FRAME_HEADER.unpack(header)
+    try:
+        if length > max_size:
+            while length:
+                length -= len(await reader.readexactly(min(length, max_size)))
+            raise FrameTooLargeError(seq)
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return Frame(opcode=opcode, flags=flags, seq=seq, user_id=user_id, payload=payload)
+
+
+def _status_arguments(payload: bytes) -> list[str]:
+    if not payload:
+        return []
+    if len(payload) != STATUS_REQUEST.size:
+        raise ValueError("Invalid status request")
+    limit, cursor, cursor_seq = STATUS_REQUEST.unpack(payload)
+    if cursor not in STATUS_CURSORS:
+        raise ValueError("Unknown status cursor %s" % cursor)
+
+    arguments = list(STATUS_CURSORS[cursor])
+    if cursor in (1, 2):
+        arguments.append(str(cursor_seq))
+    if limit and cursor != 3:
+        arguments.insert(0, str(limit))
+    return arguments
+
+
+def _target_arguments(frame: Frame) -> list[str]:
+    """Target user goes first, like "@<user_id>" of the text protocol"""
+    return ["@" + decode_user_id(frame.user_id)] if frame.user_id != NO_USER_ID else []
+
+
+def _optional_text_arguments(frame: Frame) -> list[str]:
+    text = frame.payload.decode()
+    return [text] if text else []
+
+
+def _send_arguments(frame: Frame) -> list[str]:
+    return _target_arguments(frame) + [frame.payload.decode()]
+
+
+def _report_arguments(frame: Frame) -> list[str]:
+    return [decode_user_id(frame.user_id)] if frame.user_id != NO_USER_ID else []
+
+
+def _upload_arguments(frame: Frame) -> list[str]:
+    if len(frame.payload) < UPLOAD_REQUEST.size:
+        raise ValueError("Invalid upload request")
+    (size,) = UPLOAD_REQUEST.unpack_from(frame.payload)
+    return _target_arguments(frame) + [str(size), frame.payload[UPLOAD_REQUEST.size:].decode()]
+
+
+# Request opcode -> command name and decoder of its arguments
+REQUEST_COMMANDS: dict[int, tuple[str, tp.Callable[[Frame], list[str]]]] = {
+    CONNECT: ("/connect", _optional_text_arguments),
+    DISCONNECT: ("/disconnect", lambda frame: []),
+    SEND: ("/send", _send_arguments),
+    STATUS: ("/status", lambda frame: _status_arguments(frame.payload)),
+    REPORT: ("/report", _report_arguments),
+    METRICS: ("/metrics", _optional_text_arguments),
+    UPLOAD: ("/upload", _upload_arguments),
+    DOWNLOAD: ("/download", lambda frame: [frame.payload.decode()]),
+}
+
+
+def frame_to_command(frame: Frame) -> tuple[str, list[str]]:
+    """
+    Map request frame to command name and arguments of the text protocol handlers.
+    Message content is passed as one argument, so it is not split and joined again. Raises ValueError.
+    """
+    if frame.opcode not in REQUEST_COMMANDS:
+        raise ValueError("Unknown opcode %s" % frame.opcode)
+    name, decode_arguments = REQUEST_COMMANDS[frame.opcode]
+    return name, decode_arguments(frame)
+
+
+def message_payload(created_at: float, content: str) -> bytes:
+    return MESSAGE_PAYLOAD_HEADER.pack(created_at) + content.encode()
+
+
+def split_message_payload(payload: bytes) -> tuple[float, str]:
+    (created_at,) = MESSAGE_PAYLOAD_HEADER.unpack_from(payload)
+    return created_at, payload[MESSAGE_PAYLOAD_HEADER.size:].decode()
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import typing as tp
+from asyncio import StreamReader, StreamWriter
+from pathlib import Path
+
+from core.persistence import RECORD_HEADER, encode_record
+from core.utils import SequenceCounter
+
+__all__ = (
+    "HELLO_EVENT",
+    "USER_EVENT",
+    "ATTACH_EVENT",
+    "DETACH_EVENT",
+    "MESSAGE_EVENT",
+    "REPORT_EVENT",
+    "LIMIT_EVENT",
+    "PURGE_EVENT",
+    "SNAPSHOT_REQUEST_EVENT",
+    "SNAPSHOT_EVENT",
+    "Broker",
+    "ClusterLink",
+)
+
+logger = logging.getLogger(__name__)
+
+# Events are framed like chat log records: <payload length:uint32><event type:uint8><JSON payload>
+HELLO_EVENT = 1
+USER_EVENT = 2
+ATTACH_EVENT = 3
+DETACH_EVENT = 4
+MESSAGE_EVENT = 5
+REPORT_EVENT = 6
+LIMIT_EVENT = 7
+PURGE_EVENT = 8
+# A worker which joins later gets the state of a running worker instead of replaying the events it missed
+SNAPSHOT_REQUEST_EVENT = 9
+SNAPSHOT_EVENT = 10
+
+EventHandler = tp.Callable[[int, dict], tp.Awaitable[None]]
+
+
+async def read_event(reader: StreamReader) -> tuple[int, dict] | None:
+    try:
+        header = await reader.readexactly(RECORD_HEADER.size)
+        length, event_type = RECORD_HEADER.unpack(header)
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return event_type, json.loads(payload)
+
+
+class Broker:
+    """
+    Local pub/sub broker of cluster workers on a Unix socket.
+
+    Every event is sent back to all workers including the one it came from,
+    so all workers apply state changes in one order and keep equal replicas of users and messages.
+    Messages get their sequence ids here, so the ids are global for the cluster.
+    A worker which joins later gets a snapshot of the state from a running worker.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._workers: list[StreamWriter] = []
+        self._sequence = SequenceCounter()
+        # Joining worker id -> (joining worker, worker which makes the snapshot for it)
+        self._joining: dict[int, tuple[StreamWriter, StreamWriter]] = {}
+
+    async def _broadcast(self, data: bytes) -> None:
+        for writer in list(self._workers):
+            writer.write(data)
+        for writer in list(self._workers):
+            try:
+                await writer.drain()
+            except ConnectionError as err:
+                logger.error("Failed to send event to worker: %s" % err)
+
+    def _join(self, writer: StreamWriter, worker_id: int) -> None:
+        """
+        Add worker to the broadcast and request the snapshot for it from a running worker.
+        Both happen without a pause, so the events broadcast before are in the snapshot
+        and the events broadcast after reach the new worker directly.
+        """
+        peers = list(self._workers)
+        self._workers.append(writer)
+        if not peers:
+            # The first worker keeps the state it has restored itself
+            writer.write(encode_record(SNAPSHOT_EVENT, {"worker": worker_id, "state": None}))
+            return
+
+        self._joining[worker_id] = (writer, peers[0])
+        peers[0].write(encode_record(SNAPSHOT_REQUEST_EVENT, {"worker": worker_id}))
+
+    def _leave(self, writer: StreamWriter) -> None:
+        self._workers.remove(writer)
+        for worker_id, (joining_writer, peer) in list(self._joining.items()):
+            if joining_writer is writer:
+                del self._joining[worker_id]
+            elif peer is writer:
+                # A snapshot of another worker would include events which the joining worker has received already
+                logger.error("Worker left before it sent the snapshot for worker %s" % worker_id)
+                del self._joining[worker_id]
+                joining_writer.write(encode_record(SNAPSHOT_EVENT, {"worker": worker_id, "state": None}))
+
+    async def _handle_worker(self, reader: StreamReader, writer: StreamWriter) -> None:
+        while True:
+            event = await read_event(reader)
+            if event is None:
+                break
+
+            event_type, payload = event
+            if event_type == HELLO_EVENT:
+                # Workers restore persisted messages on start, new sequence ids must continue after them
+                self._sequence.advance_to(payload["last_seq"])
+                self._join(writer, payload["worker"])
+                logger.info("Worker %s joined the broker" % payload["worker"])
+                continue
+
+            if event_type == SNAPSHOT_EVENT:
+                # The snapshot goes only to the worker which has requested it
+                joining = self._joining.pop(payload["worker"], None)
+                if joining is not None:
+                    joining[0].write(encode_record(SNAPSHOT_EVENT, payload))
+                continue
+
+            if event_type == MESSAGE_EVENT:
+                payload["seq"] = self._sequence.next()
+            await self._broadcast(encode_record(event_type, payload))
+
+        if writer in self._workers:
+            self._leave(writer)
+        writer.close()
+
+    async def run(self) -> None:
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(self._handle_worker, path=self._path)
+        logger.info("Broker is running on %s" % self._path)
+        async with server:
+            await server.serve_forever()
+
+
+class ClusterLink:
+    """Connection of a worker to the broker. Not connected link means the server runs as a single process"""
+
+    def __init__(self) -> None:
+        self.worker_id: int | None = None
+        self._reader: StreamReader | None = None
+        self._writer: StreamWriter | None = None
+        # Events which came while the link was waiting for the snapshot
+        self._backlog: list[tuple[int, dict]] = []
+
+    @property
+    def is_connected(self) -> bool:
+        return self._writer is not None
+
+    async def connect(self, path: Path, worker_id: int, last_seq: int, attempts: int = 50) -> dict | None:
+        """
+        Join the broker and wait for the state of the running workers.
+        Returns the snapshot or None if this worker is the first one and keeps its own state.
+        """
+        # The broker process could still be starting
+        for _ in range(attempts):
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(path=path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError("Broker is not available on %s" % path)
+
+        self.worker_id = worker_id
+        self.publish(HELLO_EVENT, {"worker": worker_id, "last_seq": last_seq})
+        while True:
+            event = await read_event(self._reader)
+            if event is None:
+                raise ConnectionError("Broker closed the connection")
+
+            event_type, payload = event
+            if event_type == SNAPSHOT_EVENT:
+                break
+            # Events after the snapshot request are not in the snapshot, they are applied after it
+            self._backlog.append(event)
+
+        logger.info("Worker %s is connected to the broker" % worker_id)
+        return payload["state"]
+
+    def publish(self, event_type: int, payload: dict) -> None:
+        if self._writer is None:
+            raise ConnectionError("Cluster link is not connected")
+        self._writer.write(encode_record(event_type, payload))
+
+    async def _apply(self, handler: EventHandler, event_type: int, payload: dict) -> None:
+        try:
+            await handler(event_type, payload)
+        except Exception as err:
+            logger.exception("Failed to apply %s event: %s" % (event_type, err))
+
+    async def run(self, handler: EventHandler) -> None:
+        if self._reader is None:
+            raise ConnectionError("Cluster link is not connected")
+
+        backlog, self._backlog = self._backlog, []
+        for event_type, payload in backlog:
+            await self._apply(handler, event_type, payload)
+
+        while True:
+            event = await read_event(self._reader)
+            if event is None:
+                logger.error("Broker closed the connection")
+                return
+
+            event_type, payload = event
+            await self._apply(handler, event_type, payload)
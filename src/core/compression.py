@@ -0,0 +1,53 @@
+import asyncio
+import struct
+import zlib
+from asyncio import StreamReader
+
+__all__ = ("COMPRESSED_FLAG", "COMPRESSION_HEADER", "StreamCompressor", "inflate_stream")
+
+# Compressed connection output is framed: <flag and length:uint32><data>.
+# The high bit marks data which went through the connection deflate stream, other frames are sent as is
+COMPRESSION_HEADER = struct.Struct("!I")
+COMPRESSED_FLAG = 0x80000000
+
+
+class StreamCompressor:
+    """
+    Deflate context of one connection. It lives as long as the connection, so repeated date prefixes
+    and user tags of earlier writes stay in the window and later writes refer to them.
+    Every compressed write ends with a sync flush, so the client can inflate it without waiting for more data.
+    """
+
+    __slots__ = ("min_size", "bytes_in", "bytes_out", "_compressor")
+
+    def __init__(self, level: int, min_size: int) -> None:
+        self.min_size = min_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._compressor = zlib.compressobj(level)
+
+    def encode(self, data: bytes) -> tuple[bytes, bytes]:
+        """Header and body of one output frame. Data below min_size is not worth the frame overhead of deflate"""
+        self.bytes_in += len(data)
+        if len(data) < self.min_size:
+            self.bytes_out += COMPRESSION_HEADER.size + len(data)
+            return COMPRESSION_HEADER.pack(len(data)), data
+
+        compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_out += COMPRESSION_HEADER.size + len(compressed)
+        return COMPRESSION_HEADER.pack(len(compressed) | COMPRESSED_FLAG), compressed
+
+
+async def inflate_stream(reader: StreamReader, output: StreamReader) -> None:
+    """Read compressed connection output and feed the original bytes into output, so it reads like a plain stream"""
+    decompressor = zlib.decompressobj()
+    try:
+        while True:
+            header = await reader.readexactly(COMPRESSION_HEADER.size)
+            (value,) = COMPRESSION_HEADER.unpack(header)
+            data = await reader.readexactly(value & ~COMPRESSED_FLAG)
+            output.feed_data(decompressor.decompress(data) if value & COMPRESSED_FLAG else data)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        output.feed_eof()
@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import re
+import typing as tp
+from datetime import datetime
+from pathlib import Path
+
+from core.schemas import StoredFile
+
+__all__ = ("FileTooLargeError", "FileSpool")
+
+logger = logging.getLogger(__name__)
+
+FILE_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+PARTIAL_SUFFIX = ".part"
+METADATA_SUFFIX = ".json"
+
+
+class FileTooLargeError(Exception):
+    def __init__(self, max_size: int) -> None:
+        super().__init__("File is larger than %s bytes" % max_size)
+        self.max_size = max_size
+
+
+def _write_chunk(file: tp.BinaryIO, digest: "hashlib._Hash", chunk: bytes) -> None:
+    digest.update(chunk)
+    file.write(chunk)
+
+
+class FileSpool:
+    """
+    Uploaded files in the spool directory: "<id>" keeps the content and "<id>.json" the metadata.
+
+    An upload is streamed to "<id>.part" chunk by chunk and renamed when it is complete, so at most one chunk
+    is in memory whatever the file size and a broken upload never becomes visible.
+    Disk writes and hashing run in a thread. Files are kept in creation order to expire them from the head.
+    """
+
+    def __init__(self, directory: Path, max_size: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self._data: dict[str, StoredFile] = {}
+        self._timeline: collections.deque[StoredFile] = collections.deque()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __str__(self) -> str:
+        return "<FileSpool> %s" % len(self._data)
+
+    def __repr__(self) -> str:
+        return "<FileSpool> %s" % len(self._data)
+
+    def get_path(self, stored_file: StoredFile) -> Path:
+        return self.directory / stored_file.idx
+
+    def _get_metadata_path(self, idx: str) -> Path:
+        return self.directory / (idx + METADATA_SUFFIX)
+
+    def get_by_id(self, idx: str) -> StoredFile | None:
+        """
+        Files uploaded to this process are in memory. Cluster workers share the spool directory,
+        so a file uploaded through another worker is looked up by its metadata file.
+        """
+        stored_file = self._data.get(idx)
+        if stored_file is not None or not FILE_ID_PATTERN.fullmatch(idx):
+            return stored_file
+        try:
+            return StoredFile.from_record(json.loads(self._get_metadata_path(idx).read_bytes()))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get_first(self) -> StoredFile | None:
+        return self._timeline[0] if self._timeline else None
+
+    def _add(self, stored_file: StoredFile) -> None:
+        self._data[stored_file.idx] = stored_file
+        self._timeline.append(stored_file)
+
+    def _commit(self, stored_file: StoredFile, partial_path: Path) -> None:
+        partial_path.rename(self.get_path(stored_file))
+        self._get_metadata_path(stored_file.idx).write_text(json.dumps(stored_file.to_record()))
+
+    async def receive(
+        self,
+        chunks: tp.AsyncIterable[bytes],
+        name: str,
+        owner_id: str,
+        receiver_id: str | None = None,
+    ) -> StoredFile:
+        """
+        Store the content which comes in chunks. The size cap is checked as the chunks arrive.
+        Raises FileTooLargeError, OSError and the errors of the chunks source, a partial file is removed then.
+        """
+        stored_file = StoredFile(name=name, owner_id=owner_id, receiver_id=receiver_id)
+        partial_path = self.get_path(stored_file).with_suffix(PARTIAL_SUFFIX)
+        digest = hashlib.sha256()
+        await asyncio.to_thread(self.directory.mkdir, parents=True, exist_ok=True)
+        file = await asyncio.to_thread(partial_path.open, "wb")
+        is_complete = False
+        try:
+            async for chunk in chunks:
+                stored_file.size += len(chunk)
+                if stored_file.size > self.max_size:
+                    raise FileTooLargeError(self.max_size)
+                await asyncio.to_thread(_write_chunk, file, digest, chunk)
+            await asyncio.to_thread(file.close)
+            stored_file.sha256 = digest.hexdigest()
+            await asyncio.to_thread(self._commit, stored_file, partial_path)
+            is_complete = True
+        finally:
+            if not is_complete:
+                file.close()
+                partial_path.unlink(missing_ok=True)
+
+        self._add(stored_file)
+        return stored_file
+
+    def delete(self, stored_file: StoredFile) -> None:
+        self._data.pop(stored_file.idx, None)
+        # Another cluster worker could have removed the shared file already
+        self.get_path(stored_file).unlink(missing_ok=True)
+        self._get_metadata_path(stored_file.idx).unlink(missing_ok=True)
+
+    def pop_created_before(self, date_filter: datetime) -> list[StoredFile]:
+        stored_files = []
+        while self._timeline and self._timeline[0].created_at < date_filter:
+            stored_file = self._timeline.popleft()
+            self.delete(stored_file)
+            stored_files.append(stored_file)
+        return stored_files
+
+    def load(self) -> int:
+        """Restore metadata of the files left in the spool directory and remove broken uploads. Returns files count"""
+        if not self.directory.is_dir():
+            return 0
+
+        stored_files = []
+        for path in self.directory.iterdir():
+            if path.suffix == PARTIAL_SUFFIX:
+                path.unlink(missing_ok=True)
+            elif path.suffix == METADATA_SUFFIX and path.stem not in self._data:
+                stored_file = self.get_by_id(path.stem)
+                if stored_file is not None and self.get_path(stored_file).is_file():
+                    stored_files.append(stored_file)
+
+        for stored_file in sorted(stored_files, key=lambda item: item.created_at):
+            self._add(stored_file)
+        logger.info("Restored %s files from %s" % (len(stored_files), self.directory))
+        return len(stored_files)
+
+    def clear(self) -> None:
+        """Forget the files. They stay on disk and are restored by the next load"""
+        self._data = {}
+        self._timeline = collections.deque()
@@ -0,0 +1,220 @@
+import asyncio
+import typing as tp
+from asyncio import StreamReader, StreamWriter
+from dataclasses import dataclass, field
+from urllib.parse import parse_qsl
+
+__all__ = (
+    "HEAD_DELIMITER",
+    "HttpError",
+    "HttpRequest",
+    "parse_request_head",
+    "read_request",
+    "render_head",
+    "write_response",
+    "write_chunk",
+    "write_last_chunk",
+)
+
+HEAD_DELIMITER = b"\r\n\r\n"
+LINE_DELIMITER = b"\r\n"
+
+REASONS = {
+    200: "OK",
+    204: "No Content",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Content Too Large",
+    431: "Request Header Fields Too Large",
+    501: "Not Implemented",
+    503: "Service Unavailable",
+    505: "HTTP Version Not Supported",
+}
+
+
+class HttpError(Exception):
+    """
+    Request can not be served. Errors raised while the request is read close the connection after the response,
+    because the framing of the next request is unknown.
+    """
+
+    def __init__(self, status: int, message: str = "", headers: tp.Sequence[tuple[str, str]] = ()) -> None:
+        super().__init__(message or REASONS.get(status, ""))
+        self.status = status
+        self.headers = headers
+
+
+@dataclass(slots=True, eq=False)
+class HttpRequest:
+    method: str
+    path: str
+    query: dict[str, str]
+    version: str
+    # Lower-cased header name -> value view into the request head. Values are decoded only when they are asked for
+    headers: dict[bytes, memoryview] = field(repr=False)
+    body: bytes = field(default=b"", repr=False)
+
+    def get_header(self, name: bytes) -> str | None:
+        value = self.headers.get(name)
+        return bytes(value).decode("latin-1") if value is not None else None
+
+    def has_token(self, name: bytes, token: bytes) -> bool:
+        """Check comma separated header (e.g. Connection, Transfer-Encoding) for a token without decoding it"""
+        value = self.headers.get(name)
+        if value is None:
+            return False
+        return any(part.strip().lower() == token for part in bytes(value).split(b","))
+
+    @property
+    def keep_alive(self) -> bool:
+        if self.version == "HTTP/1.0":
+            return self.has_token(b"connection", b"keep-alive")
+        return not self.has_token(b"connection", b"close")
+
+    @property
+    def is_chunked(self) -> bool:
+        return self.has_token(b"transfer-encoding", b"chunked")
+
+
+def _strip(view: memoryview, start: int, end: int) -> tuple[int, int]:
+    while start < end and view[start] in b" \t":
+        start += 1
+    while end > start and view[end - 1] in b" \t":
+        end -= 1
+    return start, end
+
+
+def parse_request_head(head: bytes) -> HttpRequest:
+    """
+    Parse request line and headers of a head which ends with an empty line.
+    Positions are searched in the head bytes and values are kept as memoryview slices, so the head is not split
+    into a list of copies line by line.
+    """
+    view = memoryview(head)
+    line_end = head.find(LINE_DELIMITER)
+    method_end = head.find(b" ", 0, line_end)
+    target_end = head.find(b" ", method_end + 1, line_end)
+    if line_end <= 0 or method_end <= 0 or target_end <= method_end + 1:
+        raise HttpError(400, "Malformed request line")
+
+    version = bytes(view[target_end + 1:line_end]).decode("latin-1")
+    if version not in ("HTTP/1.1", "HTTP/1.0"):
+        raise HttpError(505)
+
+    target = bytes(view[method_end + 1:target_end]).decode("latin-1")
+    path, _, query_string = target.partition("?")
+
+    headers: dict[bytes, memoryview] = {}
+    start = line_end + len(LINE_DELIMITER)
+    head_end = len(head) - len(HEAD_DELIMITER)
+    while start < head_end:
+        end = head.find(LINE_DELIMITER, start)
+        colon = head.find(b":", start, end)
+        if colon <= start:
+            raise HttpError(400, "Malformed header")
+        value_start, value_end = _strip(view, colon + 1, end)
+        headers[head[start:colon].lower()] = view[value_start:value_end]
+        start = end + len(LINE_DELIMITER)
+
+    return HttpRequest(
+        method=bytes(view[:method_end]).decode("latin-1"),
+        path=path,
+        query=dict(parse_qsl(query_string, keep_blank_values=True)),
+        version=version,
+        headers=headers,
+    )
+
+
+async def _read_chunked_body(reader: StreamReader, max_body_size: int) -> bytes:
+    chunks: list[bytes] = []
+    size = 0
+    while True:
+        size_line = await reader.readuntil(LINE_DELIMITER)
+        try:
+            chunk_size = int(size_line.split(b";", 1)[0], 16)
+        except ValueError:
+            raise HttpError(400, "Malformed chunk size")
+        # int() takes a sign, a negative size would make readexactly fail outside of the HTTP errors
+        if chunk_size < 0:
+            raise HttpError(400, "Malformed chunk size")
+
+        if chunk_size == 0:
+            # Trailer fields are not used, skip them up to the empty line
+            while await reader.readuntil(LINE_DELIMITER) != LINE_DELIMITER:
+                pass
+            return b"".join(chunks)
+
+        size += chunk_size
+        if size > max_body_size:
+            raise HttpError(413)
+        chunks.append(await reader.readexactly(chunk_size))
+        if await reader.readexactly(len(LINE_DELIMITER)) != LINE_DELIMITER:
+            raise HttpError(400, "Malformed chunk")
+
+
+async def read_request(reader: StreamReader, max_body_size: int) -> HttpRequest | None:
+    """
+    Read one request from the connection. Pipelined requests stay in the reader buffer until the next call.
+    None means that the peer closed the connection between requests.
+    """
+    try:
+        head = await reader.readuntil(HEAD_DELIMITER)
+    except asyncio.IncompleteReadError as err:
+        if err.partial.strip():
+            raise HttpError(400, "Incomplete request head")
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(431)
+
+    request = parse_request_head(head)
+    if request.is_chunked:
+        request.body = await _read_chunked_body(reader, max_body_size)
+        return request
+
+    if request.headers.get(b"transfer-encoding") is not None:
+        raise HttpError(501, "Only chunked transfer encoding is supported")
+
+    content_length = request.get_header(b"content-length")
+    if content_length is None:
+        return request
+    if not content_length.isdigit():
+        raise HttpError(400, "Invalid Content-Length")
+    if int(content_length) > max_body_size:
+        raise HttpError(413)
+    request.body = await reader.readexactly(int(content_length))
+    return request
+
+
+def render_head(status: int, headers: tp.Iterable[tuple[str, str]], keep_alive: bool) -> bytes:
+    lines = ["HTTP/1.1 %s %s" % (status, REASONS.get(status, ""))]
+    lines.extend("%s: %s" % header for header in headers)
+    lines.append("Connection: %s" % ("keep-alive" if keep_alive else "close"))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def write_response(
+    writer: StreamWriter,
+    status: int,
+    body: bytes = b"",
+    *,
+    keep_alive: bool = True,
+    content_type: str = "text/plain; charset=utf-8",
+    headers: tp.Sequence[tuple[str, str]] = (),
+) -> None:
+    head = render_head(
+        status,
+        [("Content-Type", content_type), ("Content-Length", str(len(body))), *headers],
+        keep_alive,
+    )
+    writer.writelines((head, body))
+
+
+def write_chunk(writer: StreamWriter, data: bytes) -> None:
+    if data:
+        writer.writelines((b"%x\r\n" % len(data), data, LINE_DELIMITER))
+
+
+def write_last_chunk(writer: StreamWriter) -> None:
+    writer.write(b"0\r\n\r\n")
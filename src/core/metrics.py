@@ -0,0 +1,171 @@
+import asyncio
+import bisect
+import collections
+import logging
+import time
+import typing as tp
+
+__all__ = ("Histogram", "Metrics")
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+Gauge = tp.Callable[[], float]
+
+
+class Histogram:
+    """Fixed buckets histogram. Observation is a bisect and two additions"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tp.Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        # The last counter is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket which contains the q-quantile"""
+        rank = q * self.count
+        accumulated = 0
+        for bound, count in zip(self.buckets, self.counts):
+            accumulated += count
+            if accumulated >= rank:
+                return bound
+        return float("inf")
+
+    def render(self, name: str, labels: str = "") -> list[str]:
+        separator = "," if labels else ""
+        lines = []
+        accumulated = 0
+        for bound, count in zip(self.buckets, self.counts):
+            accumulated += count
+            lines.append('%s_bucket{%s%sle="%s"} %s' % (name, labels, separator, bound, accumulated))
+        lines.append('%s_bucket{%s%sle="+Inf"} %s' % (name, labels, separator, self.count))
+        label_set = "{%s}" % labels if labels else ""
+        lines.append("%s_sum%s %s" % (name, label_set, self.sum))
+        lines.append("%s_count%s %s" % (name, label_set, self.count))
+        return lines
+
+
+class Metrics:
+    """
+    Server instrumentation.
+
+    Call sites check ``enabled`` before taking any timestamps, so disabled metrics cost one attribute lookup.
+    Counters and histograms are updated on the hot path, gauges are callbacks which are read only on render.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.requests_total: collections.Counter[str] = collections.Counter()
+        self.request_latency: collections.defaultdict[str, Histogram] = collections.defaultdict(Histogram)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.drain_wait = Histogram()
+        # Overflow policy outcomes and drain timeouts of slow consumers
+        self.slow_consumer_events: collections.Counter[str] = collections.Counter()
+        # Admission rejections, keepalive pings and idle reaping
+        self.connection_events: collections.Counter[str] = collections.Counter()
+        self.loop_lag = 0.0
+        self._gauges: dict[str, tuple[str, Gauge]] = {}
+
+    def register_gauge(self, name: str, description: str, gauge: Gauge) -> None:
+        self._gauges[name] = (description, gauge)
+
+    def observe_request(self, route: str, latency: float) -> None:
+        self.requests_total[route] += 1
+        self.request_latency[route].observe(latency)
+
+    def observe_write(self, size: int, drain_wait: float) -> None:
+        self.bytes_out += size
+        self.drain_wait.observe(drain_wait)
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = ["# TYPE chat_requests_total counter"]
+        for route, count in sorted(self.requests_total.items()):
+            lines.append('chat_requests_total{route="%s"} %s' % (route, count))
+        lines.append("# TYPE chat_request_latency_seconds histogram")
+        for route, histogram in sorted(self.request_latency.items()):
+            lines.extend(histogram.render("chat_request_latency_seconds", 'route="%s"' % route))
+        lines.append("# TYPE chat_received_bytes_total counter")
+        lines.append("chat_received_bytes_total %s" % self.bytes_in)
+        lines.append("# TYPE chat_sent_bytes_total counter")
+        lines.append("chat_sent_bytes_total %s" % self.bytes_out)
+        lines.append("# TYPE chat_drain_wait_seconds histogram")
+        lines.extend(self.drain_wait.render("chat_drain_wait_seconds"))
+        lines.append("# TYPE chat_slow_consumer_events_total counter")
+        for outcome, count in sorted(self.slow_consumer_events.items()):
+            lines.append('chat_slow_consumer_events_total{outcome="%s"} %s' % (outcome, count))
+        lines.append("# TYPE chat_connection_events_total counter")
+        for event, count in sorted(self.connection_events.items()):
+            lines.append('chat_connection_events_total{event="%s"} %s' % (event, count))
+        lines.append("# TYPE chat_event_loop_lag_seconds gauge")
+        lines.append("chat_event_loop_lag_seconds %s" % self.loop_lag)
+        for name, (description, gauge) in self._gauges.items():
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %s" % (name, gauge()))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Short human readable report for the admin command"""
+        lines = []
+        for route, count in sorted(self.requests_total.items()):
+            histogram = self.request_latency[route]
+            lines.append(
+                "%s: %s requests, p50 <= %ss, p99 <= %ss"
+                % (route, count, histogram.quantile(0.5), histogram.quantile(0.99))
+            )
+        lines.append("Bytes in: %s. Bytes out: %s." % (self.bytes_in, self.bytes_out))
+        lines.append("Drain wait p99 <= %ss. Event loop lag: %.4fs." % (self.drain_wait.quantile(0.99), self.loop_lag))
+        for outcome, count in sorted(self.slow_consumer_events.items()):
+            lines.append("Slow consumers %s: %s" % (outcome, count))
+        for event, count in sorted(self.connection_events.items()):
+            lines.append("Connections %s: %s" % (event, count))
+        for name, (_, gauge) in self._gauges.items():
+            lines.append("%s: %s" % (name, gauge()))
+        return "\n".join(lines)
+
+    async def run_loop_lag_monitor(self, interval: float) -> None:
+        """Event loop lag is how late a sleep wakes up"""
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag = max(time.perf_counter() - started_at - interval, 0)
+
+    async def _handle_scrape(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # Any request gets the metrics, the headers are read only to be polite to the client
+            await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+
+        body = self.render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n" % len(body)
+        )
+        writer.write(body)
+        try:
+            await writer.drain()
+        except ConnectionError as err:
+            logger.error("Failed to send metrics: %s" % err)
+        writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        srv = await asyncio.start_server(self._handle_scrape, host=host, port=port)
+        logger.info("Metrics are exposed on http://%s:%s/metrics" % (host, port))
+        async with srv:
+            await srv.serve_forever()
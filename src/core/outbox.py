@@ -0,0 +1,36 @@
+import asyncio
+
+__all__ = ("Outbox",)
+
+
+class Outbox(asyncio.Queue[bytes]):
+    """
+    Queue of encoded writes of one connection. It is full when it holds maxsize writes or max_bytes bytes,
+    so a connection which stopped reading keeps a bounded amount of memory however large the writes are.
+    A single write larger than max_bytes is still accepted into the empty outbox.
+    """
+
+    def __init__(self, maxsize: int, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        super().__init__(maxsize=maxsize)
+
+    def _put(self, item: bytes) -> None:
+        self.nbytes += len(item)
+        super()._put(item)
+
+    def _get(self) -> bytes:
+        item = super()._get()
+        self.nbytes -= len(item)
+        return item
+
+    def full(self) -> bool:
+        return super().full() or self.nbytes >= self.max_bytes
+
+    def clear(self) -> int:
+        """Drop every queued write. Returns the number of dropped writes"""
+        count = 0
+        while not self.empty():
+            self.get_nowait()
+            count += 1
+        return count
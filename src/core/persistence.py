@@ -0,0 +1,351 @@
+import asyncio
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import typing as tp
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from config import MESSAGE_LIFETIME_SECONDS
+from core.schemas import Message, Room, ScheduledMessage, User
+from core.storage import DummyDatabase
+
+__all__ = (
+    "RECORD_HEADER",
+    "ChatLog",
+    "encode_record",
+    "iter_records",
+    "message_to_record",
+    "scheduled_to_record",
+)
+
+logger = logging.getLogger(__name__)
+
+# Record is a length-prefixed JSON payload: <payload length:uint32><record type:uint8><payload>
+RECORD_HEADER = struct.Struct("!IB")
+
+USER_RECORD = 1
+USER_DELETE_RECORD = 2
+MESSAGE_RECORD = 3
+SCHEDULED_RECORD = 4
+SCHEDULED_DELETE_RECORD = 5
+ROOM_RECORD = 6
+ROOM_DELETE_RECORD = 7
+
+
+def encode_record(record_type: int, payload: tp.Mapping) -> bytes:
+    data = json.dumps(payload, separators=(",", ":")).encode()
+    return RECORD_HEADER.pack(len(data), record_type) + data
+
+
+def iter_records(path: Path) -> tp.Iterator[tuple[int, dict]]:
+    """Read records through mmap. A torn record at the end of file (e.g. after a crash) is skipped"""
+    if not path.exists() or path.stat().st_size == 0:
+        return
+
+    with path.open("rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+        offset, size = 0, len(mapped_file)
+        while offset + RECORD_HEADER.size <= size:
+            length, record_type = RECORD_HEADER.unpack_from(mapped_file, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + length
+            if end > size:
+                logger.warning("Skip torn record at %s byte of %s" % (offset, path))
+                return
+            yield record_type, json.loads(mapped_file[start:end])
+            offset = end
+
+
+def message_to_record(message: Message) -> dict:
+    return {
+        "id": message.idx,
+        "seq": message.seq,
+        "sender": message.sender.idx,
+        "receiver": message.receiver.idx if message.receiver is not None else None,
+        "room": message.room.idx if message.room is not None else None,
+        "content": message.content,
+        "created_at": message.created_at.isoformat(),
+    }
+
+
+def scheduled_to_record(scheduled: ScheduledMessage) -> dict:
+    return {
+        "id": scheduled.idx,
+        "sender": scheduled.sender.idx,
+        "receiver": scheduled.receiver.idx if scheduled.receiver is not None else None,
+        "content": scheduled.content,
+        "send_at": scheduled.send_at.isoformat(),
+    }
+
+
+class ChatLog:
+    """
+    Optional persistence of chat history, scheduled messages, rooms and user state.
+
+    Messages are appended to a length-prefixed log by a background task in batches, not one write per message.
+    User and room state is diffed against the last written state on every flush, so only changed ones are logged.
+    Periodically the whole state is written to a compacted snapshot and the log is truncated.
+    On start the snapshot and then the log are replayed into DummyDatabase.
+    """
+
+    def __init__(self, directory: Path, flush_interval: float, snapshot_interval: float) -> None:
+        self._directory = directory
+        self._log_path = directory / "chat.log"
+        self._snapshot_path = directory / "chat.snapshot"
+        self._flush_interval = flush_interval
+        self._snapshot_interval = snapshot_interval
+        self._dummy_db = DummyDatabase()
+
+        self.is_running = False
+        self._pending: list[bytes] = []
+        self._user_states: dict[str, dict] = {}
+        self._room_states: dict[str, dict] = {}
+        self._last_snapshot_at = time.monotonic()
+
+    def append_message(self, message: Message) -> None:
+        self._pending.append(encode_record(MESSAGE_RECORD, message_to_record(message)))
+
+    def append_scheduled(self, scheduled: ScheduledMessage) -> None:
+        self._pending.append(encode_record(SCHEDULED_RECORD, scheduled_to_record(scheduled)))
+
+    def append_scheduled_removal(self, scheduled: ScheduledMessage) -> None:
+        """Scheduled message is cancelled or delivered"""
+        self._pending.append(encode_record(SCHEDULED_DELETE_RECORD, {"id": scheduled.idx}))
+
+    def _collect_user_records(self) -> list[bytes]:
+        records = []
+        stored_user_ids = set()
+        for user in self._dummy_db.users.get_all():
+            stored_user_ids.add(user.idx)
+            state = user.to_state()
+            if self._user_states.get(user.idx) != state:
+                self._user_states[user.idx] = state
+                records.append(encode_record(USER_RECORD, state))
+
+        for user_id in list(self._user_states.keys() - stored_user_ids):
+            del self._user_states[user_id]
+            records.append(encode_record(USER_DELETE_RECORD, {"id": user_id}))
+        return records
+
+    def _collect_room_records(self) -> list[bytes]:
+        records = []
+        stored_room_ids = set()
+        for room in self._dummy_db.rooms.get_all():
+            stored_room_ids.add(room.idx)
+            state = room.to_state()
+            if self._room_states.get(room.idx) != state:
+                self._room_states[room.idx] = state
+                records.append(encode_record(ROOM_RECORD, state))
+
+        for room_id in list(self._room_states.keys() - stored_room_ids):
+            del self._room_states[room_id]
+            records.append(encode_record(ROOM_DELETE_RECORD, {"id": room_id}))
+        return records
+
+    def _collect(self) -> bytes:
+        # Users and rooms go first: messages of a new user or room must be replayed after them
+        records = self._collect_user_records()
+        records.extend(self._collect_room_records())
+        records.extend(self._pending)
+        self._pending = []
+        return b"".join(records)
+
+    def _build_snapshot(self) -> bytes:
+        self._user_states = {}
+        self._room_states = {}
+        records = self._collect_user_records()
+        records.extend(self._collect_room_records())
+        messages = heapq.merge(
+            self._dummy_db.messages.get_all(limit=None),
+            self._dummy_db.inboxes.get_all(),
+            self._dummy_db.rooms.get_all_messages(),
+            key=lambda message: message.seq,
+        )
+        records.extend(encode_record(MESSAGE_RECORD, message_to_record(message)) for message in messages)
+        records.extend(
+            encode_record(SCHEDULED_RECORD, scheduled_to_record(scheduled))
+            for scheduled in self._dummy_db.scheduled.get_all()
+        )
+        return b"".join(records)
+
+    def _append_to_log(self, data: bytes) -> None:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        with self._log_path.open("ab") as file:
+            file.write(data)
+
+    def _write_snapshot(self, data: bytes) -> None:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._snapshot_path.with_suffix(".tmp")
+        with tmp_path.open("wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+        # Everything in the log is in the snapshot now
+        self._log_path.open("wb").close()
+
+    async def flush(self) -> None:
+        data = self._collect()
+        if not data:
+            return
+
+        try:
+            await asyncio.to_thread(self._append_to_log, data)
+        except OSError:
+            # Keep the batch to retry it with the next flush
+            self._pending.insert(0, data)
+            raise
+
+    async def snapshot(self) -> None:
+        await self.flush()
+        data = self._build_snapshot()
+        await asyncio.to_thread(self._write_snapshot, data)
+        self._last_snapshot_at = time.monotonic()
+        logger.info("Snapshot is written (%s bytes)" % len(data))
+
+    def close(self) -> None:
+        """Synchronous flush for server shutdown"""
+        data = self._collect()
+        if data:
+            self._append_to_log(data)
+
+    def _get_or_create_user(self, user_id: str) -> User:
+        user = self._dummy_db.users.get_by_id(user_id)
+        # Sender of an old message could be removed already
+        return user if user is not None else User(idx=user_id)
+
+    def _restore_user(self, record: dict) -> None:
+        user = self._dummy_db.users.get_by_id(record["id"])
+        if user is None:
+            self._dummy_db.users.add(User.from_state(record))
+        else:
+            user.load_state(record)
+
+    def _restore_room(self, record: dict) -> None:
+        room = self._dummy_db.rooms.get_by_id(record["id"])
+        if room is None:
+            self._dummy_db.rooms.add(Room.from_state(record))
+            return
+
+        # The room keeps its messages, only the membership is replaced
+        members = set(record["members"])
+        for user_id in members - room.members:
+            self._dummy_db.rooms.add_member(room, user_id)
+        for user_id in room.members - members:
+            self._dummy_db.rooms.remove_member(room, user_id)
+        room.owner_id = record["owner"]
+        room.join_requests = set(record["join_requests"])
+
+    def _restore_message(self, record: dict, created_after: datetime) -> None:
+        created_at = datetime.fromisoformat(record["created_at"])
+        if created_at <= created_after:
+            return
+
+        room = None
+        if record.get("room") is not None:
+            room = self._dummy_db.rooms.get_by_id(record["room"])
+            if room is None:
+                return
+
+        receiver_id = record["receiver"]
+        message = Message(
+            sender=self._get_or_create_user(record["sender"]),
+            content=record["content"],
+            receiver=self._get_or_create_user(receiver_id) if receiver_id is not None else None,
+            room=room,
+        )
+        message.idx = record["id"]
+        message.seq = record["seq"]
+        message.restore_created_at(created_at)
+        if message.receiver is not None:
+            self._dummy_db.inboxes.restore(message)
+        elif message.room is not None:
+            self._dummy_db.rooms.restore_message(message)
+        else:
+            self._dummy_db.messages.restore(message)
+
+    def _delete_user(self, record: dict) -> None:
+        self._dummy_db.users.delete(record["id"])
+        self._dummy_db.inboxes.delete_inbox(record["id"])
+
+    def _delete_room(self, record: dict) -> None:
+        room = self._dummy_db.rooms.get_by_id(record["id"])
+        if room is not None:
+            self._dummy_db.rooms.delete(room)
+
+    def _restore_scheduled(self, record: dict) -> None:
+        if record["id"] in self._dummy_db.scheduled:
+            return
+
+        receiver_id = record["receiver"]
+        scheduled = ScheduledMessage(
+            sender=self._get_or_create_user(record["sender"]),
+            content=record["content"],
+            send_at=datetime.fromisoformat(record["send_at"]),
+            receiver=self._get_or_create_user(receiver_id) if receiver_id is not None else None,
+            idx=record["id"],
+        )
+        self._dummy_db.scheduled.add(scheduled)
+
+    def _cancel_scheduled(self, record: dict) -> None:
+        self._dummy_db.scheduled.cancel(record["id"])
+
+    def load(self, with_scheduled: bool = True) -> list[User]:
+        """
+        Replay snapshot and log into DummyDatabase. Returns restored users.
+        Scheduled messages are skipped without with_scheduled, then they are delivered by another process.
+        """
+        started_at = time.monotonic()
+        created_after = datetime.now() - timedelta(seconds=MESSAGE_LIFETIME_SECONDS)
+        records_count = 0
+        # Record type -> restore function
+        restorers: dict[int, tp.Callable[[dict], None]] = {
+            USER_RECORD: self._restore_user,
+            USER_DELETE_RECORD: self._delete_user,
+            ROOM_RECORD: self._restore_room,
+            ROOM_DELETE_RECORD: self._delete_room,
+            MESSAGE_RECORD: lambda record: self._restore_message(record, created_after),
+        }
+        if with_scheduled:
+            restorers[SCHEDULED_RECORD] = self._restore_scheduled
+            restorers[SCHEDULED_DELETE_RECORD] = self._cancel_scheduled
+
+        for path in (self._snapshot_path, self._log_path):
+            for record_type, record in iter_records(path):
+                records_count += 1
+                restore = restorers.get(record_type)
+                if restore is not None:
+                    restore(record)
+
+        users = self._dummy_db.users.get_all()
+        self._user_states = {user.idx: user.to_state() for user in users}
+        self._room_states = {room.idx: room.to_state() for room in self._dummy_db.rooms.get_all()}
+        logger.info(
+            "Restored %s users, %s rooms, %s messages and %s scheduled messages from %s records in %.2fs"
+            % (
+                len(users),
+                len(self._dummy_db.rooms),
+                len(self._dummy_db.messages),
+                len(self._dummy_db.scheduled),
+                records_count,
+                time.monotonic() - started_at,
+            )
+        )
+        return users
+
+    async def run(self) -> None:
+        self.is_running = True
+        logger.info("Chat log is running in %s" % self._directory)
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                if time.monotonic() - self._last_snapshot_at >= self._snapshot_interval:
+                    await self.snapshot()
+                else:
+                    await self.flush()
+            except OSError as err:
+                logger.error("Chat log write failed: %s" % err)
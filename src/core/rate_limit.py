@@ -0,0 +1,53 @@
+import time
+import typing as tp
+from dataclasses import dataclass
+
+from core.schemas import TokenBucket, User
+
+__all__ = ("RateLimit", "RateLimiter")
+
+
+@dataclass(frozen=True, slots=True)
+class RateLimit:
+    capacity: int
+    period_seconds: float
+
+    @property
+    def refill_rate(self) -> float:
+        """Tokens per second"""
+        return self.capacity / self.period_seconds
+
+
+class RateLimiter:
+    """
+    Token bucket limits of user commands.
+
+    A bucket is refilled from timestamps at check time, so there are no timers at all
+    and a user can send at most ``capacity`` requests in a burst, then one request per ``1 / refill_rate`` seconds.
+    Commands without a configured limit are never limited.
+    """
+
+    def __init__(self, limits: tp.Mapping[str, tp.Mapping[str, float]]) -> None:
+        self._limits = {
+            command: RateLimit(capacity=int(limit["capacity"]), period_seconds=limit["period_seconds"])
+            for command, limit in limits.items()
+        }
+
+    def consume(self, user: User, command: str, now: float | None = None) -> float:
+        """Take a token from the user bucket of command. Returns 0 if it is allowed, otherwise seconds to wait"""
+        limit = self._limits.get(command)
+        if limit is None:
+            return 0
+
+        now = time.time() if now is None else now
+        bucket = user.rate_limits.get(command)
+        if bucket is None:
+            bucket = user.rate_limits[command] = TokenBucket(tokens=limit.capacity, updated_at=now)
+
+        elapsed = max(now - bucket.updated_at, 0)
+        bucket.tokens = min(bucket.tokens + elapsed * limit.refill_rate, limit.capacity)
+        bucket.updated_at = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0
+        return (1 - bucket.tokens) / limit.refill_rate
@@ -1,36 +1,92 @@
+import asyncio
+import secrets
+import time
 import typing as tp
 import uuid
 from asyncio import StreamWriter, StreamReader
 from dataclasses import dataclass, field
 from datetime import datetime
 
-from config import DATE_FORMAT, USER_MESSAGE_LIMIT
-
-__all__ = ("User", "Message", "Command", "Route")
+from config import DATE_FORMAT, OUTBOUND_QUEUE_SIZE, CORRELATION_PREFIX, SLOW_CONSUMER_OUTBOX_MAX_BYTES
+from core import binary
+from core.compression import StreamCompressor
+from core.outbox import Outbox
+from core.utils import prepare_message
+
+__all__ = (
+    "User",
+    "Connection",
+    "Message",
+    "Command",
+    "Route",
+    "Page",
+    "TokenBucket",
+    "StoredFile",
+    "ScheduledMessage",
+    "Room",
+)
 
 
 def _set_idx() -> str:
     return str(uuid.uuid4())
 
 
+def _set_user_idx() -> str:
+    return uuid.uuid4().hex
+
+
+def _set_token() -> str:
+    return secrets.token_urlsafe(24)
+
+
 def _now_datetime() -> datetime:
     return datetime.now()
 
 
+def _datetime_to_string(value: datetime | None) -> str | None:
+    return value.isoformat() if value is not None else None
+
+
+def _datetime_from_string(value: str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
 @dataclass(frozen=True, slots=True, order=False, eq=False)
 class Route:
     name: str
     handler: tp.Callable
 
 
+@dataclass(frozen=True, slots=True)
+class Page:
+    limit: int
+    before: int | None = None
+    after: int | None = None
+
+
 @dataclass(slots=True)
 class Command:
     request: bytes | str = field(repr=False)
     name: str = field(init=False)
     arguments: tp.Sequence[tp.Any] = field(init=False, repr=False)
+    # Request "#<id> /command ..." asks to prefix every reply line with "#<id> " and to end the reply with "#<id>"
+    correlation_id: str | None = field(init=False, default=None)
 
     def __post_init__(self):
         self.name, self.arguments = self.parse_request(raw_request=self.request)
+        if self.name.startswith(CORRELATION_PREFIX) and len(self.name) > 1 and self.arguments:
+            self.correlation_id = self.name[1:]
+            self.name, *self.arguments = self.arguments
+
+    @classmethod
+    def from_arguments(cls, name: str, arguments: tp.Sequence[tp.Any]) -> "Command":
+        """Command of the binary protocol. Its fields come typed from the frame, so there is nothing to parse"""
+        command = cls.__new__(cls)
+        command.request = name
+        command.name = name
+        command.arguments = arguments
+        command.correlation_id = None
+        return command
 
     def arguments_to_string(self) -> str:
         return " ".join(self.arguments)
@@ -51,25 +107,75 @@ class Command:
         return command_name, command_args
 
 
-@dataclass(slots=True)
-class User:
-    idx: str
+@dataclass(slots=True, eq=False)
+class Connection:
     host: str
     port: int
-    reader: StreamReader
-    writer: StreamWriter
+    # HTTP session connections are not bound to a stream
+    reader: StreamReader | None = field(repr=False)
+    writer: StreamWriter | None = field(repr=False)
+    user: "User" = field(repr=False)
 
+    # Connection sent /connect command and receives chat messages
     is_connected: bool = field(init=False, default=False)
+    # Connection started with the binary protocol handshake
+    is_binary: bool = field(init=False, default=False)
+    # Output of the connection is compressed, the client asked for it in the handshake
+    compressor: StreamCompressor | None = field(init=False, repr=False, default=None)
+
+    outbox: Outbox = field(init=False, repr=False)
+    outbox_writer: asyncio.Task | None = field(init=False, repr=False, default=None)
+    # Pushes skipped by the "coalesce" overflow policy since the last missed messages notice
+    missed_count: int = field(init=False, repr=False, default=0)
+    # Monotonic time of the last request, the idle reaper pings and closes quiet connections by it
+    last_active_at: float = field(init=False, repr=False, default_factory=time.monotonic)
+    # Bytes of the current request body (an upload) which follow the request on the stream and are not read yet
+    request_body_size: int = field(init=False, repr=False, default=0)
+
+    def __post_init__(self):
+        self.outbox = Outbox(maxsize=OUTBOUND_QUEUE_SIZE, max_bytes=SLOW_CONSUMER_OUTBOX_MAX_BYTES)
+
+    def _object_as_string(self) -> str:
+        return "Connection[%s:%s]" % (self.host, self.port)
+
+    def __str__(self) -> str:
+        return self._object_as_string()
+
+    def __repr__(self) -> str:
+        return self._object_as_string()
+
+    async def disconnect(self) -> None:
+        self.is_connected = False
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.close()
+
+
+@dataclass(slots=True)
+class TokenBucket:
+    """Rate limit state of one user command. Tokens are refilled lazily by RateLimiter when the command is checked"""
+
+    tokens: float
+    updated_at: float
+
+
+@dataclass(slots=True)
+class User:
+    idx: str = field(default_factory=_set_user_idx)
+    token: str = field(default_factory=_set_token, repr=False)
+    connections: list[Connection] = field(init=False, repr=False, default_factory=list)
+    session_expires_at: datetime | None = field(init=False, default=None)
 
     reports_count: int = 0
     is_banned: bool = field(init=False, default=False)
     banned_to: datetime | None = field(init=False, default=None)
 
-    message_limit: int = USER_MESSAGE_LIMIT
-    is_chating_blocked: bool = field(init=False, default=False)
-    chating_blocked_to: datetime | None = field(init=False, default=None)
+    # Token buckets by command name
+    rate_limits: dict[str, TokenBucket] = field(init=False, repr=False, default_factory=dict)
 
-    last_status_request_at: datetime | None = field(init=False, default=None)
+    # Sequence id of the last message delivered to user. It is shared by all user connections
+    last_seq: int = field(init=False, default=0)
+    # Connections of user on the other cluster workers
+    remote_connections_count: int = field(init=False, repr=False, default=0)
 
     def _object_as_string(self) -> str:
         return "User[%s]" % self.idx
@@ -80,33 +186,172 @@ class User:
     def __repr__(self) -> str:
         return self._object_as_string()
 
+    @property
+    def is_connected(self) -> bool:
+        return any(connection.is_connected for connection in self.connections)
+
+    def get_connected(self) -> list[Connection]:
+        return [connection for connection in self.connections if connection.is_connected]
+
     async def disconnect(self) -> None:
-        if not self.writer.is_closing():
-            self.writer.close()
+        for connection in self.connections:
+            await connection.disconnect()
 
     def to_dict(self) -> tp.Mapping:
         data = {
             "id": self.idx,
-            "host": self.host,
-            "port": self.port,
         }
         return data
 
+    def to_state(self) -> dict:
+        """Session state which survives server restart"""
+        return {
+            "id": self.idx,
+            "token": self.token,
+            "reports_count": self.reports_count,
+            "banned_to": _datetime_to_string(self.banned_to),
+            "rate_limits": {
+                command: [bucket.tokens, bucket.updated_at] for command, bucket in self.rate_limits.items()
+            },
+            "last_seq": self.last_seq,
+        }
+
+    def load_state(self, state: tp.Mapping) -> None:
+        self.reports_count = state["reports_count"]
+        self.banned_to = _datetime_from_string(state["banned_to"])
+        self.is_banned = self.banned_to is not None
+        self.rate_limits = {
+            command: TokenBucket(tokens=tokens, updated_at=updated_at)
+            for command, (tokens, updated_at) in state.get("rate_limits", {}).items()
+        }
+        self.last_seq = state["last_seq"]
+
+    @classmethod
+    def from_state(cls, state: tp.Mapping) -> "User":
+        user = cls(idx=state["id"], token=state["token"])
+        user.load_state(state)
+        return user
+
+
+@dataclass(slots=True, eq=False)
+class Room:
+    """
+    Group chat. Users get into it by an invite of the owner or by the invite code and the owner approval.
+    Members and join requests are sets of user ids, so membership checks do not depend on the room size.
+    """
+
+    name: str
+    owner_id: str
+    idx: str = field(default_factory=_set_user_idx)
+    invite_code: str = field(default_factory=_set_token)
+    members: set[str] = field(default_factory=set)
+    # Users who came with the invite code and wait for the owner approval
+    join_requests: set[str] = field(default_factory=set)
+
+    def __post_init__(self):
+        self.members.add(self.owner_id)
+
+    def _object_as_string(self) -> str:
+        return "Room[%s]" % self.idx
+
+    def __str__(self) -> str:
+        return self._object_as_string()
+
+    def __repr__(self) -> str:
+        return self._object_as_string()
+
+    def has_member(self, user_id: str) -> bool:
+        return user_id in self.members
+
+    def to_state(self) -> dict:
+        return {
+            "id": self.idx,
+            "name": self.name,
+            "owner": self.owner_id,
+            "invite_code": self.invite_code,
+            "members": sorted(self.members),
+            "join_requests": sorted(self.join_requests),
+        }
+
+    @classmethod
+    def from_state(cls, state: tp.Mapping) -> "Room":
+        return cls(
+            name=state["name"],
+            owner_id=state["owner"],
+            idx=state["id"],
+            invite_code=state["invite_code"],
+            members=set(state["members"]),
+            join_requests=set(state["join_requests"]),
+        )
+
 
 @dataclass(slots=True)
 class Message:
     idx: str = field(init=False, default_factory=_set_idx)
+    seq: int = field(init=False, default=0)
     sender: User
     content: str
+    receiver: User | None = None
+    room: Room | None = None
     created_at: datetime = field(init=False, default_factory=_now_datetime)
     created_at_as_string: str = field(init=False)
+    _wire: bytes | None = field(init=False, repr=False, default=None)
+    _binary_payload: bytes | None = field(init=False, repr=False, default=None)
+    _binary_wire: bytes | None = field(init=False, repr=False, default=None)
 
     def __post_init__(self):
         self.created_at_as_string = self.created_at.strftime(DATE_FORMAT)
 
+    def restore_created_at(self, created_at: datetime) -> None:
+        self.created_at = created_at
+        self.created_at_as_string = created_at.strftime(DATE_FORMAT)
+        self._wire = None
+        self._binary_payload = None
+        self._binary_wire = None
+
+    @property
+    def is_private(self) -> bool:
+        return self.receiver is not None
+
     def _object_as_string(self) -> str:
+        if self.is_private:
+            return "[%s] <%s> (private) %s" % (self.created_at_as_string, self.sender, self.content)
+        if self.room is not None:
+            room_tag = "%s %s" % (self.room, self.room.name)
+            return "[%s] <%s> (%s) %s" % (self.created_at_as_string, self.sender, room_tag, self.content)
         return "[%s] <%s> %s" % (self.created_at_as_string, self.sender, self.content)
 
+    @property
+    def wire(self) -> bytes:
+        """Message rendered and encoded for delivery. It is rendered on first use and reused for every receiver"""
+        if self._wire is None:
+            self._wire = prepare_message(self._object_as_string()).encode()
+        return self._wire
+
+    def binary_frame(self, flags: int = 0) -> bytes:
+        """Message frame of the binary protocol. The payload is encoded once, only the header is packed per call"""
+        if self._binary_payload is None:
+            self._binary_payload = binary.message_payload(self.created_at.timestamp(), self.content)
+        if self.is_private:
+            flags |= binary.FLAG_PRIVATE
+        elif self.room is not None:
+            flags |= binary.FLAG_ROOM
+        header = binary.FRAME_HEADER.pack(
+            len(self._binary_payload),
+            binary.MESSAGE,
+            flags,
+            self.seq,
+            binary.encode_user_id(self.sender.idx),
+        )
+        return header + self._binary_payload
+
+    @property
+    def binary_wire(self) -> bytes:
+        """Binary frame of the pushed message. It must be requested after the message got its sequence id"""
+        if self._binary_wire is None:
+            self._binary_wire = self.binary_frame()
+        return self._binary_wire
+
     def __str__(self) -> str:
         return self._object_as_string()
 
@@ -116,7 +361,81 @@ class Message:
     def to_dict(self) -> dict:
         return {
             "id": self.idx,
+            "seq": self.seq,
             "sender": self.sender.to_dict(),
+            "receiver": self.receiver.to_dict() if self.receiver is not None else None,
+            "room": self.room.idx if self.room is not None else None,
             "content": self.content,
             "created_at": self.created_at_as_string,
         }
+
+
+@dataclass(slots=True, eq=False)
+class ScheduledMessage:
+    """Message which becomes a regular message at send_at"""
+
+    sender: User
+    content: str
+    send_at: datetime
+    receiver: User | None = None
+    idx: str = field(default_factory=_set_user_idx)
+    # Cancelled message stays in the scheduler heap until it reaches the top
+    is_cancelled: bool = field(init=False, default=False)
+
+    def _object_as_string(self) -> str:
+        return "ScheduledMessage[%s]" % self.idx
+
+    def __str__(self) -> str:
+        return self._object_as_string()
+
+    def __repr__(self) -> str:
+        return self._object_as_string()
+
+
+@dataclass(slots=True)
+class StoredFile:
+    """Uploaded file. The content lives in the spool directory, only the metadata is kept in memory"""
+
+    name: str
+    owner_id: str
+    # Private file can be downloaded only by the owner and the receiver
+    receiver_id: str | None = None
+    idx: str = field(default_factory=_set_user_idx)
+    size: int = 0
+    sha256: str = ""
+    created_at: datetime = field(default_factory=_now_datetime)
+
+    def _object_as_string(self) -> str:
+        return "File[%s]" % self.idx
+
+    def __str__(self) -> str:
+        return self._object_as_string()
+
+    def __repr__(self) -> str:
+        return self._object_as_string()
+
+    def is_available_to(self, user: "User") -> bool:
+        return self.receiver_id is None or user.idx in (self.owner_id, self.receiver_id)
+
+    def to_record(self) -> dict:
+        return {
+            "id": self.idx,
+            "name": self.name,
+            "owner": self.owner_id,
+            "receiver": self.receiver_id,
+            "size": self.size,
+            "sha256": self.sha256,
+            "created_at": _datetime_to_string(self.created_at),
+        }
+
+    @classmethod
+    def from_record(cls, record: tp.Mapping) -> "StoredFile":
+        return cls(
+            idx=record["id"],
+            name=record["name"],
+            owner_id=record["owner"],
+            receiver_id=record["receiver"],
+            size=record["size"],
+            sha256=record["sha256"],
+            created_at=datetime.fromisoformat(record["created_at"]),
+        )
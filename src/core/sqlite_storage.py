@@ -0,0 +1,424 @@
+import array
+import bisect
+import collections
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import typing as tp
+from datetime import datetime
+from pathlib import Path
+
+from config import SHOW_LAST_MESSAGES_COUNT, SESSION_LIFETIME_SECONDS
+from core.schemas import User, Message
+from core.utils import DummyStorageProtocol, message_sequence
+
+__all__ = ("SqliteWriter", "SqliteUsersStorage", "SqliteMessagesStorage")
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    token TEXT NOT NULL UNIQUE,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    sender_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_created_at_idx ON messages (created_at);
+"""
+
+# SQLite limits the number of parameters in one query
+_MAX_QUERY_PARAMETERS = 500
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class SqliteWriter(threading.Thread):
+    """
+    Dedicated thread which owns the write connection.
+    Statements are queued from the event loop and everything queued so far is committed as one transaction.
+    """
+
+    def __init__(self, path: Path) -> None:
+        super().__init__(name="sqlite-writer", daemon=True)
+        self._path = path
+        self._queue: queue.SimpleQueue[tuple[str, tp.Sequence, int] | None] = queue.SimpleQueue()
+        # The highest message sequence id which is committed. Read from the event loop thread
+        self.committed_seq = 0
+
+    def execute(self, sql: str, parameters: tp.Sequence = (), seq: int = 0) -> None:
+        self._queue.put((sql, parameters, seq))
+
+    def _get_batch(self) -> list[tuple[str, tp.Sequence, int] | None]:
+        batch = [self._queue.get()]
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def run(self) -> None:
+        connection = connect(self._path)
+        is_running = True
+        while is_running:
+            batch = self._get_batch()
+            max_seq = 0
+            try:
+                with connection:
+                    for operation in batch:
+                        if operation is None:
+                            is_running = False
+                            continue
+                        sql, parameters, seq = operation
+                        connection.execute(sql, parameters)
+                        max_seq = max(max_seq, seq)
+            except sqlite3.Error as err:
+                logger.error("Failed to write %s statements: %s" % (len(batch), err))
+            else:
+                # Messages of a rolled back batch are not in SQLite, their bodies must stay in the cache
+                self.committed_seq = max(self.committed_seq, max_seq)
+        connection.close()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self.join()
+
+
+class SqliteUsersStorage(DummyStorageProtocol):
+    """
+    Users of live sessions are kept in memory together with their connections.
+    Session state is written to SQLite, so a session can be restored by token after server restart.
+    """
+
+    def __init__(self, reader: sqlite3.Connection, writer: SqliteWriter) -> None:
+        self._reader = reader
+        self._writer = writer
+        self._data: dict[str, User] = {}
+        self._tokens: dict[str, str] = {}
+        self._writer.execute(
+            "DELETE FROM users WHERE updated_at < ?",
+            (time.time() - SESSION_LIFETIME_SECONDS,),
+        )
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _object_as_string(self) -> str:
+        return "<SqliteUsersStorage> %s" % len(self._data)
+
+    def __str__(self) -> str:
+        return self._object_as_string()
+
+    def __repr__(self) -> str:
+        return self._object_as_string()
+
+    def _load(self, column: str, value: str) -> User | None:
+        row = self._reader.execute("SELECT state FROM users WHERE %s = ?" % column, (value,)).fetchone()
+        if row is None:
+            return None
+        return User.from_state(json.loads(row[0]))
+
+    def get_by_id(self, idx: str) -> User | None:
+        """
+        Offline user is read from SQLite but not kept in memory: it has no session expiry there,
+        so every looked up id (reports, private messages, room members) would stay forever
+        """
+        user = self._data.get(idx)
+        if user is None:
+            user = self._load("id", idx)
+        return user
+
+    def get_loaded(self, idx: str) -> User | None:
+        """User of a live session. Unlike get_by_id it never reads SQLite"""
+        return self._data.get(idx)
+
+    def get_by_token(self, token: str) -> User | None:
+        """The session is attached by token, so the user is kept in memory until the session expires"""
+        user_id = self._tokens.get(token)
+        if user_id is not None:
+            return self._data.get(user_id)
+
+        user = self._load("token", token)
+        if user is not None:
+            self._data[user.idx] = user
+            self._tokens[user.token] = user.idx
+        return user
+
+    def get_all(self) -> list[User]:
+        return list(self._data.values())
+
+    def get_connected(self) -> list[User]:
+        return [user for user in self._data.values() if user.is_connected]
+
+    def save(self, user: User) -> None:
+        self._writer.execute(
+            "INSERT INTO users (id, token, state, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+            (user.idx, user.token, json.dumps(user.to_state()), time.time()),
+        )
+
+    def add(self, user: User) -> None:
+        self._data[user.idx] = user
+        self._tokens[user.token] = user.idx
+        self.save(user)
+
+    def bulk_add(self, users: list[User]) -> None:
+        for user in users:
+            self.add(user)
+
+    def delete(self, idx: str) -> None:
+        if idx in self._data:
+            user = self._data.pop(idx)
+            self._tokens.pop(user.token, None)
+        self._writer.execute("DELETE FROM users WHERE id = ?", (idx,))
+
+    def clear(self) -> None:
+        for user in self._data.values():
+            for connection in user.connections:
+                if connection.writer is not None:
+                    connection.writer.close()
+            self.save(user)
+        self._data = {}
+        self._tokens = {}
+
+
+class SqliteMessagesStorage(DummyStorageProtocol):
+    """
+    General chat messages stored in SQLite.
+
+    Only a skeleton of the history is kept in memory: sequence ids and creation timestamps in compact arrays.
+    Counting, range and expiry lookups are bisects over it, exactly like MessagesIndex does.
+    Message bodies live in SQLite and the newest ``cache_size`` of them are cached.
+    A message is evicted from the cache only after the writer thread committed it,
+    so bodies which are not in the cache can always be read from SQLite.
+    """
+
+    def __init__(
+        self,
+        reader: sqlite3.Connection,
+        writer: SqliteWriter,
+        users: SqliteUsersStorage,
+        cache_size: int,
+    ) -> None:
+        self._reader = reader
+        self._writer = writer
+        self._users = users
+        self._cache_size = cache_size
+        self._cache: dict[int, Message] = {}
+        self._cache_ids: dict[str, int] = {}
+        self._cache_order: collections.deque[int] = collections.deque()
+
+        self._seqs: array.array = array.array("q")
+        self._timestamps: array.array = array.array("d")
+        self._head = 0
+        self._deleted: set[int] = set()
+        self._load_skeleton()
+
+    def _load_skeleton(self) -> None:
+        for seq, created_at in self._reader.execute("SELECT seq, created_at FROM messages ORDER BY seq"):
+            self._seqs.append(seq)
+            self._timestamps.append(created_at)
+        if self._seqs:
+            message_sequence.advance_to(self._seqs[-1])
+            self._writer.committed_seq = self._seqs[-1]
+        logger.info("Loaded %s messages from SQLite" % len(self._seqs))
+
+    def __len__(self) -> int:
+        return len(self._seqs) - self._head - len(self._deleted)
+
+    def __str__(self) -> str:
+        return "<SqliteMessagesStorage> %s" % len(self)
+
+    def __repr__(self) -> str:
+        return "<SqliteMessagesStorage> %s" % len(self)
+
+    def _is_alive(self, position: int) -> bool:
+        return self._seqs[position] not in self._deleted
+
+    def _is_stored(self, seq: int) -> bool:
+        position = bisect.bisect_left(self._seqs, seq, lo=self._head)
+        return position < len(self._seqs) and self._seqs[position] == seq and seq not in self._deleted
+
+    def _cache_message(self, message: Message) -> None:
+        self._cache[message.seq] = message
+        self._cache_ids[message.idx] = message.seq
+        self._cache_order.append(message.seq)
+        while len(self._cache_order) > self._cache_size and self._cache_order[0] <= self._writer.committed_seq:
+            self._uncache(self._cache_order.popleft())
+
+    def _uncache(self, seq: int) -> None:
+        message = self._cache.pop(seq, None)
+        if message is not None:
+            self._cache_ids.pop(message.idx, None)
+
+    def _message_from_row(self, row: tuple) -> Message:
+        seq, idx, sender_id, content, created_at = row
+        # Senders of old messages are mostly offline, loading them would fill the live users storage
+        sender = self._users.get_loaded(sender_id) or User(idx=sender_id)
+        message = Message(sender=sender, content=content)
+        message.idx = idx
+        message.seq = seq
+        message.restore_created_at(datetime.fromtimestamp(created_at))
+        return message
+
+    def _load(self, seqs: list[int]) -> list[Message]:
+        """Messages by sequence ids in the same order. Bodies missing in the cache are read with one query per chunk"""
+        missing_seqs = [seq for seq in seqs if seq not in self._cache]
+        loaded_messages: dict[int, Message] = {}
+        for start in range(0, len(missing_seqs), _MAX_QUERY_PARAMETERS):
+            chunk = missing_seqs[start: start + _MAX_QUERY_PARAMETERS]
+            rows = self._reader.execute(
+                "SELECT seq, id, sender_id, content, created_at FROM messages WHERE seq IN (%s)"
+                % ",".join("?" * len(chunk)),
+                chunk,
+            )
+            for row in rows:
+                loaded_messages[row[0]] = self._message_from_row(row)
+
+        messages = []
+        for seq in seqs:
+            message = self._cache.get(seq) or loaded_messages.get(seq)
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    def _collect(self, lo: int, hi: int, limit: int | None, newest: bool) -> list[Message]:
+        positions = range(hi - 1, lo - 1, -1) if newest else range(lo, hi)
+        seqs: list[int] = []
+        for position in positions:
+            if limit is not None and len(seqs) >= limit:
+                break
+            if self._is_alive(position):
+                seqs.append(self._seqs[position])
+        if newest:
+            seqs.reverse()
+        return self._load(seqs)
+
+    def _compact(self) -> None:
+        while self._head < len(self._seqs) and not self._is_alive(self._head):
+            self._deleted.discard(self._seqs[self._head])
+            self._head += 1
+        if self._head >= 1024 and self._head * 2 >= len(self._seqs):
+            del self._seqs[: self._head]
+            del self._timestamps[: self._head]
+            self._head = 0
+
+    @property
+    def last_seq(self) -> int:
+        for position in range(len(self._seqs) - 1, self._head - 1, -1):
+            if self._is_alive(position):
+                return self._seqs[position]
+        return 0
+
+    def get_by_id(self, idx: str) -> Message | None:
+        """
+        New messages are in the cache until they are committed, so the cache is checked first.
+        Older messages are read from SQLite, the skeleton tells whether they are still stored.
+        """
+        seq = self._cache_ids.get(idx)
+        if seq is not None:
+            return self._cache[seq] if self._is_stored(seq) else None
+
+        row = self._reader.execute("SELECT seq FROM messages WHERE id = ?", (idx,)).fetchone()
+        if row is None or not self._is_stored(row[0]):
+            return None
+        messages = self._load([row[0]])
+        return messages[0] if messages else None
+
+    def get_all(self, limit: int | None = SHOW_LAST_MESSAGES_COUNT) -> list[Message]:
+        return self.get_before(limit=limit)
+
+    def get_all_from_date(self, date_filter: datetime) -> list[Message]:
+        lo = bisect.bisect_right(self._timestamps, date_filter.timestamp(), lo=self._head)
+        return self._collect(lo, len(self._seqs), None, newest=False)
+
+    def get_after(self, seq: int, limit: int | None = None) -> list[Message]:
+        lo = bisect.bisect_right(self._seqs, seq, lo=self._head)
+        return self._collect(lo, len(self._seqs), limit, newest=False)
+
+    def get_before(self, seq: int | None = None, limit: int | None = None) -> list[Message]:
+        hi = len(self._seqs)
+        if seq is not None:
+            hi = bisect.bisect_left(self._seqs, seq, lo=self._head)
+        return self._collect(self._head, hi, limit, newest=True)
+
+    def get_first(self) -> Message | None:
+        self._compact()
+        if self._head < len(self._seqs):
+            messages = self._load([self._seqs[self._head]])
+            return messages[0] if messages else None
+        return None
+
+    def add(self, message: Message) -> None:
+        message.seq = message_sequence.next()
+        self.restore(message)
+
+    def bulk_add(self, messages: list[Message]) -> None:
+        for message in messages:
+            self.add(message)
+
+    def restore(self, message: Message) -> None:
+        message_sequence.advance_to(message.seq)
+        self._seqs.append(message.seq)
+        self._timestamps.append(message.created_at.timestamp())
+        self._cache_message(message)
+        self._writer.execute(
+            "INSERT OR REPLACE INTO messages (seq, id, sender_id, content, created_at) VALUES (?, ?, ?, ?, ?)",
+            (message.seq, message.idx, message.sender.idx, message.content, message.created_at.timestamp()),
+            seq=message.seq,
+        )
+
+    def delete(self, message: Message) -> None:
+        position = bisect.bisect_left(self._seqs, message.seq, lo=self._head)
+        if position == len(self._seqs) or self._seqs[position] != message.seq:
+            return
+
+        self._deleted.add(message.seq)
+        self._uncache(message.seq)
+        self._writer.execute("DELETE FROM messages WHERE seq = ?", (message.seq,))
+        self._compact()
+
+    def bulk_delete(self, messages: list[Message]) -> None:
+        for message in messages:
+            self.delete(message)
+
+    def pop_created_before(self, date_filter: datetime) -> list[Message]:
+        hi = bisect.bisect_left(self._timestamps, date_filter.timestamp(), lo=self._head)
+        if hi == self._head:
+            return []
+
+        messages = self._collect(self._head, hi, None, newest=False)
+        last_seq = self._seqs[hi - 1]
+        for message in messages:
+            self._uncache(message.seq)
+        self._deleted.difference_update(self._seqs[self._head: hi])
+        self._head = hi
+        self._compact()
+        self._writer.execute("DELETE FROM messages WHERE seq <= ?", (last_seq,))
+        return messages
+
+    def clear(self) -> None:
+        """Drop in-memory state only. History stays in SQLite"""
+        self._cache = {}
+        self._cache_ids = {}
+        self._cache_order = collections.deque()
+        self._seqs = array.array("q")
+        self._timestamps = array.array("d")
+        self._head = 0
+        self._deleted = set()
@@ -1,15 +1,40 @@
+import bisect
+import collections
+import heapq
+import itertools
+import typing as tp
 from datetime import datetime
 
-from config import SHOW_LAST_MESSAGES_COUNT
-from core.schemas import User, Message
-from core.utils import DummyStorageProtocol, Singleton
+from config import (
+    SHOW_LAST_MESSAGES_COUNT,
+    INBOX_MAX_SIZE,
+    STORAGE_BACKEND,
+    SQLITE_PATH,
+    SQLITE_CACHE_SIZE,
+    FILES_DIR,
+    FILES_MAX_SIZE,
+    ROOM_MAX_MESSAGES,
+)
+from core.files import FileSpool
+from core.schemas import User, Message, Room, ScheduledMessage
+from core.sqlite_storage import SqliteWriter, SqliteUsersStorage, SqliteMessagesStorage, connect
+from core.utils import DummyStorageProtocol, Singleton, message_sequence
 
-__all__ = ("DummyDatabase",)
+__all__ = ("DummyDatabase", "MessagesIndex", "ScheduledMessagesQueue")
+
+
+def _get_seq(message: Message) -> int:
+    return message.seq
+
+
+def _get_created_at(message: Message) -> datetime:
+    return message.created_at
 
 
 class DummyUsersStorage(DummyStorageProtocol, Singleton):
     def __init__(self) -> None:
         self._data: dict[str, User] = {}
+        self._tokens: dict[str, str] = {}
 
     def __len__(self) -> int:
         return len(self._data)
@@ -26,26 +51,159 @@ class DummyUsersStorage(DummyStorageProtocol, Singleton):
     def get_by_id(self, idx: str) -> User | None:
         return self._data.get(idx)
 
+    def get_by_token(self, token: str) -> User | None:
+        user_id = self._tokens.get(token)
+        if user_id is None:
+            return None
+        return self._data.get(user_id)
+
+    def get_all(self) -> list[User]:
+        return list(self._data.values())
+
+    def get_connected(self) -> list[User]:
+        return [user for user in self._data.values() if user.is_connected]
+
+    def save(self, user: User) -> None:
+        """Users are kept in memory by reference, so there is nothing to write"""
+
     def add(self, user: User) -> None:
         self._data[user.idx] = user
+        self._tokens[user.token] = user.idx
 
     def bulk_add(self, users: list[User]) -> None:
         for user in users:
-            self._data[user.idx] = user
+            self.add(user)
 
     def delete(self, idx: str) -> None:
         if idx in self._data:
-            del self._data[idx]
+            user = self._data.pop(idx)
+            self._tokens.pop(user.token, None)
 
     def clear(self) -> None:
         for user in self._data.values():
-            user.writer.close()
+            for connection in user.connections:
+                if connection.writer is not None:
+                    connection.writer.close()
         self._data = {}
+        self._tokens = {}
+
+
+class MessagesIndex:
+    """
+    Sequence-ordered messages index.
+
+    Messages are appended in ``seq`` order, which is also their creation order, so range queries are bisects
+    over the live window ``_items[_head:]``. Expired messages are popped from the head in O(1).
+    Messages deleted from the middle of the window stay there as tombstones until the head passes them.
+    """
+
+    _compact_threshold = 1024
+
+    def __init__(self, maxlen: int | None = None) -> None:
+        self._items: list[Message] = []
+        self._head: int = 0
+        self._by_id: dict[str, Message] = {}
+        self._maxlen = maxlen
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, idx: str) -> bool:
+        return idx in self._by_id
+
+    def _is_alive(self, message: Message) -> bool:
+        return self._by_id.get(message.idx) is message
+
+    def _collect(self, lo: int, hi: int, limit: int | None, newest: bool) -> list[Message]:
+        positions = range(hi - 1, lo - 1, -1) if newest else range(lo, hi)
+        messages: list[Message] = []
+        for position in positions:
+            if limit is not None and len(messages) >= limit:
+                break
+            message = self._items[position]
+            if self._is_alive(message):
+                messages.append(message)
+        if newest:
+            messages.reverse()
+        return messages
+
+    def _compact(self) -> None:
+        while self._head < len(self._items) and not self._is_alive(self._items[self._head]):
+            self._head += 1
+        if self._head >= self._compact_threshold and self._head * 2 >= len(self._items):
+            del self._items[: self._head]
+            self._head = 0
+
+    @property
+    def last_seq(self) -> int:
+        for position in range(len(self._items) - 1, self._head - 1, -1):
+            message = self._items[position]
+            if self._is_alive(message):
+                return message.seq
+        return 0
+
+    def get_by_id(self, idx: str) -> Message | None:
+        return self._by_id.get(idx)
+
+    def get_first(self) -> Message | None:
+        self._compact()
+        if self._head < len(self._items):
+            return self._items[self._head]
+        return None
+
+    def get_after(self, seq: int, limit: int | None = None) -> list[Message]:
+        """Oldest ``limit`` messages with sequence id greater than ``seq``"""
+        lo = bisect.bisect_right(self._items, seq, lo=self._head, key=_get_seq)
+        return self._collect(lo, len(self._items), limit, newest=False)
+
+    def get_before(self, seq: int | None = None, limit: int | None = None) -> list[Message]:
+        """Newest ``limit`` messages with sequence id less than ``seq`` (the whole tail if ``seq`` is None)"""
+        hi = len(self._items)
+        if seq is not None:
+            hi = bisect.bisect_left(self._items, seq, lo=self._head, key=_get_seq)
+        return self._collect(self._head, hi, limit, newest=True)
+
+    def get_from_date(self, date_filter: datetime) -> list[Message]:
+        lo = bisect.bisect_right(self._items, date_filter, lo=self._head, key=_get_created_at)
+        return self._collect(lo, len(self._items), None, newest=False)
+
+    def add(self, message: Message) -> None:
+        self._items.append(message)
+        self._by_id[message.idx] = message
+        if self._maxlen is not None and len(self._by_id) > self._maxlen:
+            oldest_message = self.get_first()
+            if oldest_message is not None:
+                self.delete(oldest_message)
+
+    def delete(self, message: Message) -> None:
+        if self._is_alive(message):
+            del self._by_id[message.idx]
+            self._compact()
+
+    def pop_created_before(self, date_filter: datetime) -> list[Message]:
+        """Remove messages from the head of the index while they were created before ``date_filter``"""
+        messages = []
+        while self._head < len(self._items):
+            message = self._items[self._head]
+            alive = self._is_alive(message)
+            if alive and message.created_at >= date_filter:
+                break
+            if alive:
+                del self._by_id[message.idx]
+                messages.append(message)
+            self._head += 1
+        self._compact()
+        return messages
+
+    def clear(self) -> None:
+        self._items = []
+        self._head = 0
+        self._by_id = {}
 
 
 class DummyMessagesStorage(DummyStorageProtocol, Singleton):
     def __init__(self) -> None:
-        self._data: list[Message] = []
+        self._data: MessagesIndex = MessagesIndex()
 
     def __len__(self) -> int:
         return len(self._data)
@@ -56,51 +214,422 @@ class DummyMessagesStorage(DummyStorageProtocol, Singleton):
     def __repr__(self) -> str:
         return "<MessagesStorage> %s" % len(self._data)
 
+    @property
+    def last_seq(self) -> int:
+        return self._data.last_seq
+
     def get_by_id(self, idx: str) -> Message | None:
-        for message in self._data:
-            if idx == message.idx:
-                return message
-        return None
+        return self._data.get_by_id(idx)
 
     def get_all(self, limit: int | None = SHOW_LAST_MESSAGES_COUNT) -> list[Message]:
-        if limit is None:
-            return self._data
-        return self._data[-limit:]
+        return self._data.get_before(limit=limit)
 
     def get_all_from_date(self, date_filter: datetime) -> list[Message]:
-        messages = list(filter(lambda x: x.created_at > date_filter, self._data))
-        return messages
+        return self._data.get_from_date(date_filter)
+
+    def get_after(self, seq: int, limit: int | None = None) -> list[Message]:
+        return self._data.get_after(seq, limit=limit)
+
+    def get_before(self, seq: int | None = None, limit: int | None = None) -> list[Message]:
+        return self._data.get_before(seq, limit=limit)
+
+    def get_first(self) -> Message | None:
+        return self._data.get_first()
 
     def add(self, message: Message) -> None:
-        self._data.append(message)
+        message.seq = message_sequence.next()
+        self._data.add(message)
 
     def bulk_add(self, messages: list[Message]) -> None:
-        self._data.extend(messages)
+        for message in messages:
+            self.add(message)
+
+    def restore(self, message: Message) -> None:
+        """Add message which already has a sequence id, e.g. loaded from disk. Must be called in seq order"""
+        message_sequence.advance_to(message.seq)
+        self._data.add(message)
 
     def delete(self, message: Message) -> None:
-        self._data.remove(message)
+        self._data.delete(message)
 
     def bulk_delete(self, messages: list[Message]) -> None:
         for message in messages:
-            self._data.remove(message)
+            self._data.delete(message)
+
+    def pop_created_before(self, date_filter: datetime) -> list[Message]:
+        return self._data.pop_created_before(date_filter)
 
     def clear(self) -> None:
-        self._data = []
+        self._data.clear()
+
+
+class DummyInboxesStorage(DummyStorageProtocol, Singleton):
+    """
+    Private messages indexed per receiver.
+    Every inbox is a bounded MessagesIndex, so reading user private messages never touches other inboxes.
+    All private messages are also kept in one creation-ordered queue to expire them from the head.
+    """
+
+    def __init__(self) -> None:
+        self._data: dict[str, MessagesIndex] = {}
+        self._timeline: collections.deque[Message] = collections.deque()
+
+    def __len__(self) -> int:
+        return sum(len(inbox) for inbox in self._data.values())
+
+    def __str__(self) -> str:
+        return "<InboxesStorage> %s" % len(self._data)
+
+    def __repr__(self) -> str:
+        return "<InboxesStorage> %s" % len(self._data)
+
+    def get_by_id(self, idx: str) -> MessagesIndex | None:
+        return self._data.get(idx)
+
+    def get_after(self, user_id: str, seq: int, limit: int | None = None) -> list[Message]:
+        inbox = self._data.get(user_id)
+        if inbox is None:
+            return []
+        return inbox.get_after(seq, limit=limit)
+
+    def get_before(self, user_id: str, seq: int | None = None, limit: int | None = None) -> list[Message]:
+        inbox = self._data.get(user_id)
+        if inbox is None:
+            return []
+        return inbox.get_before(seq, limit=limit)
+
+    def get_first(self) -> Message | None:
+        return self._timeline[0] if self._timeline else None
+
+    def add(self, message: Message) -> None:
+        if message.receiver is None:
+            raise ValueError("Private message must have a receiver")
+
+        message.seq = message_sequence.next()
+        self.restore(message)
+
+    def bulk_add(self, messages: list[Message]) -> None:
+        for message in messages:
+            self.add(message)
+
+    def restore(self, message: Message) -> None:
+        """Add message which already has a sequence id, e.g. loaded from disk. Must be called in seq order"""
+        if message.receiver is None:
+            raise ValueError("Private message must have a receiver")
+
+        message_sequence.advance_to(message.seq)
+        inbox = self._data.get(message.receiver.idx)
+        if inbox is None:
+            inbox = self._data[message.receiver.idx] = MessagesIndex(maxlen=INBOX_MAX_SIZE)
+        inbox.add(message)
+        self._timeline.append(message)
+
+    def get_all(self) -> list[Message]:
+        return [message for message in self._timeline if self._is_stored(message)]
+
+    def _is_stored(self, message: Message) -> bool:
+        inbox = self._data.get(message.receiver.idx) if message.receiver is not None else None
+        return inbox is not None and inbox.get_by_id(message.idx) is message
+
+    def delete(self, message: Message) -> None:
+        if message.receiver is not None and message.receiver.idx in self._data:
+            self._data[message.receiver.idx].delete(message)
+
+    def delete_inbox(self, user_id: str) -> None:
+        if user_id in self._data:
+            del self._data[user_id]
+
+    def pop_created_before(self, date_filter: datetime) -> list[Message]:
+        messages = []
+        while self._timeline and self._timeline[0].created_at < date_filter:
+            message = self._timeline.popleft()
+            self.delete(message)
+            messages.append(message)
+        return messages
+
+    def clear(self) -> None:
+        self._data = {}
+        self._timeline = collections.deque()
+
+
+class DummyRoomsStorage(DummyStorageProtocol, Singleton):
+    """
+    Rooms with their members and messages.
+    Every room has its own bounded MessagesIndex and rooms of a user are indexed by user id,
+    so fan-out and history of a room never touch other rooms or the general chat.
+    All room messages are also kept in one creation-ordered queue to expire them from the head.
+    """
+
+    def __init__(self) -> None:
+        self._data: dict[str, Room] = {}
+        self._invite_codes: dict[str, str] = {}
+        self._messages: dict[str, MessagesIndex] = {}
+        self._user_rooms: dict[str, set[str]] = {}
+        self._timeline: collections.deque[Message] = collections.deque()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __str__(self) -> str:
+        return "<RoomsStorage> %s" % len(self._data)
+
+    def __repr__(self) -> str:
+        return "<RoomsStorage> %s" % len(self._data)
+
+    def get_by_id(self, idx: str) -> Room | None:
+        return self._data.get(idx)
+
+    def get_by_invite_code(self, invite_code: str) -> Room | None:
+        room_id = self._invite_codes.get(invite_code)
+        if room_id is None:
+            return None
+        return self._data.get(room_id)
+
+    def get_all(self) -> list[Room]:
+        return list(self._data.values())
+
+    def get_user_rooms(self, user_id: str) -> list[Room]:
+        return [self._data[room_id] for room_id in self._user_rooms.get(user_id, ())]
+
+    def add(self, room: Room) -> None:
+        self._data[room.idx] = room
+        self._invite_codes[room.invite_code] = room.idx
+        self._messages[room.idx] = MessagesIndex(maxlen=ROOM_MAX_MESSAGES)
+        for user_id in room.members:
+            self._user_rooms.setdefault(user_id, set()).add(room.idx)
+
+    def bulk_add(self, rooms: list[Room]) -> None:
+        for room in rooms:
+            self.add(room)
+
+    def delete(self, room: Room) -> None:
+        if self._data.get(room.idx) is not room:
+            return
+
+        del self._data[room.idx]
+        del self._invite_codes[room.invite_code]
+        del self._messages[room.idx]
+        for user_id in room.members:
+            self._discard_user_room(user_id, room.idx)
+
+    def _discard_user_room(self, user_id: str, room_id: str) -> None:
+        room_ids = self._user_rooms.get(user_id)
+        if room_ids is not None:
+            room_ids.discard(room_id)
+            if not room_ids:
+                del self._user_rooms[user_id]
+
+    def add_member(self, room: Room, user_id: str) -> None:
+        room.join_requests.discard(user_id)
+        room.members.add(user_id)
+        self._user_rooms.setdefault(user_id, set()).add(room.idx)
+
+    def remove_member(self, room: Room, user_id: str) -> None:
+        """The room without members is deleted, the owner passes the room to another member"""
+        room.members.discard(user_id)
+        self._discard_user_room(user_id, room.idx)
+        if not room.members:
+            self.delete(room)
+        elif room.owner_id == user_id:
+            room.owner_id = min(room.members)
+
+    def remove_user(self, user_id: str) -> None:
+        for room in self.get_user_rooms(user_id):
+            self.remove_member(room, user_id)
+
+    def get_after(self, room_id: str, seq: int, limit: int | None = None) -> list[Message]:
+        messages = self._messages.get(room_id)
+        if messages is None:
+            return []
+        return messages.get_after(seq, limit=limit)
+
+    def get_before(self, room_id: str, seq: int | None = None, limit: int | None = None) -> list[Message]:
+        messages = self._messages.get(room_id)
+        if messages is None:
+            return []
+        return messages.get_before(seq, limit=limit)
+
+    def get_first(self) -> Message | None:
+        return self._timeline[0] if self._timeline else None
+
+    def add_message(self, message: Message) -> None:
+        if message.room is None:
+            raise ValueError("Room message must have a room")
+
+        message.seq = message_sequence.next()
+        self.restore_message(message)
+
+    def restore_message(self, message: Message) -> None:
+        """Add message which already has a sequence id, e.g. loaded from disk. Must be called in seq order"""
+        if message.room is None:
+            raise ValueError("Room message must have a room")
+
+        message_sequence.advance_to(message.seq)
+        messages = self._messages.get(message.room.idx)
+        if messages is None:
+            return
+        messages.add(message)
+        self._timeline.append(message)
+
+    def get_all_messages(self) -> list[Message]:
+        return [message for message in self._timeline if self._is_stored(message)]
+
+    def _is_stored(self, message: Message) -> bool:
+        messages = self._messages.get(message.room.idx) if message.room is not None else None
+        return messages is not None and messages.get_by_id(message.idx) is message
+
+    def delete_message(self, message: Message) -> None:
+        if message.room is not None and message.room.idx in self._messages:
+            self._messages[message.room.idx].delete(message)
+
+    def pop_created_before(self, date_filter: datetime) -> list[Message]:
+        messages = []
+        while self._timeline and self._timeline[0].created_at < date_filter:
+            message = self._timeline.popleft()
+            self.delete_message(message)
+            messages.append(message)
+        return messages
+
+    def clear(self) -> None:
+        self._data = {}
+        self._invite_codes = {}
+        self._messages = {}
+        self._user_rooms = {}
+        self._timeline = collections.deque()
+
+
+class ScheduledMessagesQueue:
+    """
+    Scheduled messages in a min-heap by send time with an index by id.
+
+    Adding a message is O(log n). A cancelled message is only marked and removed from the index,
+    its heap entry is dropped when it reaches the top. The heap is rebuilt when cancelled entries
+    outnumber the pending ones, so mass cancels do not keep the memory.
+    """
+
+    _compact_threshold = 1024
+
+    def __init__(self) -> None:
+        self._heap: list[tuple[datetime, int, ScheduledMessage]] = []
+        self._by_id: dict[str, ScheduledMessage] = {}
+        self._counter: tp.Iterator[int] = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, idx: str) -> bool:
+        return idx in self._by_id
+
+    def __str__(self) -> str:
+        return "<ScheduledMessagesQueue> %s" % len(self._by_id)
+
+    def __repr__(self) -> str:
+        return "<ScheduledMessagesQueue> %s" % len(self._by_id)
+
+    def get_by_id(self, idx: str) -> ScheduledMessage | None:
+        return self._by_id.get(idx)
+
+    def get_first(self) -> ScheduledMessage | None:
+        while self._heap and self._heap[0][2].is_cancelled:
+            heapq.heappop(self._heap)
+        return self._heap[0][2] if self._heap else None
+
+    def get_all(self) -> list[ScheduledMessage]:
+        return sorted(self._by_id.values(), key=lambda scheduled: scheduled.send_at)
+
+    def add(self, scheduled: ScheduledMessage) -> None:
+        heapq.heappush(self._heap, (scheduled.send_at, next(self._counter), scheduled))
+        self._by_id[scheduled.idx] = scheduled
+
+    def cancel(self, idx: str) -> ScheduledMessage | None:
+        """Returns the cancelled message or None if it is not pending"""
+        scheduled = self._by_id.pop(idx, None)
+        if scheduled is None:
+            return None
+
+        scheduled.is_cancelled = True
+        if len(self._heap) >= self._compact_threshold and len(self._heap) > 2 * len(self._by_id):
+            self._heap = [item for item in self._heap if not item[2].is_cancelled]
+            heapq.heapify(self._heap)
+        return scheduled
+
+    def pop_due(self, now: datetime, limit: int | None = None) -> list[ScheduledMessage]:
+        """Remove up to ``limit`` messages which are due at ``now``, earliest first"""
+        due: list[ScheduledMessage] = []
+        while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+            _, _, scheduled = heapq.heappop(self._heap)
+            if not scheduled.is_cancelled:
+                del self._by_id[scheduled.idx]
+                due.append(scheduled)
+        return due
+
+    def clear(self) -> None:
+        self._heap = []
+        self._by_id = {}
 
 
 class DummyDatabase(Singleton):
     def __init__(self) -> None:
-        self._users: DummyUsersStorage = DummyUsersStorage()
-        self._messages: DummyMessagesStorage = DummyMessagesStorage()
+        # Singleton returns the same object, but __init__ runs on every DummyDatabase() call
+        if hasattr(self, "_users"):
+            return
+
+        self._users: DummyUsersStorage | SqliteUsersStorage
+        self._messages: DummyMessagesStorage | SqliteMessagesStorage
+        self._sqlite_writer: SqliteWriter | None = None
+        if STORAGE_BACKEND == "sqlite":
+            reader = connect(SQLITE_PATH)
+            self._sqlite_writer = SqliteWriter(SQLITE_PATH)
+            self._sqlite_writer.start()
+            self._users = SqliteUsersStorage(reader=reader, writer=self._sqlite_writer)
+            self._messages = SqliteMessagesStorage(
+                reader=reader,
+                writer=self._sqlite_writer,
+                users=self._users,
+                cache_size=SQLITE_CACHE_SIZE,
+            )
+        else:
+            self._users = DummyUsersStorage()
+            self._messages = DummyMessagesStorage()
+        self._inboxes: DummyInboxesStorage = DummyInboxesStorage()
+        self._files: FileSpool = FileSpool(directory=FILES_DIR, max_size=FILES_MAX_SIZE)
+        self._rooms: DummyRoomsStorage = DummyRoomsStorage()
+        self._scheduled: ScheduledMessagesQueue = ScheduledMessagesQueue()
 
     @property
-    def users(self) -> DummyUsersStorage:
+    def users(self) -> DummyUsersStorage | SqliteUsersStorage:
         return self._users
 
     @property
-    def messages(self) -> DummyMessagesStorage:
+    def messages(self) -> DummyMessagesStorage | SqliteMessagesStorage:
         return self._messages
 
+    @property
+    def inboxes(self) -> DummyInboxesStorage:
+        return self._inboxes
+
+    @property
+    def files(self) -> FileSpool:
+        return self._files
+
+    @property
+    def rooms(self) -> DummyRoomsStorage:
+        return self._rooms
+
+    @property
+    def scheduled(self) -> ScheduledMessagesQueue:
+        return self._scheduled
+
     def clear(self) -> None:
         self._users.clear()
         self._messages.clear()
+        self._inboxes.clear()
+        self._files.clear()
+        self._rooms.clear()
+        self._scheduled.clear()
+
+    def close(self) -> None:
+        """Clear in-memory state and wait until SQLite writer commits everything"""
+        self.clear()
+        if self._sqlite_writer is not None:
+            self._sqlite_writer.close()
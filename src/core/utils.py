@@ -2,7 +2,14 @@ import logging
 import typing as tp
 from datetime import datetime, timedelta
 
-__all__ = ("DummyStorageProtocol", "Singleton", "get_now_with_delta", "prepare_message")
+__all__ = (
+    "DummyStorageProtocol",
+    "Singleton",
+    "SequenceCounter",
+    "message_sequence",
+    "get_now_with_delta",
+    "prepare_message",
+)
 
 logger = logging.getLogger(__name__)
 
@@ -40,3 +47,24 @@ class DummyStorageProtocol(tp.Protocol):
 
     def clear(self) -> None:
         raise NotImplementedError
+
+
+class SequenceCounter:
+    def __init__(self) -> None:
+        self._last_seq = 0
+
+    @property
+    def last_seq(self) -> int:
+        return self._last_seq
+
+    def next(self) -> int:
+        self._last_seq += 1
+        return self._last_seq
+
+    def advance_to(self, seq: int) -> None:
+        """Move counter forward to a restored sequence id, so new messages continue after it"""
+        self._last_seq = max(self._last_seq, seq)
+
+
+# Sequence ids are shared by all messages storages, so one user cursor covers the general chat and private messages
+message_sequence = SequenceCounter()
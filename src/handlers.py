@@ -1,5 +1,4 @@
 import logging
-from datetime import datetime
 
 import services
 from config import (
@@ -7,74 +6,427 @@ from config import (
     USER_NO_FOUND_MESSAGE_TEMPLATE,
     NO_MESSAGE_TEMPLATE,
     ALREADY_CONNECTED_MESSAGE_TEMPLATE,
+    STATUS_CURSOR_MESSAGE_TEMPLATE,
+    SESSION_TOKEN_MESSAGE_TEMPLATE,
+    INVALID_SESSION_MESSAGE_TEMPLATE,
+    METRICS_DISABLED_MESSAGE_TEMPLATE,
+    METRICS_ADMIN_TOKEN,
+    FILE_MESSAGE_TEMPLATE,
+    FILE_NOT_FOUND_MESSAGE_TEMPLATE,
+    FILE_TRANSFER_UNAVAILABLE_MESSAGE_TEMPLATE,
+    DATE_FORMAT,
+    SCHEDULED_MESSAGE_TEMPLATE,
+    CANCELLED_MESSAGE_TEMPLATE,
+    SCHEDULED_NOT_FOUND_MESSAGE_TEMPLATE,
+    INVALID_SEND_TIME_MESSAGE_TEMPLATE,
+    SCHEDULED_UNAVAILABLE_MESSAGE_TEMPLATE,
+    ROOM_CREATED_MESSAGE_TEMPLATE,
+    ROOM_NOT_FOUND_MESSAGE_TEMPLATE,
+    ROOM_OWNER_ONLY_MESSAGE_TEMPLATE,
+    ROOM_INVITED_MESSAGE_TEMPLATE,
+    ROOM_JOINED_MESSAGE_TEMPLATE,
+    ROOM_ALREADY_MEMBER_MESSAGE_TEMPLATE,
+    ROOM_INVALID_INVITE_MESSAGE_TEMPLATE,
+    ROOM_JOIN_REQUESTED_MESSAGE_TEMPLATE,
+    ROOM_JOIN_REQUEST_MESSAGE_TEMPLATE,
+    ROOM_LEFT_MESSAGE_TEMPLATE,
+    ROOMS_UNAVAILABLE_MESSAGE_TEMPLATE,
 )
 from core import DummyDatabase
-from core.schemas import User, Command
+from core.schemas import Connection, Command, Room, User
 
 dummy_db = DummyDatabase()
 
 logger = logging.getLogger(__name__)
 
 
-async def connect(user: User, command: Command | None = None) -> None:
-    if user.is_connected:
-        await services.send_message_to_user(user=user, message=ALREADY_CONNECTED_MESSAGE_TEMPLATE)
+async def connect(connection: Connection, command: Command | None = None) -> None:
+    if connection.is_connected:
+        await services.send_message_to_connection(connection=connection, message=ALREADY_CONNECTED_MESSAGE_TEMPLATE)
         return
 
-    user.is_connected = True
-    logger.info("%s connected!" % user)
-    await services.send_start_message(user_to=user)
+    token = command.arguments[0] if command is not None and len(command.arguments) != 0 else None
+    user = services.start_session(connection, token=token)
+    if user is None:
+        logger.info("%s sent invalid session token" % connection)
+        await services.send_message_to_connection(connection=connection, message=INVALID_SESSION_MESSAGE_TEMPLATE)
+        return
+
+    logger.info("%s connected with %s!" % (user, connection))
+    await services.send_message_to_connection(
+        connection=connection,
+        message=SESSION_TOKEN_MESSAGE_TEMPLATE.format(token=user.token),
+    )
+    await services.send_start_message(connection_to=connection)
 
 
-async def disconnect(user: User, command: Command | None = None) -> None:
-    logger.info("%s disconnect" % user)
-    user.is_connected = False
-    await user.disconnect()
+async def disconnect(connection: Connection, command: Command | None = None) -> None:
+    logger.info("%s disconnect %s" % (connection.user, connection))
+    await connection.disconnect()
 
 
-async def send(user: User, command: Command | None = None) -> None:
+async def send(connection: Connection, command: Command | None = None) -> None:
     if command is None:
         logger.error('send handler must have "command" parameter')
-        await services.send_message_to_user(user=user, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        return
+
+    send_at = None
+    arguments = list(command.arguments)
+    if arguments[:1] == ["--at"]:
+        # Scheduled messages live in the worker memory and only the first worker persists them
+        if services.is_clustered():
+            await services.send_message_to_connection(
+                connection=connection,
+                message=SCHEDULED_UNAVAILABLE_MESSAGE_TEMPLATE,
+            )
+            return
+
+        value = arguments[1] if len(arguments) > 1 else ""
+        del arguments[:2]
+        try:
+            send_at = services.parse_send_at(value)
+        except ValueError as err:
+            logger.info("Invalid send time from %s: %s" % (connection.user, err))
+            await services.send_message_to_connection(
+                connection=connection,
+                message=INVALID_SEND_TIME_MESSAGE_TEMPLATE.format(send_at=value),
+            )
+            return
+
+    receiver = None
+    if arguments and arguments[0].startswith("@"):
+        receiver_id = arguments.pop(0)[1:]
+        receiver = dummy_db.users.get_by_id(idx=receiver_id)
+        if receiver is None:
+            await services.send_message_to_connection(
+                connection=connection,
+                message=USER_NO_FOUND_MESSAGE_TEMPLATE.format(user_id=receiver_id),
+            )
+            return
+
+    if send_at is not None:
+        scheduled = services.schedule_message(
+            sender=connection.user,
+            content=" ".join(arguments),
+            send_at=send_at,
+            receiver=receiver,
+        )
+        logger.info("Scheduled %s by %s to %s" % (scheduled, connection.user, send_at))
+        await services.send_message_to_connection(
+            connection=connection,
+            message=SCHEDULED_MESSAGE_TEMPLATE.format(
+                message_id=scheduled.idx,
+                send_at=send_at.strftime(DATE_FORMAT),
+            ),
+        )
         return
 
-    message_content = command.arguments_to_string()
-    message = await services.create_message(sender=user, content=message_content)
+    await _publish(connection, " ".join(arguments), receiver)
+
+
+async def _publish(connection: Connection, message_content: str, receiver: User | None) -> None:
+    if services.is_clustered():
+        services.submit_message(origin=connection, content=message_content, receiver=receiver)
+        return
+
+    user = connection.user
+    message = await services.create_message(sender=user, content=message_content, receiver=receiver)
     logger.info("Created Message[%s] by %s" % (message.idx, user))
+    receivers_count = services.publish_message(message, origin=connection)
+    logger.info("Message[%s] published to %s users" % (message.idx, receivers_count))
+
+
+async def cancel(connection: Connection, command: Command | None = None) -> None:
+    if command is None or len(command.arguments) == 0:
+        logger.error('cancel handler must have "command" parameter with message id')
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        return
+
+    if services.is_clustered():
+        await services.send_message_to_connection(
+            connection=connection, message=SCHEDULED_UNAVAILABLE_MESSAGE_TEMPLATE
+        )
+        return
+
+    message_id = command.arguments[0]
+    scheduled = services.cancel_scheduled_message(connection.user, message_id)
+    if scheduled is None:
+        await services.send_message_to_connection(
+            connection=connection,
+            message=SCHEDULED_NOT_FOUND_MESSAGE_TEMPLATE.format(message_id=message_id),
+        )
+        return
+
+    logger.info("%s cancelled %s" % (connection.user, scheduled))
+    await services.send_message_to_connection(
+        connection=connection,
+        message=CANCELLED_MESSAGE_TEMPLATE.format(message_id=message_id),
+    )
 
 
-async def status(user: User, command: Command | None = None) -> None:
-    last_messages = dummy_db.messages.get_all(limit=None)
+async def status(connection: Connection, command: Command | None = None) -> None:
+    arguments = command.arguments if command is not None else []
+    user = connection.user
+    if list(arguments[:1]) == ["summary"]:
+        logger.info("Show summary to %s" % user)
+        await services.send_message_to_connection(connection, services.get_status_summary())
+        return
+
+    try:
+        page = services.parse_page(arguments)
+    except ValueError as err:
+        logger.info("Invalid status request from %s: %s" % (user, err))
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        return
+
+    last_messages = services.get_messages_page(page)
     logger.info("Show %s %s messages" % (user, len(last_messages)))
-    user.last_status_request_at = datetime.now()
     if len(last_messages) == 0:
-        await services.send_message_to_user(user, NO_MESSAGE_TEMPLATE)
+        await services.send_message_to_connection(connection, NO_MESSAGE_TEMPLATE)
         return
 
-    for message_obj in last_messages:
-        await services.send_message_to_user(user, repr(message_obj))
+    await services.send_messages_to_connection(connection, last_messages)
+    await services.send_message_to_connection(
+        connection=connection,
+        message=STATUS_CURSOR_MESSAGE_TEMPLATE.format(before=last_messages[0].seq, after=last_messages[-1].seq),
+    )
 
 
-async def report(user: User, command: Command | None = None) -> None:
+async def report(connection: Connection, command: Command | None = None) -> None:
     if command is None:
         logger.error('report handler must have "command" parameter')
-        await services.send_message_to_user(user=user, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
         return
 
     command_arguments = command.arguments
     target_user_id = command_arguments[0] if len(command_arguments) != 0 else ""
     target_user = dummy_db.users.get_by_id(idx=target_user_id)
 
-    if target_user and target_user.idx != user.idx:
+    if target_user and target_user.idx != connection.user.idx:
         logger.info("Ban report on %s" % target_user)
-        await services.report_on_user(target_user)
+        if services.is_clustered():
+            services.submit_report(target_user)
+        else:
+            await services.report_on_user(target_user)
     else:
-        await services.send_message_to_user(
-            user=user,
+        await services.send_message_to_connection(
+            connection=connection,
             message=USER_NO_FOUND_MESSAGE_TEMPLATE.format(user_id=target_user_id),
         )
 
 
-async def default(user: User, command: Command | None = None) -> None:
-    logger.info("Invalid request. Send error to %s" % user)
-    await services.send_message_to_user(user=user, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+async def room(connection: Connection, command: Command | None = None) -> None:
+    """/room create|invite|join|leave|send. Rooms live in the worker memory, so a cluster server has none"""
+    if command is None or len(command.arguments) == 0 or command.arguments[0] not in ROOM_ACTIONS:
+        logger.error('room handler must have "command" parameter with action')
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        return
+    if services.is_clustered():
+        await services.send_message_to_connection(connection=connection, message=ROOMS_UNAVAILABLE_MESSAGE_TEMPLATE)
+        return
+
+    action, *arguments = command.arguments
+    if action != "create" and len(arguments) == 0:
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        return
+    await ROOM_ACTIONS[action](connection, arguments)
+
+
+async def _create_room(connection: Connection, arguments: list[str]) -> None:
+    name = " ".join(arguments)
+    if not name:
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        return
+
+    new_room = services.create_room(owner=connection.user, name=name)
+    logger.info("%s created %s" % (connection.user, new_room))
+    await services.send_message_to_connection(
+        connection=connection,
+        message=ROOM_CREATED_MESSAGE_TEMPLATE.format(
+            room_id=new_room.idx,
+            name=new_room.name,
+            invite_code=new_room.invite_code,
+        ),
+    )
+
+
+async def _get_member_room(connection: Connection, room_id: str) -> Room | None:
+    member_room = services.get_member_room(connection.user, room_id)
+    if member_room is None:
+        await services.send_message_to_connection(
+            connection=connection,
+            message=ROOM_NOT_FOUND_MESSAGE_TEMPLATE.format(room_id=room_id),
+        )
+    return member_room
+
+
+async def _invite_to_room(connection: Connection, arguments: list[str]) -> None:
+    """Owner invites any user. Inviting the user who asked to join with the invite link approves the request"""
+    room_id = arguments[0]
+    member_room = await _get_member_room(connection, room_id)
+    if member_room is None:
+        return
+    if member_room.owner_id != connection.user.idx:
+        await services.send_message_to_connection(
+            connection=connection,
+            message=ROOM_OWNER_ONLY_MESSAGE_TEMPLATE.format(room_id=room_id),
+        )
+        return
+
+    user_id = arguments[1].removeprefix("@") if len(arguments) > 1 else ""
+    user = dummy_db.users.get_by_id(idx=user_id)
+    if user is None:
+        await services.send_message_to_connection(
+            connection=connection,
+            message=USER_NO_FOUND_MESSAGE_TEMPLATE.format(user_id=user_id),
+        )
+        return
+
+    if not member_room.has_member(user.idx):
+        services.add_room_member(member_room, user)
+        logger.info("%s is added to %s" % (user, member_room))
+        services.notify_user(user, ROOM_JOINED_MESSAGE_TEMPLATE.format(room_id=room_id, name=member_room.name))
+    await services.send_message_to_connection(
+        connection=connection,
+        message=ROOM_INVITED_MESSAGE_TEMPLATE.format(user_id=user.idx, room_id=room_id),
+    )
+
+
+async def _join_room(connection: Connection, arguments: list[str]) -> None:
+    invite_code = arguments[0]
+    user = connection.user
+    invited_room = dummy_db.rooms.get_by_invite_code(invite_code)
+    if invited_room is None:
+        await services.send_message_to_connection(
+            connection=connection,
+            message=ROOM_INVALID_INVITE_MESSAGE_TEMPLATE.format(invite_code=invite_code),
+        )
+        return
+    if invited_room.has_member(user.idx):
+        await services.send_message_to_connection(
+            connection=connection,
+            message=ROOM_ALREADY_MEMBER_MESSAGE_TEMPLATE.format(room_id=invited_room.idx),
+        )
+        return
+
+    owner = services.get_room_owner(invited_room)
+    if services.request_room_join(invited_room, user) and owner is not None:
+        logger.info("%s asks to join %s" % (user, invited_room))
+        notice = ROOM_JOIN_REQUEST_MESSAGE_TEMPLATE.format(
+            user_id=user.idx,
+            room_id=invited_room.idx,
+            name=invited_room.name,
+        )
+        services.notify_user(owner, notice)
+    await services.send_message_to_connection(
+        connection=connection,
+        message=ROOM_JOIN_REQUESTED_MESSAGE_TEMPLATE.format(room_id=invited_room.idx, name=invited_room.name),
+    )
+
+
+async def _leave_room(connection: Connection, arguments: list[str]) -> None:
+    room_id = arguments[0]
+    member_room = await _get_member_room(connection, room_id)
+    if member_room is None:
+        return
+
+    services.leave_room(member_room, connection.user)
+    logger.info("%s left %s" % (connection.user, member_room))
+    await services.send_message_to_connection(
+        connection=connection,
+        message=ROOM_LEFT_MESSAGE_TEMPLATE.format(room_id=room_id),
+    )
+
+
+async def _send_to_room(connection: Connection, arguments: list[str]) -> None:
+    room_id, *content = arguments
+    member_room = await _get_member_room(connection, room_id)
+    if member_room is None:
+        return
+
+    user = connection.user
+    message = await services.create_message(sender=user, content=" ".join(content), room=member_room)
+    logger.info("Created Message[%s] by %s in %s" % (message.idx, user, member_room))
+    receivers_count = services.publish_message(message, origin=connection)
+    logger.info("Message[%s] published to %s users" % (message.idx, receivers_count))
+
+
+ROOM_ACTIONS = {
+    "create": _create_room,
+    "invite": _invite_to_room,
+    "join": _join_room,
+    "leave": _leave_room,
+    "send": _send_to_room,
+}
+
+
+async def metrics(connection: Connection, command: Command | None = None) -> None:
+    if not services.is_metrics_enabled():
+        await services.send_message_to_connection(connection=connection, message=METRICS_DISABLED_MESSAGE_TEMPLATE)
+        return
+
+    token = command.arguments[0] if command is not None and len(command.arguments) != 0 else None
+    if METRICS_ADMIN_TOKEN and token != METRICS_ADMIN_TOKEN:
+        logger.info("%s requested metrics without admin token" % connection.user)
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        return
+
+    logger.info("Show metrics to %s" % connection.user)
+    await services.send_message_to_connection(connection=connection, message=services.get_metrics_summary())
+
+
+async def upload(connection: Connection, command: Command | None = None) -> None:
+    """The request is followed by the file content. What the handler does not read is skipped by the server"""
+    if command is None:
+        logger.error('upload handler must have "command" parameter')
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        return
+
+    if not services.can_transfer_files(connection):
+        await services.send_message_to_connection(connection, FILE_TRANSFER_UNAVAILABLE_MESSAGE_TEMPLATE)
+        return
+
+    try:
+        receiver_id, size, name = services.parse_upload(command.arguments)
+    except ValueError as err:
+        logger.info("Invalid upload request from %s: %s" % (connection.user, err))
+        await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+        return
+
+    result = await services.receive_upload(connection, receiver_id, size, name)
+    if result.reply is not None:
+        await services.send_message_to_connection(connection=connection, message=result.reply)
+    if result.stored_file is None:
+        return
+
+    stored_file = result.stored_file
+    content = FILE_MESSAGE_TEMPLATE.format(name=stored_file.name, size=stored_file.size, file_id=stored_file.idx)
+    await _publish(connection, content, result.receiver)
+
+
+async def download(connection: Connection, command: Command | None = None) -> None:
+    if not services.can_transfer_files(connection):
+        await services.send_message_to_connection(connection, FILE_TRANSFER_UNAVAILABLE_MESSAGE_TEMPLATE)
+        return
+
+    file_id = command.arguments[0] if command is not None and len(command.arguments) != 0 else ""
+    stored_file = services.get_file(connection.user, file_id)
+    if stored_file is None:
+        await services.send_message_to_connection(connection, FILE_NOT_FOUND_MESSAGE_TEMPLATE.format(file_id=file_id))
+        return
+
+    try:
+        await services.send_file(connection, stored_file)
+    except FileNotFoundError:
+        await services.send_message_to_connection(connection, FILE_NOT_FOUND_MESSAGE_TEMPLATE.format(file_id=file_id))
+        return
+    except OSError as err:
+        logger.info("Failed to send %s to %s: %s" % (stored_file, connection, err))
+        return
+    logger.info("%s downloaded %s" % (connection.user, stored_file))
+
+
+async def default(connection: Connection, command: Command | None = None) -> None:
+    logger.info("Invalid request. Send error to %s" % connection.user)
+    await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
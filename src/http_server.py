@@ -0,0 +1,404 @@
+import asyncio
+import logging
+import time
+import typing as tp
+from asyncio import StreamReader, StreamWriter
+from dataclasses import dataclass, field
+
+import services
+from config import (
+    MAX_FRAME_SIZE,
+    HTTP_MAX_BODY_SIZE,
+    HTTP_KEEPALIVE_TIMEOUT_SECONDS,
+    HTTP_SESSION_IDLE_SECONDS,
+    HTTP_LONG_POLL_TIMEOUT_SECONDS,
+    HTTP_SSE_KEEPALIVE_SECONDS,
+    SLOW_CONSUMER_DRAIN_TIMEOUT_SECONDS,
+    NOT_CONNECTED_MESSAGE_TEMPLATE,
+    INVALID_SESSION_MESSAGE_TEMPLATE,
+)
+from core import DummyDatabase
+from core.http import HttpError, HttpRequest, read_request, render_head, write_response, write_chunk, write_last_chunk
+from core.schemas import Command, Connection
+
+Dispatch = tp.Callable[[Connection, Command], tp.Awaitable[None]]
+Peer = tuple[str, int]
+RouteHandler = tp.Callable[[HttpRequest, StreamWriter, Peer], tp.Awaitable[None]]
+
+TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
+SESSION_TOKEN_HEADER = "X-Session-Token"
+
+
+@dataclass(slots=True, eq=False)
+class HttpSession:
+    connection: Connection
+    last_seen_at: float = field(default_factory=time.monotonic)
+    # Event streams and long polls which are waiting for the session messages
+    streams: int = 0
+
+    def touch(self) -> None:
+        self.last_seen_at = time.monotonic()
+
+
+class HttpServer:
+    """
+    HTTP/1.1 front end of the chat.
+
+    Requests are mapped onto chat commands and go through the same dispatch as the line protocol.
+    POST /connect returns a session token, the other requests carry it in the "Authorization: Bearer" header.
+    The session has its own chat connection which is not bound to a TCP stream: chat messages wait in its outbox
+    until they are streamed by GET /events (server-sent events) or taken by GET /poll (long poll).
+    """
+
+    def __init__(self, dispatch: Dispatch) -> None:
+        self._dispatch = dispatch
+        self._dummy_db = DummyDatabase()
+        self._sessions: dict[str, HttpSession] = {}
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.routes: dict[tuple[str, str], RouteHandler] = {
+            ("POST", "/connect"): self.connect,
+            ("POST", "/disconnect"): self.disconnect,
+            ("GET", "/status"): self.status,
+            ("POST", "/send"): self.send,
+            ("POST", "/cancel"): self.cancel,
+            ("POST", "/room"): self.room,
+            ("POST", "/report"): self.report,
+            ("GET", "/events"): self.events,
+            ("GET", "/poll"): self.poll,
+        }
+
+    @staticmethod
+    def _get_token(request: HttpRequest) -> str | None:
+        authorization = request.get_header(b"authorization")
+        if authorization is None:
+            return None
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() != "bearer":
+            return None
+        return token.strip() or None
+
+    def _get_session(self, request: HttpRequest, peer: Peer) -> HttpSession:
+        """
+        Find the session of request token. A valid token without HTTP session (e.g. a session of the line
+        protocol or a session from the other cluster worker) gets a new HTTP session connection.
+        """
+        token = self._get_token(request)
+        if token is None:
+            raise HttpError(401, NOT_CONNECTED_MESSAGE_TEMPLATE, headers=[("WWW-Authenticate", "Bearer")])
+
+        session = self._sessions.get(token)
+        if session is not None and not session.connection.is_connected:
+            # The session connection was evicted as a slow consumer, the client gets a new one
+            del self._sessions[token]
+            session = None
+        if session is None:
+            if self._dummy_db.users.get_by_token(token) is None:
+                raise HttpError(401, INVALID_SESSION_MESSAGE_TEMPLATE, headers=[("WWW-Authenticate", "Bearer")])
+            connection = services.create_http_connection(host=peer[0], port=peer[1])
+            services.start_session(connection, token=token)
+            session = self._sessions[token] = HttpSession(connection)
+            self._logger.info("HTTP session of %s is attached by token" % connection.user)
+
+        session.touch()
+        return session
+
+    def _close_session(self, token: str) -> None:
+        session = self._sessions.pop(token, None)
+        if session is None:
+            return
+        services.close_session(session.connection)
+        # Wake up event streams of the session, they stop when they see the closed connection
+        services.enqueue_to_connection(session.connection, b"")
+        self._logger.info("HTTP session of %s is closed" % session.connection.user)
+
+    async def _reply(self, request: HttpRequest, writer: StreamWriter, connection: Connection, line: str) -> None:
+        """Dispatch command and send its replies as one response with Content-Length"""
+        replies: list[bytes] = []
+
+        async def collect(data: bytes) -> None:
+            replies.append(data)
+
+        with services.capture_replies(connection, collect):
+            await self._dispatch(connection, Command(request=line))
+
+        headers = []
+        if connection.is_connected:
+            headers.append((SESSION_TOKEN_HEADER, connection.user.token))
+        write_response(writer, 200, b"".join(replies), keep_alive=request.keep_alive, headers=headers)
+
+    async def _stream_reply(
+        self,
+        request: HttpRequest,
+        writer: StreamWriter,
+        connection: Connection,
+        line: str,
+    ) -> None:
+        """Dispatch command and send every reply chunk as soon as it is ready, e.g. a long status page"""
+        if request.version == "HTTP/1.0":
+            await self._reply(request, writer, connection, line)
+            return
+
+        writer.write(
+            render_head(
+                200,
+                [("Content-Type", TEXT_CONTENT_TYPE), ("Transfer-Encoding", "chunked")],
+                request.keep_alive,
+            )
+        )
+
+        async def stream(data: bytes) -> None:
+            write_chunk(writer, data)
+            await writer.drain()
+
+        with services.capture_replies(connection, stream):
+            await self._dispatch(connection, Command(request=line))
+        write_last_chunk(writer)
+
+    async def connect(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        token = self._get_token(request) or request.body.decode(errors="replace").strip() or None
+        session = self._sessions.get(token) if token is not None else None
+        if session is not None:
+            session.touch()
+            await self._reply(request, writer, session.connection, "/connect")
+            return
+
+        connection = services.create_http_connection(host=peer[0], port=peer[1])
+        await self._reply(request, writer, connection, "/connect" if token is None else "/connect %s" % token)
+        if connection.is_connected:
+            self._sessions[connection.user.token] = HttpSession(connection)
+
+    async def disconnect(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        session = self._get_session(request, peer)
+        self._close_session(session.connection.user.token)
+        write_response(writer, 204, keep_alive=request.keep_alive)
+
+    async def status(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        session = self._get_session(request, peer)
+        query = request.query
+        arguments = []
+        if "summary" in query:
+            arguments.append("summary")
+        else:
+            if "limit" in query:
+                arguments.append(query["limit"])
+            for cursor in ("before", "after"):
+                if cursor in query:
+                    arguments.extend((cursor, query[cursor]))
+                    break
+        await self._stream_reply(request, writer, session.connection, " ".join(["/status", *arguments]))
+
+    async def send(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        session = self._get_session(request, peer)
+        try:
+            content = request.body.decode()
+        except UnicodeDecodeError:
+            raise HttpError(400, "Message must be UTF-8 text")
+
+        command_name = "/send"
+        send_at = request.query.get("at", "").strip()
+        if send_at:
+            # The send time is one command argument, "2026-01-01 10:00" is read as "2026-01-01T10:00"
+            command_name = "/send --at %s" % send_at.replace(" ", "T")
+        receiver_id = request.query.get("to")
+        if receiver_id is not None:
+            content = "@%s %s" % (receiver_id, content)
+        await self._reply(request, writer, session.connection, "%s %s" % (command_name, content))
+
+    async def cancel(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        session = self._get_session(request, peer)
+        message_id = request.query.get("id") or request.body.decode(errors="replace").strip()
+        await self._reply(request, writer, session.connection, "/cancel %s" % message_id)
+
+    async def room(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        """Body is the /room command without its name, e.g. "send <room_id> <message>" """
+        session = self._get_session(request, peer)
+        try:
+            arguments = request.body.decode()
+        except UnicodeDecodeError:
+            raise HttpError(400, "Room command must be UTF-8 text")
+        await self._reply(request, writer, session.connection, "/room %s" % arguments)
+
+    async def report(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        session = self._get_session(request, peer)
+        user_id = request.query.get("user") or request.body.decode(errors="replace").strip()
+        await self._reply(request, writer, session.connection, "/report %s" % user_id)
+
+    @staticmethod
+    def _take_outbox(connection: Connection, first: bytes) -> bytes:
+        chunks = [first]
+        while not connection.outbox.empty():
+            chunks.append(connection.outbox.get_nowait())
+        services.enqueue_missed_notice(connection)
+        return b"".join(chunks)
+
+    async def events(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        """Server-sent events stream: every chat line is one event, comments keep idle proxies from closing it"""
+        if request.version == "HTTP/1.0":
+            raise HttpError(505, "Event stream needs HTTP/1.1")
+
+        session = self._get_session(request, peer)
+        connection = session.connection
+        writer.write(
+            render_head(
+                200,
+                [
+                    ("Content-Type", "text/event-stream"),
+                    ("Cache-Control", "no-cache"),
+                    ("Transfer-Encoding", "chunked"),
+                ],
+                request.keep_alive,
+            )
+        )
+        session.streams += 1
+        try:
+            while connection.is_connected:
+                try:
+                    data = await asyncio.wait_for(connection.outbox.get(), timeout=HTTP_SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    write_chunk(writer, b": keepalive\n\n")
+                else:
+                    lines = self._take_outbox(connection, data).splitlines()
+                    write_chunk(writer, b"".join(b"data: %s\n\n" % line for line in lines))
+                async with asyncio.timeout(SLOW_CONSUMER_DRAIN_TIMEOUT_SECONDS):
+                    await writer.drain()
+        finally:
+            session.streams -= 1
+            session.touch()
+        write_last_chunk(writer)
+
+    async def poll(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        """Long poll: wait for chat messages up to the timeout and return everything that is queued"""
+        session = self._get_session(request, peer)
+        connection = session.connection
+        try:
+            timeout = float(request.query.get("timeout", HTTP_LONG_POLL_TIMEOUT_SECONDS))
+        except ValueError:
+            raise HttpError(400, "Invalid timeout")
+        # Long poll must not outlive the session idle timeout
+        timeout = min(max(timeout, 0), HTTP_SESSION_IDLE_SECONDS)
+
+        session.streams += 1
+        try:
+            data = await asyncio.wait_for(connection.outbox.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            data = b""
+        finally:
+            session.streams -= 1
+            session.touch()
+
+        body = self._take_outbox(connection, data) if data else b""
+        write_response(writer, 200 if body else 204, body, keep_alive=request.keep_alive)
+
+    async def handle_request(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> None:
+        handler = self.routes.get((request.method, request.path))
+        if handler is not None:
+            self._logger.info("Execute %s %s" % (request.method, request.path))
+            await handler(request, writer, peer)
+            return
+
+        allowed_methods = [method for method, path in self.routes if path == request.path]
+        if allowed_methods:
+            raise HttpError(405, headers=[("Allow", ", ".join(allowed_methods))])
+        raise HttpError(404)
+
+    @staticmethod
+    def write_error(writer: StreamWriter, err: HttpError, keep_alive: bool) -> None:
+        write_response(writer, err.status, ("%s\n" % err).encode(), keep_alive=keep_alive, headers=err.headers)
+
+    async def entrypoint(self, reader: StreamReader, writer: StreamWriter) -> None:
+        host, port, *_ = writer.get_extra_info("peername")
+        reason = services.admit_connection(host)
+        if reason is not None:
+            self._logger.info("Reject HTTP connection from %s: %s" % (host, reason))
+            message = services.get_rejection_message(host, reason)
+            write_response(writer, 503, ("%s\n" % message).encode(), keep_alive=False, headers=[("Retry-After", "1")])
+            writer.close()
+            return
+
+        try:
+            await self.serve_connection(reader, writer, peer=(host, port))
+        finally:
+            services.release_connection(host)
+
+    async def read_next_request(self, reader: StreamReader, writer: StreamWriter, peer: Peer) -> HttpRequest | None:
+        """
+        Read the next request of a keep-alive connection. None means the connection has to be closed:
+        the peer closed it, stayed silent for the keep-alive timeout or sent a bad request, which is answered here.
+        """
+        host, port = peer
+        try:
+            return await asyncio.wait_for(
+                read_request(reader, HTTP_MAX_BODY_SIZE),
+                timeout=HTTP_KEEPALIVE_TIMEOUT_SECONDS,
+            )
+        except HttpError as err:
+            self._logger.info("Bad HTTP request from %s:%s: %s" % (host, port, err))
+            self.write_error(writer, err, keep_alive=False)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        return None
+
+    async def respond(self, request: HttpRequest, writer: StreamWriter, peer: Peer) -> bool:
+        """Handle the request and write the response. Returns False if the connection is lost"""
+        host, port = peer
+        try:
+            await self.handle_request(request, writer, peer)
+            await writer.drain()
+        except HttpError as err:
+            self.write_error(writer, err, keep_alive=request.keep_alive)
+        except ConnectionError as err:
+            self._logger.info("HTTP connection %s:%s is lost: %s" % (host, port, err))
+            return False
+        except TimeoutError:
+            self._logger.warning("HTTP connection %s:%s does not read the response" % (host, port))
+            writer.transport.abort()
+            return False
+        return True
+
+    async def serve_connection(self, reader: StreamReader, writer: StreamWriter, peer: Peer) -> None:
+        """
+        Serve keep-alive connection. Pipelined requests are read one by one from the reader buffer
+        and answered in order, a response is written before the next request is read.
+        """
+        host, port = peer
+        try:
+            while True:
+                request = await self.read_next_request(reader, writer, peer)
+                if request is None or not await self.respond(request, writer, peer) or not request.keep_alive:
+                    break
+        except Exception as err:
+            # An unexpected error must not leave the connection open and unserved
+            self._logger.exception("Failed to serve HTTP connection %s:%s: %s" % (host, port, err))
+        finally:
+            if not writer.is_closing():
+                writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def reap_idle_sessions(self) -> None:
+        """Close sessions without requests and waiting streams, their users become offline as after a disconnect"""
+        interval = max(HTTP_SESSION_IDLE_SECONDS / 2, 1)
+        while True:
+            await asyncio.sleep(interval)
+            deadline = time.monotonic() - HTTP_SESSION_IDLE_SECONDS
+            for token, session in list(self._sessions.items()):
+                if session.streams == 0 and session.last_seen_at < deadline:
+                    self._close_session(token)
+
+    async def serve(self, host: str, port: int, reuse_port: bool = False) -> None:
+        reaper = asyncio.create_task(self.reap_idle_sessions())
+        srv = await asyncio.start_server(
+            self.entrypoint,
+            host=host,
+            port=port,
+            limit=MAX_FRAME_SIZE,
+            reuse_port=reuse_port,
+        )
+        self._logger.info("HTTP front end is running on http://%s:%s" % (host, port))
+        try:
+            async with srv:
+                await srv.serve_forever()
+        finally:
+            reaper.cancel()
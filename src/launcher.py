@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+import sys
+from pathlib import Path
+
+from config import SERVER_HOST, SERVER_PORT, STORAGE_BACKEND, CLUSTER_WORKERS, CLUSTER_BROKER_PATH
+from core.cluster import Broker
+from server import create_server
+
+logger = logging.getLogger("Launcher")
+
+
+def run_broker(path: Path) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(Broker(path).run())
+
+
+def run_worker(worker_id: int, host: str, port: int, broker_path: Path) -> None:
+    server = create_server(host=host, port=port, reuse_port=True, worker_id=worker_id, broker_path=broker_path)
+    asyncio.run(server.run())
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run chat server workers which share one port")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=CLUSTER_WORKERS)
+    parser.add_argument("--broker-path", type=Path, default=CLUSTER_BROKER_PATH)
+    return parser.parse_args()
+
+
+def main() -> None:
+    arguments = parse_arguments()
+    if STORAGE_BACKEND != "memory":
+        logger.error("Cluster supports only the memory storage backend")
+        sys.exit(1)
+
+    broker = multiprocessing.Process(target=run_broker, args=(arguments.broker_path,), name="broker")
+    broker.start()
+    workers = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(worker_id, arguments.host, arguments.port, arguments.broker_path),
+            name="worker-%s" % worker_id,
+        )
+        for worker_id in range(arguments.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info("Started %s workers on %s:%s" % (len(workers), arguments.host, arguments.port))
+
+    def stop(*_) -> None:
+        for worker in workers:
+            worker.terminate()
+
+    # Ctrl+C reaches the whole process group, so workers stop by themselves on SIGINT
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+    for worker in workers:
+        worker.join()
+    broker.terminate()
+    broker.join()
+    logger.info("Cluster is stopped")
+
+
+if __name__ == "__main__":
+    main()
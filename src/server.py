@@ -3,33 +3,63 @@ import functools
 import logging
 import signal
 import sys
+import time
 import typing as tp
 from asyncio.streams import StreamReader, StreamWriter
 from dataclasses import dataclass, field
+from pathlib import Path
 
 import handlers
 import services
-from config import SERVER_PORT, SERVER_HOST
-from core import DummyDatabase
-from core.schemas import Command, User, Route
-from core.utils import prepare_message
+from config import (
+    SERVER_PORT,
+    SERVER_HOST,
+    MAX_FRAME_SIZE,
+    FRAME_DELIMITER,
+    HANDSHAKE_PREFIX,
+    HANDSHAKE_BINARY,
+    HANDSHAKE_COMPRESSION,
+    COMPRESSION_LEVEL,
+    COMPRESSION_MIN_SIZE,
+    FRAME_TOO_LARGE_MESSAGE_TEMPLATE,
+    ERROR_REQUEST_MESSAGE_TEMPLATE,
+    PERSISTENCE_ENABLED,
+    METRICS_PROMETHEUS_PORT,
+    METRICS_LOOP_LAG_INTERVAL_SECONDS,
+    HTTP_ENABLED,
+    HTTP_PORT,
+    KEEPALIVE_PONG,
+)
+from core import DummyDatabase, binary
+from core.compression import StreamCompressor
+from core.schemas import Command, Connection, User, Route, Message
+from core.utils import message_sequence
+from http_server import HttpServer
+from tasks import expiry_sweeper, idle_reaper, message_scheduler, chat_log, cluster_link, metrics
 
 
 @dataclass(eq=False, order=False)
 class Server:
     host: str = SERVER_HOST
     port: int = SERVER_PORT
+    # Cluster worker options. Workers share the port and are connected through the broker
+    reuse_port: bool = False
+    worker_id: int | None = None
+    broker_path: Path | None = None
     routes: tp.MutableSequence[Route] = field(init=False, repr=False, default_factory=list)
 
     _dummy_db: DummyDatabase = field(init=False, repr=False)
     _logger: logging.Logger = field(init=False, repr=False)
+    _background_tasks: list[asyncio.Task] = field(init=False, repr=False, default_factory=list)
 
     def __post_init__(self):
         self._dummy_db = DummyDatabase()
         self._logger = logging.getLogger(self.__class__.__name__)
 
     def _stop_server(self, loop: asyncio.AbstractEventLoop):
-        self._dummy_db.clear()
+        if chat_log.is_running:
+            chat_log.close()
+        self._dummy_db.close()
         self._logger.info("Closing server...")
         loop.stop()
         self._logger.info("Server is closed!")
@@ -44,66 +74,290 @@ class Server:
             self._logger.info("Execute default handler")
             return handlers.default
 
-    async def send_message_to_user(self, receiver: User, message: str) -> None:
-        message = prepare_message(message)
-        receiver.writer.write(message.encode())
-        await receiver.writer.drain()
+    async def send_message_to_user(self, receiver: User, message: str | Message) -> None:
+        await services.send_message_to_user(user=receiver, message=message)
 
-    async def close_connection(self, user: User) -> None:
-        if not user.writer.is_closing():
-            user.writer.close()
-            await user.writer.wait_closed()
+    async def close_connection(self, connection: Connection) -> None:
+        services.close_session(connection)
+        await services.stop_outbox_writer(connection)
+        writer = connection.writer
+        if writer is not None and not writer.is_closing():
+            writer.close()
+            await writer.wait_closed()
 
-    async def entrypoint(self, reader: StreamReader, writer: StreamWriter):
-        user = services.get_or_create_user(reader=reader, writer=writer)
+    @staticmethod
+    async def read_frame(reader: StreamReader) -> bytes:
+        """
+        Read one delimited request frame.
+        Frames that were pipelined in one write stay in the reader buffer until the next call.
+        An empty result means that the peer closed the connection.
+        """
+        try:
+            return await reader.readuntil(FRAME_DELIMITER)
+        except asyncio.IncompleteReadError as err:
+            return err.partial
+
+    @staticmethod
+    async def skip_frame(reader: StreamReader) -> None:
+        """Drop the rest of a frame which is longer than the reader limit"""
+        while True:
+            try:
+                await reader.readuntil(FRAME_DELIMITER)
+                return
+            except asyncio.LimitOverrunError as err:
+                await reader.readexactly(err.consumed)
+
+    async def read_request(self, connection: Connection, reader: StreamReader) -> bytes:
+        try:
+            return await self.read_frame(reader)
+        except asyncio.LimitOverrunError:
+            self._logger.info("%s sent too large request" % connection)
+            await services.send_message_to_connection(
+                connection=connection,
+                message=FRAME_TOO_LARGE_MESSAGE_TEMPLATE.format(max_size=MAX_FRAME_SIZE),
+            )
+            await self.skip_frame(reader)
+            return FRAME_DELIMITER
+
+    async def handle_request(self, connection: Connection, request: bytes) -> None:
+        try:
+            command = Command(request=request)
+        except UnicodeDecodeError:
+            self._logger.info("%s sent request which is not UTF-8 text" % connection)
+            await services.send_message_to_connection(connection=connection, message=ERROR_REQUEST_MESSAGE_TEMPLATE)
+            return
+
+        services.expect_request_body(connection, command)
+        if command.correlation_id is None:
+            await self.dispatch(connection, command)
+        else:
+            with services.reply_to(connection, command.correlation_id):
+                await self.dispatch(connection, command)
+            await services.send_reply_end(connection, command.correlation_id)
+        await services.discard_request_body(connection)
+
+    async def dispatch(self, connection: Connection, command: Command) -> None:
+        if command.name == KEEPALIVE_PONG:
+            # Pong only keeps the connection active, which the request itself has already done
+            return
+
+        user = connection.user
+        if user.is_banned:
+            self._logger.info("%s banned" % user)
+            await services.send_ban_message(connection)
+            return
+
+        if not connection.is_connected and command.name != "/connect":
+            self._logger.info("%s is not connected" % connection)
+            await services.send_not_connected_message(connection)
+            return
+
+        retry_after = services.consume_rate_limit(user, command.name)
+        if retry_after:
+            self._logger.info("%s exceeded %s rate limit" % (user, command.name))
+            await services.send_rate_limit_message(connection, command.name, retry_after)
+            return
+
+        handler = self.get_handler(command_name=command.name)
+        if not metrics.enabled:
+            await handler(connection, command)
+            return
+
+        started_at = time.perf_counter()
+        await handler(connection, command)
+        # Unknown commands share one label, so clients can not blow up the number of series
+        route = command.name if handler is not handlers.default else "default"
+        metrics.observe_request(route, time.perf_counter() - started_at)
+
+    async def handle_frame(self, connection: Connection, frame: binary.Frame) -> None:
+        try:
+            name, arguments = binary.frame_to_command(frame)
+        except ValueError as err:
+            self._logger.info("%s sent invalid frame: %s" % (connection, err))
+            # Empty command name goes to the default handler which replies with an error
+            name, arguments = "", []
+
+        command = Command.from_arguments(name, arguments)
+        services.expect_request_body(connection, command)
+        with services.reply_to(connection, frame.seq):
+            await self.dispatch(connection, command)
+        await services.send_reply_end(connection, frame.seq)
+        await services.discard_request_body(connection)
+
+    async def serve_text(self, connection: Connection, head: bytes = b"") -> None:
+        """Serve newline delimited text requests. Head is the start of the first request read by the handshake"""
+        # Only HTTP sessions have no stream, they are never served here
+        reader = connection.reader
+        assert reader is not None
         while True:
             try:
-                request = await reader.read(1024)
+                request = await self.read_request(connection, reader)
             except Exception as err:
                 self._logger.error(err)
                 break
 
+            request, head = head + request, b""
             if not request:
                 break
 
-            if user.is_banned or user.is_chating_blocked:
-                self._logger.info("%s banned or blocked" % user)
-                await services.send_block_or_ban_message(user)
+            connection.last_active_at = time.monotonic()
+            if metrics.enabled:
+                metrics.bytes_in += len(request)
+
+            if request.strip():
+                await self.handle_request(connection, request)
+
+    async def serve_binary(self, connection: Connection) -> None:
+        """Serve length-prefixed binary frames. Every request gets its reply frames and a REPLY_END frame"""
+        reader = connection.reader
+        assert reader is not None
+        while True:
+            try:
+                frame = await binary.read_frame(reader, MAX_FRAME_SIZE)
+            except binary.FrameTooLargeError as err:
+                self._logger.info("%s sent too large frame" % connection)
+                with services.reply_to(connection, err.seq):
+                    await services.send_message_to_connection(
+                        connection=connection,
+                        message=FRAME_TOO_LARGE_MESSAGE_TEMPLATE.format(max_size=MAX_FRAME_SIZE),
+                    )
+                await services.send_reply_end(connection, err.seq)
                 continue
+            except Exception as err:
+                self._logger.error(err)
+                break
 
-            command = Command(request=request)
-            if not user.is_connected and command.name != "/connect":
-                self._logger.info("%s is not connected" % user)
-                await services.send_not_connected_message(user)
+            if frame is None:
+                break
+
+            connection.last_active_at = time.monotonic()
+            if frame.opcode == binary.PONG:
                 continue
 
-            handler = self.get_handler(command_name=command.name)
-            await handler(user, command)
+            if metrics.enabled:
+                metrics.bytes_in += binary.FRAME_HEADER.size + len(frame.payload)
+
+            await self.handle_frame(connection, frame)
+
+    def apply_handshake(self, connection: Connection, options: int) -> None:
+        connection.is_binary = bool(options & HANDSHAKE_BINARY)
+        if options & HANDSHAKE_COMPRESSION:
+            connection.compressor = StreamCompressor(level=COMPRESSION_LEVEL, min_size=COMPRESSION_MIN_SIZE)
+        self._logger.info(
+            "%s handshake: binary %s, compression %s"
+            % (connection, connection.is_binary, connection.compressor is not None)
+        )
 
-        self._logger.info("Stop serving %s" % user)
-        await self.close_connection(user)
+    async def entrypoint(self, reader: StreamReader, writer: StreamWriter):
+        host = writer.get_extra_info("peername")[0]
+        reason = services.admit_connection(host)
+        if reason is not None:
+            services.reject_connection(writer, host, reason)
+            return
+
+        try:
+            await self.serve_connection(reader, writer)
+        finally:
+            services.release_connection(host)
+
+    async def serve_connection(self, reader: StreamReader, writer: StreamWriter):
+        connection = services.create_connection(reader=reader, writer=writer)
+        services.start_outbox_writer(connection)
+        try:
+            # The first byte is either the handshake with protocol options or the start of the first text request
+            try:
+                head = await reader.read(1)
+            except ConnectionError as err:
+                self._logger.error(err)
+                head = b""
+
+            if head and head[0] & 0xF0 == HANDSHAKE_PREFIX:
+                self.apply_handshake(connection, options=head[0])
+                if connection.is_binary:
+                    await self.serve_binary(connection)
+                else:
+                    await self.serve_text(connection)
+            elif head:
+                await self.serve_text(connection, head=head)
+        finally:
+            # A failed request must not leave the connection attached to the user with a running outbox writer
+            self._logger.info("Stop serving %s of %s" % (connection, connection.user))
+            await self.close_connection(connection)
 
     async def run(self) -> None:
         loop = asyncio.get_event_loop()
         # Signal handlers
         for signal_ in (signal.SIGINT, signal.SIGTERM):
             loop.add_signal_handler(signal_, functools.partial(self._stop_server, loop=loop))
+        # Background tasks
+        services.restore_files()
+        if PERSISTENCE_ENABLED:
+            # Every worker restores the same state, but only the first one writes it.
+            # Scheduled messages of an earlier single process run are delivered by the first worker only
+            services.restore_state(with_scheduled=not self.worker_id)
+            if not self.worker_id:
+                self._background_tasks.append(loop.create_task(chat_log.run()))
+        if self.broker_path is not None:
+            cluster_state = await cluster_link.connect(
+                self.broker_path,
+                worker_id=self.worker_id or 0,
+                last_seq=message_sequence.last_seq,
+            )
+            # A worker which joins running workers takes their state instead of its own restored one
+            if cluster_state is not None:
+                services.restore_cluster_state(cluster_state)
+            self._background_tasks.append(loop.create_task(cluster_link.run(services.apply_cluster_event)))
+        self._background_tasks.append(loop.create_task(expiry_sweeper.run()))
+        self._background_tasks.append(loop.create_task(message_scheduler.run(services.deliver_scheduled_message)))
+        if idle_reaper.is_enabled:
+            self._background_tasks.append(
+                loop.create_task(idle_reaper.run(services.send_keepalive_ping, services.reap_idle_connection))
+            )
+        if metrics.enabled:
+            services.register_metrics_gauges()
+            self._background_tasks.append(
+                loop.create_task(metrics.run_loop_lag_monitor(METRICS_LOOP_LAG_INTERVAL_SECONDS))
+            )
+            if METRICS_PROMETHEUS_PORT:
+                metrics_port = METRICS_PROMETHEUS_PORT + (self.worker_id or 0)
+                self._background_tasks.append(loop.create_task(metrics.serve(self.host, metrics_port)))
+        if HTTP_ENABLED:
+            http_server = HttpServer(dispatch=self.dispatch)
+            self._background_tasks.append(
+                loop.create_task(http_server.serve(self.host, HTTP_PORT, reuse_port=self.reuse_port))
+            )
         # Run server
-        srv = await asyncio.start_server(self.entrypoint, host=self.host, port=self.port)
+        srv = await asyncio.start_server(
+            self.entrypoint,
+            host=self.host,
+            port=self.port,
+            limit=MAX_FRAME_SIZE,
+            reuse_port=self.reuse_port,
+        )
         self._logger.info("Server is running on %s:%s" % (self.host, self.port))
         async with srv:
             await srv.serve_forever()
 
 
-async def main() -> None:
-    server = Server(host="127.0.0.1", port=8000)
+def create_server(**kwargs: tp.Any) -> Server:
+    server = Server(**kwargs)
     server.routes = [
         Route(name="/connect", handler=handlers.connect),
         Route(name="/disconnect", handler=handlers.disconnect),
         Route(name="/status", handler=handlers.status),
         Route(name="/report", handler=handlers.report),
         Route(name="/send", handler=handlers.send),
+        Route(name="/cancel", handler=handlers.cancel),
+        Route(name="/room", handler=handlers.room),
+        Route(name="/metrics", handler=handlers.metrics),
+        Route(name="/upload", handler=handlers.upload),
+        Route(name="/download", handler=handlers.download),
     ]
+    return server
+
+
+async def main() -> None:
+    server = create_server(host="127.0.0.1", port=8000)
     await server.run()
 
 
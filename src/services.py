@@ -1,135 +1,1121 @@
 import asyncio
-import hashlib
+import contextlib
+import contextvars
+import heapq
 import logging
+import time
+import typing as tp
 from asyncio import StreamWriter, StreamReader
+from datetime import datetime, time as day_time, timedelta
 
 from config import (
     SHOW_LAST_MESSAGES_COUNT,
     MAX_REPORTS_COUNT,
-    CHATING_BLOCK_LIFETIME_SECONDS,
     BAN_MESSAGE_TEMPLATE,
-    BLOCK_CHATING_MESSAGE_TEMPLATE,
+    RATE_LIMIT_MESSAGE_TEMPLATE,
     BAN_LIFETIME_SECONDS,
-    MESSAGE_LIFETIME_SECONDS,
     NOT_CONNECTED_MESSAGE_TEMPLATE,
     NO_MESSAGE_TEMPLATE,
+    REPLAY_CHUNK_SIZE_BYTES,
+    STATUS_PAGE_SIZE,
+    STATUS_MAX_PAGE_SIZE,
+    STATUS_SUMMARY_MESSAGE_TEMPLATE,
+    RATE_LIMITS,
+    CORRELATION_PREFIX,
+    MISSED_MESSAGES_MESSAGE_TEMPLATE,
+    SLOW_CONSUMER_OVERFLOW_POLICY,
+    SLOW_CONSUMER_WRITE_HIGH_WATERMARK,
+    SLOW_CONSUMER_WRITE_LOW_WATERMARK,
+    SLOW_CONSUMER_DRAIN_TIMEOUT_SECONDS,
+    SERVER_FULL_MESSAGE_TEMPLATE,
+    TOO_MANY_CONNECTIONS_MESSAGE_TEMPLATE,
+    KEEPALIVE_PING_MESSAGE,
+    ADMISSION_MAX_CONNECTIONS,
+    ADMISSION_MAX_CONNECTIONS_PER_IP,
+    FILE_HEADER_MESSAGE_TEMPLATE,
+    FILES_CHUNK_SIZE,
+    FILES_MAX_SIZE,
+    FILE_UPLOADED_MESSAGE_TEMPLATE,
+    FILE_TOO_LARGE_MESSAGE_TEMPLATE,
+    USER_NO_FOUND_MESSAGE_TEMPLATE,
+    ERROR_REQUEST_MESSAGE_TEMPLATE,
 )
-from core import DummyDatabase
-from core.schemas import User, Message
+from core import DummyDatabase, binary
+from core.admission import SERVER_FULL, AdmissionControl
+from core.compression import COMPRESSION_HEADER
+from core.files import FileTooLargeError
+from core.cluster import (
+    USER_EVENT,
+    ATTACH_EVENT,
+    DETACH_EVENT,
+    MESSAGE_EVENT,
+    REPORT_EVENT,
+    LIMIT_EVENT,
+    PURGE_EVENT,
+    SNAPSHOT_REQUEST_EVENT,
+    SNAPSHOT_EVENT,
+)
+from core.persistence import message_to_record
+from core.rate_limit import RateLimiter
+from core.schemas import Command, User, Connection, Message, Page, Room, ScheduledMessage, StoredFile
 from core.utils import get_now_with_delta, prepare_message
-from tasks import remove_user_chating_block, remove_user_ban, remove_expired_message
+from tasks import expiry_sweeper, idle_reaper, message_scheduler, chat_log, cluster_link, metrics, remove_session
 
 logger = logging.getLogger(__name__)
 
 dummy_db = DummyDatabase()
+rate_limiter = RateLimiter(RATE_LIMITS)
+admission = AdmissionControl(ADMISSION_MAX_CONNECTIONS, ADMISSION_MAX_CONNECTIONS_PER_IP)
 
+ReplySink = tp.Callable[[bytes], tp.Awaitable[None]]
 
-async def send_message_to_user(user: User, message: str) -> None:
-    message = prepare_message(message)
-    user.writer.write(message.encode())
-    await user.writer.drain()
 
+class UploadResult(tp.NamedTuple):
+    """Stored file is None if the upload failed. Reply is None if there is nobody to reply to"""
 
-async def send_block_or_ban_message(user: User) -> None:
-    if user.is_banned:
-        await send_message_to_user(
-            user=user,
-            message=BAN_MESSAGE_TEMPLATE.format(banned_to=user.banned_to),
-        )
-    elif user.is_chating_blocked:
-        await send_message_to_user(
-            user=user,
-            message=BLOCK_CHATING_MESSAGE_TEMPLATE.format(block_to=user.chating_blocked_to),
-        )
+    stored_file: StoredFile | None
+    receiver: User | None
+    reply: str | None
 
 
-async def send_not_connected_message(user: User) -> None:
-    if not user.is_connected:
-        await send_message_to_user(user=user, message=NOT_CONNECTED_MESSAGE_TEMPLATE)
+class _ReplyContext(tp.NamedTuple):
+    connection: Connection
+    # Prefix of every reply line, e.g. the correlation id
+    prefix: bytes = b""
+    # Request id of the binary protocol request. Reply frames are flagged and text frames echo the id
+    request_seq: int | None = None
+    # Replies go to the sink instead of the connection outbox, e.g. into an HTTP response
+    sink: ReplySink | None = None
 
 
-def create_user_id_by_peer_name(peer_name: tuple[str, int]) -> str:
-    peer_name_to_bytes = str(peer_name).encode()
-    user_id = hashlib.md5(peer_name_to_bytes).hexdigest()
-    return user_id
+# Replies to the request which is handled in the current task
+_reply_context: contextvars.ContextVar[_ReplyContext | None] = contextvars.ContextVar("reply_context", default=None)
 
+# Connections which sent messages to the broker and wait for them to come back. Keyed by message id
+_origin_connections: dict[str, Connection] = {}
 
-def get_or_create_user(*, reader: StreamReader, writer: StreamWriter) -> User:
-    peer_name = writer.get_extra_info("peername")
-    logger.info("Create user id by peername (%s)" % str(peer_name))
-    user_id = create_user_id_by_peer_name(peer_name)
-    logger.info("Check user in db")
-    user = dummy_db.users.get_by_id(idx=user_id)
-    if not user:
-        logger.info("Create new user")
-        user = User(
-            idx=user_id,
-            host=peer_name[0],
-            port=peer_name[1],
-            reader=reader,
-            writer=writer,
-        )
+
+def _get_reply_context(connection: Connection) -> _ReplyContext | None:
+    context = _reply_context.get()
+    if context is not None and context.connection is connection:
+        return context
+    return None
+
+
+def _is_evicted(connection: Connection) -> bool:
+    return connection.writer is not None and connection.writer.is_closing()
+
+
+async def _put_reply(connection: Connection, data: bytes, context: _ReplyContext | None) -> None:
+    if context is not None and context.sink is not None:
+        await context.sink(data)
+    elif not _is_evicted(connection):
+        # Replies wait for room in the outbox, so a slow consumer slows down only its own requests
+        await connection.outbox.put(data)
+
+
+@contextlib.contextmanager
+def reply_to(connection: Connection, correlation_id: str | int) -> tp.Iterator[None]:
+    """
+    Replies to connection which are sent inside the block are marked with the correlation id:
+    text lines get the "#<id> " prefix, binary frames get the reply flag.
+    """
+    if connection.is_binary:
+        context = _ReplyContext(connection, request_seq=int(correlation_id))
+    else:
+        context = _ReplyContext(connection, prefix=("%s%s " % (CORRELATION_PREFIX, correlation_id)).encode())
+    token = _reply_context.set(context)
+    try:
+        yield
+    finally:
+        _reply_context.reset(token)
+
+
+@contextlib.contextmanager
+def capture_replies(connection: Connection, sink: ReplySink) -> tp.Iterator[None]:
+    """Replies to connection which are sent inside the block are passed to sink instead of the connection outbox"""
+    token = _reply_context.set(_ReplyContext(connection, sink=sink))
+    try:
+        yield
+    finally:
+        _reply_context.reset(token)
+
+
+async def send_reply_end(connection: Connection, correlation_id: str | int) -> None:
+    if connection.is_binary:
+        data = binary.encode_frame(binary.REPLY_END, seq=int(correlation_id))
+    else:
+        data = prepare_message("%s%s" % (CORRELATION_PREFIX, correlation_id)).encode()
+    await _put_reply(connection, data, None)
+
+
+def _encode_message(connection: Connection, message: Message, context: _ReplyContext | None) -> bytes:
+    if connection.is_binary:
+        if context is not None and context.request_seq is not None:
+            return message.binary_frame(binary.FLAG_REPLY)
+        return message.binary_wire
+    if context is not None and context.prefix:
+        return context.prefix + message.wire
+    return message.wire
+
+
+def _encode_text(connection: Connection, text: str, context: _ReplyContext | None) -> bytes:
+    if connection.is_binary:
+        payload = text.rstrip().encode()
+        if context is not None and context.request_seq is not None:
+            return binary.encode_frame(binary.TEXT, payload, seq=context.request_seq, flags=binary.FLAG_REPLY)
+        return binary.encode_frame(binary.TEXT, payload)
+
+    data = prepare_message(text).encode()
+    if context is not None and context.prefix:
+        return b"".join(context.prefix + line for line in data.splitlines(keepends=True))
+    return data
+
+
+async def send_message_to_connection(connection: Connection, message: str | Message) -> None:
+    context = _get_reply_context(connection)
+    if isinstance(message, Message):
+        data = _encode_message(connection, message, context)
+        connection.user.last_seq = max(connection.user.last_seq, message.seq)
+    else:
+        data = _encode_text(connection, message, context)
+    await _put_reply(connection, data, context)
+
+
+async def send_message_to_user(user: User, message: str | Message) -> None:
+    for connection in user.get_connected():
+        await send_message_to_connection(connection, message)
+
+
+async def send_messages_to_connection(connection: Connection, messages: tp.Iterable[Message]) -> None:
+    """
+    Replay messages to connection with a few large writes instead of a write and a drain per message.
+    Messages are joined into chunks of REPLAY_CHUNK_SIZE_BYTES and the loop is released between chunks,
+    so a long replay does not starve other connections.
+    """
+    user = connection.user
+    context = _get_reply_context(connection)
+    chunk: list[bytes] = []
+    chunk_size = 0
+    for message in messages:
+        data = _encode_message(connection, message, context)
+        chunk.append(data)
+        chunk_size += len(data)
+        user.last_seq = max(user.last_seq, message.seq)
+        if chunk_size >= REPLAY_CHUNK_SIZE_BYTES:
+            await _put_reply(connection, b"".join(chunk), context)
+            chunk, chunk_size = [], 0
+            await asyncio.sleep(0)
+
+    if chunk:
+        await _put_reply(connection, b"".join(chunk), context)
+
+
+def evict_connection(connection: Connection, reason: str) -> None:
+    """
+    Close connection of a slow consumer right away. Queued writes and the transport buffer are dropped,
+    the connection handler sees the closed stream and closes the session as usual.
+    """
+    logger.warning("Evict %s of %s: %s" % (connection, connection.user, reason))
+    connection.is_connected = False
+    connection.outbox.clear()
+    if connection.writer is not None:
+        connection.writer.transport.abort()
+    else:
+        close_session(connection)
+
+
+def enqueue_missed_notice(connection: Connection) -> None:
+    """The notice about skipped pushes takes their place in the outbox as soon as there is room"""
+    if connection.missed_count and not connection.outbox.full():
+        notice = MISSED_MESSAGES_MESSAGE_TEMPLATE.format(count=connection.missed_count)
+        connection.outbox.put_nowait(_encode_text(connection, notice, None))
+        connection.missed_count = 0
+
+
+def enqueue_to_connection(connection: Connection, data: bytes) -> bool:
+    """Enqueue push without waiting. Full outbox of a slow consumer is handled by SLOW_CONSUMER_OVERFLOW_POLICY"""
+    outbox = connection.outbox
+    enqueue_missed_notice(connection)
+    if not outbox.full():
+        outbox.put_nowait(data)
+        return True
+
+    policy = SLOW_CONSUMER_OVERFLOW_POLICY
+    if metrics.enabled:
+        metrics.slow_consumer_events[policy] += 1
+
+    if policy == "drop_oldest":
+        dropped = 0
+        while outbox.full() and not outbox.empty():
+            outbox.get_nowait()
+            dropped += 1
+        logger.debug("%s outbox of %s is full. Drop %s oldest writes" % (connection, connection.user, dropped))
+        outbox.put_nowait(data)
+        return True
+
+    if policy == "coalesce":
+        connection.missed_count += 1
+        return False
+
+    evict_connection(connection, "outbox is full")
+    return False
+
+
+def publish_message(message: Message, origin: Connection | None = None) -> int:
+    """
+    Enqueue message to every receiver connection except the one it was sent from.
+    Private messages go to the receiver and to the other connections of the sender, room messages to room members.
+    """
+    if message.receiver is not None:
+        receivers = [message.receiver]
+        if message.sender is not message.receiver:
+            receivers.append(message.sender)
+    elif message.room is not None:
+        receivers = [user for user in map(dummy_db.users.get_by_id, message.room.members) if user is not None]
+    else:
+        receivers = dummy_db.users.get_connected()
+
+    receivers_count = 0
+    for user in receivers:
+        delivered = False
+        for connection in user.get_connected():
+            if connection is origin:
+                continue
+            data = message.binary_wire if connection.is_binary else message.wire
+            if enqueue_to_connection(connection, data):
+                delivered = True
+        if delivered:
+            user.last_seq = max(user.last_seq, message.seq)
+            receivers_count += 1
+    return receivers_count
+
+
+async def write_connection_outbox(connection: Connection) -> None:
+    writer = connection.writer
+    if writer is None:
+        return
+    while not writer.is_closing():
+        chunks = [await connection.outbox.get()]
+        while not connection.outbox.empty():
+            chunks.append(connection.outbox.get_nowait())
+        if connection.compressor is not None:
+            # The whole batch is one frame, so a replay or a burst of messages shares one deflate flush
+            chunks = list(connection.compressor.encode(b"".join(chunks)))
+        writer.writelines(chunks)
+        started_at = time.perf_counter() if metrics.enabled else 0.0
+        try:
+            # Drain waits only while the transport buffer is above the high watermark
+            async with asyncio.timeout(SLOW_CONSUMER_DRAIN_TIMEOUT_SECONDS):
+                await writer.drain()
+        except ConnectionError as err:
+            logger.error("Stop writing to %s: %s" % (connection, err))
+            break
+        except TimeoutError:
+            if metrics.enabled:
+                metrics.slow_consumer_events["drain_timeout"] += 1
+            evict_connection(connection, "write is not drained in %s seconds" % SLOW_CONSUMER_DRAIN_TIMEOUT_SECONDS)
+            break
+        enqueue_missed_notice(connection)
+        if metrics.enabled:
+            metrics.observe_write(sum(len(chunk) for chunk in chunks), time.perf_counter() - started_at)
+
+
+def start_outbox_writer(connection: Connection) -> None:
+    if connection.outbox_writer is None:
+        connection.outbox_writer = asyncio.create_task(write_connection_outbox(connection))
+
+
+async def stop_outbox_writer(connection: Connection) -> None:
+    task = connection.outbox_writer
+    if task is None:
+        return
+
+    connection.outbox_writer = None
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+
+async def send_ban_message(connection: Connection) -> None:
+    await send_message_to_connection(
+        connection=connection,
+        message=BAN_MESSAGE_TEMPLATE.format(banned_to=connection.user.banned_to),
+    )
+
+
+def consume_rate_limit(user: User, command_name: str) -> float:
+    """Returns 0 if the command is allowed, otherwise seconds until it is allowed again"""
+    retry_after = rate_limiter.consume(user, command_name)
+    # Other workers take the token too, so the user has one bucket on the whole cluster
+    if not retry_after and command_name in RATE_LIMITS and cluster_link.is_connected:
+        cluster_link.publish(LIMIT_EVENT, {"id": user.idx, "command": command_name, "worker": cluster_link.worker_id})
+    return retry_after
+
+
+async def send_rate_limit_message(connection: Connection, command_name: str, retry_after: float) -> None:
+    await send_message_to_connection(
+        connection=connection,
+        message=RATE_LIMIT_MESSAGE_TEMPLATE.format(command=command_name, retry_after=retry_after),
+    )
+
+
+async def send_not_connected_message(connection: Connection) -> None:
+    if not connection.is_connected:
+        await send_message_to_connection(connection=connection, message=NOT_CONNECTED_MESSAGE_TEMPLATE)
+
+
+def admit_connection(host: str) -> str | None:
+    """Count a new connection of host. Returns None if it is admitted, otherwise the rejection reason"""
+    reason = admission.admit(host)
+    if reason is not None and metrics.enabled:
+        metrics.connection_events["rejected_%s" % reason] += 1
+    return reason
+
+
+def release_connection(host: str) -> None:
+    admission.release(host)
+
+
+def get_rejection_message(host: str, reason: str) -> str:
+    if reason == SERVER_FULL:
+        return SERVER_FULL_MESSAGE_TEMPLATE
+    return TOO_MANY_CONNECTIONS_MESSAGE_TEMPLATE.format(host=host)
+
+
+def reject_connection(writer: StreamWriter, host: str, reason: str) -> None:
+    """Rejected connection gets one line and is closed without reading anything from it"""
+    logger.info("Reject connection from %s: %s" % (host, reason))
+    writer.write(prepare_message(get_rejection_message(host, reason)).encode())
+    writer.close()
+
+
+def send_keepalive_ping(connection: Connection) -> None:
+    """Ping a quiet connection. Connection with queued writes is receiving anyway, so it is not pinged"""
+    if not connection.outbox.empty():
+        return
+    if connection.is_binary:
+        data = binary.encode_frame(binary.PING)
+    else:
+        data = prepare_message(KEEPALIVE_PING_MESSAGE).encode()
+    connection.outbox.put_nowait(data)
+    if metrics.enabled:
+        metrics.connection_events["pinged"] += 1
+
+
+def _get_session_deadline(user: User) -> str | None:
+    """Session expiry deadline in cluster events. Workers compare it to tell whether an event is stale"""
+    return user.session_expires_at.isoformat() if user.session_expires_at is not None else None
+
+
+def purge_user(user: User) -> None:
+    """Delete the session of user without connections right away instead of keeping it until it expires"""
+    if user.connections or user.remote_connections_count or dummy_db.users.get_by_id(user.idx) is not user:
+        return
+    if cluster_link.is_connected:
+        # Every worker purges the user when the broker sends the event back
+        cluster_link.publish(PURGE_EVENT, {"id": user.idx, "expires_at": _get_session_deadline(user)})
+        return
+
+    remove_session(user)
+    logger.info("Purge %s" % user)
+
+
+def reap_idle_connection(connection: Connection) -> None:
+    """Close connection which sent nothing, not even a keepalive pong, for the idle timeout"""
+    logger.info("Reap idle %s of %s" % (connection, connection.user))
+    if metrics.enabled:
+        metrics.connection_events["reaped"] += 1
+    close_session(connection)
+    purge_user(connection.user)
+    if connection.writer is not None:
+        connection.writer.transport.abort()
+
+
+def create_connection(*, reader: StreamReader, writer: StreamWriter) -> Connection:
+    """
+    Create connection with a new anonymous user.
+    The user is stored only after /connect, so connections which never connect do not leak into the storage.
+    """
+    host, port, *_ = writer.get_extra_info("peername")
+    writer.transport.set_write_buffer_limits(
+        high=SLOW_CONSUMER_WRITE_HIGH_WATERMARK,
+        low=SLOW_CONSUMER_WRITE_LOW_WATERMARK,
+    )
+    connection = Connection(host=host, port=port, reader=reader, writer=writer, user=User())
+    idle_reaper.track(connection)
+    logger.info("New %s of %s" % (connection, connection.user))
+    return connection
+
+
+def create_http_connection(*, host: str, port: int) -> Connection:
+    """
+    Create connection of an HTTP session. It is not bound to a TCP stream: requests come over any keep-alive
+    connection with the session token and pushed messages wait in the outbox until they are polled or streamed.
+    """
+    connection = Connection(host=host, port=port, reader=None, writer=None, user=User())
+    logger.info("New HTTP %s of %s" % (connection, connection.user))
+    return connection
+
+
+def start_session(connection: Connection, token: str | None = None) -> User | None:
+    """
+    Attach connection to the session user.
+    Without token the connection user starts a new session, otherwise the session is looked up by token.
+    """
+    if token is None:
+        user = connection.user
         dummy_db.users.add(user)
+        if cluster_link.is_connected:
+            cluster_link.publish(USER_EVENT, user.to_state())
+    else:
+        session_user = dummy_db.users.get_by_token(token)
+        if session_user is None:
+            return None
+        user = connection.user = session_user
+        # A session loaded from SQLite after restart brings its ban, but its expiry is not scheduled yet
+        if user.is_banned and not user.connections:
+            expiry_sweeper.schedule_ban(user)
+
+    user.session_expires_at = None
+    if connection not in user.connections:
+        user.connections.append(connection)
+        if cluster_link.is_connected:
+            # The state lets other workers restore the session if they have just purged it
+            cluster_link.publish(
+                ATTACH_EVENT,
+                {"id": user.idx, "worker": cluster_link.worker_id, "state": user.to_state()},
+            )
+    connection.is_connected = True
     return user
 
 
-async def send_start_message(*, user_to: User) -> None:
-    last_status_request = user_to.last_status_request_at
-    if last_status_request:
-        logger.info("Get last messages from %s" % last_status_request)
-        last_messages = dummy_db.messages.get_all_from_date(date_filter=last_status_request)
+def close_session(connection: Connection) -> None:
+    """Detach closed connection from user. The session of user without connections expires after a while"""
+    user = connection.user
+    connection.is_connected = False
+    if connection in user.connections:
+        user.connections.remove(connection)
+        if not user.connections:
+            dummy_db.users.save(user)
+            expiry_sweeper.schedule_session_expiry(user)
+        if cluster_link.is_connected:
+            cluster_link.publish(
+                DETACH_EVENT,
+                {
+                    "id": user.idx,
+                    "worker": cluster_link.worker_id,
+                    "last_seq": user.last_seq,
+                    "expires_at": _get_session_deadline(user),
+                },
+            )
+
+
+def parse_upload(arguments: tp.Sequence[str]) -> tuple[str | None, int, str]:
+    """Parse "[@<user_id>] <size> [name]" upload arguments into receiver id, size and name. Raises ValueError"""
+    arguments = list(arguments)
+    receiver_id = arguments.pop(0)[1:] if arguments and arguments[0].startswith("@") else None
+    if not arguments or not arguments[0].isdigit():
+        raise ValueError("Upload size is missing")
+    size = int(arguments.pop(0))
+    # The name is shown in chat lines, so it is kept to one short line
+    name = " ".join(" ".join(arguments).split())[:255] or "file"
+    return receiver_id, size, name
+
+
+def expect_request_body(connection: Connection, command: Command) -> None:
+    """Upload request is followed by its body on the stream. The body is read by the handler or discarded after it"""
+    connection.request_body_size = 0
+    if command.name == "/upload" and connection.reader is not None:
+        with contextlib.suppress(ValueError):
+            connection.request_body_size = parse_upload(command.arguments)[1]
+
+
+async def read_request_body(connection: Connection) -> tp.AsyncIterator[bytes]:
+    """Chunks of the request body. Raises asyncio.IncompleteReadError if the peer closes the connection"""
+    reader = connection.reader
+    while reader is not None and connection.request_body_size > 0:
+        chunk = await reader.readexactly(min(connection.request_body_size, FILES_CHUNK_SIZE))
+        connection.request_body_size -= len(chunk)
+        # A long upload keeps the connection active for the idle reaper
+        connection.last_active_at = time.monotonic()
+        if metrics.enabled:
+            metrics.bytes_in += len(chunk)
+        yield chunk
+
+
+async def discard_request_body(connection: Connection) -> None:
+    """Skip the body which the request handler did not read, e.g. of a rejected upload, to reach the next request"""
+    if connection.request_body_size <= 0:
+        return
+    logger.info("Skip %s bytes of request body from %s" % (connection.request_body_size, connection))
+    with contextlib.suppress(asyncio.IncompleteReadError, ConnectionError):
+        async for _ in read_request_body(connection):
+            pass
+    connection.request_body_size = 0
+
+
+def can_transfer_files(connection: Connection) -> bool:
+    """Files are streamed over the connection itself, HTTP sessions are not bound to a stream"""
+    return connection.reader is not None and connection.writer is not None
+
+
+async def receive_file(connection: Connection, name: str, receiver: User | None = None) -> StoredFile:
+    """Stream the upload body into the file spool. Raises FileTooLargeError, OSError, asyncio.IncompleteReadError"""
+    stored_file = await dummy_db.files.receive(
+        read_request_body(connection),
+        name=name,
+        owner_id=connection.user.idx,
+        receiver_id=receiver.idx if receiver is not None else None,
+    )
+    expiry_sweeper.notify_file(stored_file)
+    return stored_file
+
+
+async def receive_upload(connection: Connection, receiver_id: str | None, size: int, name: str) -> UploadResult:
+    """Check the upload request and store the file. Errors are mapped to the reply of the request"""
+    receiver = None
+    if receiver_id is not None:
+        receiver = dummy_db.users.get_by_id(receiver_id)
+        if receiver is None:
+            return UploadResult(None, None, USER_NO_FOUND_MESSAGE_TEMPLATE.format(user_id=receiver_id))
+
+    if size > FILES_MAX_SIZE:
+        return UploadResult(None, receiver, FILE_TOO_LARGE_MESSAGE_TEMPLATE.format(max_size=FILES_MAX_SIZE))
+
+    try:
+        stored_file = await receive_file(connection, name=name, receiver=receiver)
+    except asyncio.IncompleteReadError:
+        logger.info("%s closed connection during upload" % connection)
+        return UploadResult(None, receiver, None)
+    except FileTooLargeError as err:
+        return UploadResult(None, receiver, FILE_TOO_LARGE_MESSAGE_TEMPLATE.format(max_size=err.max_size))
+    except OSError as err:
+        logger.error("Failed to store upload of %s: %s" % (connection.user, err))
+        return UploadResult(None, receiver, ERROR_REQUEST_MESSAGE_TEMPLATE)
+
+    logger.info("%s uploaded %s (%s bytes)" % (connection.user, stored_file, stored_file.size))
+    reply = FILE_UPLOADED_MESSAGE_TEMPLATE.format(file_id=stored_file.idx, sha256=stored_file.sha256)
+    return UploadResult(stored_file, receiver, reply)
+
+
+def get_file(user: User, file_id: str) -> StoredFile | None:
+    stored_file = dummy_db.files.get_by_id(file_id)
+    if stored_file is None or not stored_file.is_available_to(user):
+        return None
+    return stored_file
+
+
+async def send_file(connection: Connection, stored_file: StoredFile) -> None:
+    """
+    Send the file header line and then the file content with loop.sendfile, straight from the page cache
+    to the socket without copying it through Python. The outbox writer is paused for the transfer:
+    writes queued before the download go first, pushes which come during it wait in the outbox.
+    Raises OSError if the file is gone or the connection is lost.
+    """
+    writer = connection.writer
+    if writer is None:
+        raise ConnectionError("%s is not bound to a stream" % connection)
+
+    file = await asyncio.to_thread(dummy_db.files.get_path(stored_file).open, "rb")
+    context = _get_reply_context(connection)
+    header = FILE_HEADER_MESSAGE_TEMPLATE.format(
+        file_id=stored_file.idx,
+        size=stored_file.size,
+        sha256=stored_file.sha256,
+        name=stored_file.name,
+    )
+    await stop_outbox_writer(connection)
+    try:
+        with file:
+            chunks = []
+            while not connection.outbox.empty():
+                chunks.append(connection.outbox.get_nowait())
+            chunks.append(_encode_text(connection, header, context))
+
+            # Binary protocol sends the content as a FILE frame, its header is written before the content
+            content_prefix = b""
+            if connection.is_binary:
+                request_seq = context.request_seq if context is not None else None
+                content_prefix = binary.FRAME_HEADER.pack(
+                    stored_file.size,
+                    binary.FILE,
+                    binary.FLAG_REPLY if request_seq is not None else 0,
+                    request_seq or 0,
+                    binary.encode_user_id(stored_file.owner_id),
+                )
+
+            data = b"".join(chunks)
+            if connection.compressor is not None:
+                # The content goes as one uncompressed frame: deflate would need to copy it through Python
+                data = b"".join(connection.compressor.encode(data))
+                data += COMPRESSION_HEADER.pack(len(content_prefix) + stored_file.size)
+            writer.writelines((data, content_prefix))
+            await asyncio.get_running_loop().sendfile(writer.transport, file, count=stored_file.size)
+        if metrics.enabled:
+            metrics.bytes_out += len(data) + len(content_prefix) + stored_file.size
+    finally:
+        start_outbox_writer(connection)
+
+
+def restore_files() -> None:
+    dummy_db.files.load()
+    first_file = dummy_db.files.get_first()
+    if first_file is not None:
+        expiry_sweeper.notify_file(first_file)
+
+
+def restore_state(with_scheduled: bool = True) -> None:
+    """Load persisted users and messages and schedule their pending deadlines"""
+    for user in chat_log.load(with_scheduled=with_scheduled):
+        if user.is_banned:
+            expiry_sweeper.schedule_ban(user)
+        expiry_sweeper.schedule_session_expiry(user)
+
+
+def _merge_by_seq(*messages: list[Message]) -> list[Message]:
+    return list(heapq.merge(*messages, key=lambda message: message.seq))
+
+
+async def send_start_message(*, connection_to: Connection) -> None:
+    user = connection_to.user
+    # Unread messages are replayed only when no other user connection has been receiving them
+    rooms = dummy_db.rooms.get_user_rooms(user.idx)
+    if user.last_seq and len(user.get_connected()) == 1:
+        logger.info("Get unread messages after %s for %s" % (user.last_seq, user))
+        last_messages = _merge_by_seq(
+            dummy_db.messages.get_after(user.last_seq),
+            dummy_db.inboxes.get_after(user.idx, user.last_seq),
+            *(dummy_db.rooms.get_after(room.idx, user.last_seq) for room in rooms),
+        )
     else:
         logger.info("Get last %s messages" % SHOW_LAST_MESSAGES_COUNT)
-        last_messages = dummy_db.messages.get_all()
+        last_messages = _merge_by_seq(
+            dummy_db.messages.get_all(),
+            dummy_db.inboxes.get_before(user.idx, limit=SHOW_LAST_MESSAGES_COUNT),
+            *(dummy_db.rooms.get_before(room.idx, limit=SHOW_LAST_MESSAGES_COUNT) for room in rooms),
+        )
 
     if len(last_messages) == 0:
-        await send_message_to_user(user_to, NO_MESSAGE_TEMPLATE)
+        await send_message_to_connection(connection_to, NO_MESSAGE_TEMPLATE)
         return
 
-    for message_obj in last_messages:
-        await send_message_to_user(user_to, repr(message_obj))
+    await send_messages_to_connection(connection_to, last_messages)
 
 
-async def decrease_user_messages_limit(user: User) -> None:
-    user.message_limit -= 1
-    if user.message_limit > 0:
-        return
+def parse_page(arguments: tp.Sequence[str]) -> Page:
+    """Parse "[limit] [before|after <seq>]" command arguments. Raises ValueError for invalid arguments"""
+    arguments = list(arguments)
+    limit = STATUS_PAGE_SIZE
+    if arguments and arguments[0].isdigit():
+        limit = int(arguments.pop(0))
+    if limit <= 0:
+        raise ValueError("Page limit must be positive")
+    limit = min(limit, STATUS_MAX_PAGE_SIZE)
+
+    if not arguments:
+        return Page(limit=limit)
+
+    if len(arguments) != 2 or arguments[0] not in ("before", "after") or not arguments[1].isdigit():
+        raise ValueError("Invalid page cursor: %s" % " ".join(arguments))
+
+    direction, seq = arguments[0], int(arguments[1])
+    if direction == "before":
+        return Page(limit=limit, before=seq)
+    return Page(limit=limit, after=seq)
+
 
-    logger.info("Blocking messaging for %s" % user)
-    user.is_chating_blocked = True
-    user.chating_blocked_to = get_now_with_delta(seconds=CHATING_BLOCK_LIFETIME_SECONDS)
+def get_messages_page(page: Page) -> list[Message]:
+    if page.after is not None:
+        return dummy_db.messages.get_after(page.after, limit=page.limit)
+    return dummy_db.messages.get_before(page.before, limit=page.limit)
 
-    asyncio.get_running_loop().call_later(
-        CHATING_BLOCK_LIFETIME_SECONDS,
-        remove_user_chating_block,
-        user,
+
+def get_status_summary() -> str:
+    return STATUS_SUMMARY_MESSAGE_TEMPLATE.format(
+        users_count=len(dummy_db.users.get_connected()),
+        messages_count=len(dummy_db.messages),
+        last_seq=dummy_db.messages.last_seq,
     )
 
 
-async def create_message(sender: User, content: str) -> Message:
-    message = Message(sender=sender, content=content)
-    dummy_db.messages.add(message)
-    asyncio.get_running_loop().call_later(
-        MESSAGE_LIFETIME_SECONDS,
-        remove_expired_message,
-        message,
+def get_connected_connections() -> list[Connection]:
+    return [connection for user in dummy_db.users.get_connected() for connection in user.get_connected()]
+
+
+def register_metrics_gauges() -> None:
+    metrics.register_gauge(
+        "chat_connected_users",
+        "Users with at least one connection",
+        lambda: len(dummy_db.users.get_connected()),
+    )
+    metrics.register_gauge(
+        "chat_stored_messages",
+        "General chat and private messages in storage",
+        lambda: len(dummy_db.messages) + len(dummy_db.inboxes),
+    )
+    metrics.register_gauge(
+        "chat_pending_expiry_timers",
+        "Deadlines in the expiry sweeper heap",
+        lambda: len(expiry_sweeper),
+    )
+    metrics.register_gauge(
+        "chat_rooms",
+        "Rooms with at least one member",
+        lambda: len(dummy_db.rooms),
+    )
+    metrics.register_gauge(
+        "chat_scheduled_messages",
+        "Messages waiting for their send time",
+        lambda: len(dummy_db.scheduled),
     )
+    metrics.register_gauge(
+        "chat_outbound_queue_depth",
+        "Frames waiting in all connection outboxes",
+        lambda: sum(connection.outbox.qsize() for connection in get_connected_connections()),
+    )
+    metrics.register_gauge(
+        "chat_open_connections",
+        "Admitted line protocol and HTTP connections",
+        lambda: admission.count,
+    )
+    metrics.register_gauge(
+        "chat_outbound_queue_bytes",
+        "Bytes waiting in all connection outboxes",
+        lambda: sum(connection.outbox.nbytes for connection in get_connected_connections()),
+    )
+    metrics.register_gauge(
+        "chat_outbound_queue_depth_max",
+        "Frames waiting in the fullest connection outbox",
+        lambda: max((connection.outbox.qsize() for connection in get_connected_connections()), default=0),
+    )
+
+
+def is_metrics_enabled() -> bool:
+    return metrics.enabled
+
 
-    await decrease_user_messages_limit(user=sender)
+def get_metrics_summary() -> str:
+    return metrics.summary()
+
+
+def _store_message(message: Message) -> None:
+    if message.receiver is not None:
+        dummy_db.inboxes.restore(message)
+    elif message.room is not None:
+        dummy_db.rooms.restore_message(message)
+    else:
+        dummy_db.messages.restore(message)
+    expiry_sweeper.notify_message(message)
+    if chat_log.is_running:
+        chat_log.append_message(message)
+
+
+async def create_message(
+    sender: User,
+    content: str,
+    receiver: User | None = None,
+    room: Room | None = None,
+) -> Message:
+    message = Message(sender=sender, content=content, receiver=receiver, room=room)
+    if receiver is not None:
+        dummy_db.inboxes.add(message)
+    elif room is not None:
+        dummy_db.rooms.add_message(message)
+    else:
+        dummy_db.messages.add(message)
+    expiry_sweeper.notify_message(message)
+    if chat_log.is_running:
+        chat_log.append_message(message)
     return message
 
 
+def notify_user(user: User, text: str) -> None:
+    """Push a server notice to every user connection, e.g. about an event of a room"""
+    for connection in user.get_connected():
+        enqueue_to_connection(connection, _encode_text(connection, text, None))
+
+
+def get_member_room(user: User, room_id: str) -> Room | None:
+    """Room is visible only to its members"""
+    room = dummy_db.rooms.get_by_id(room_id)
+    if room is None or not room.has_member(user.idx):
+        return None
+    return room
+
+
+def create_room(owner: User, name: str) -> Room:
+    room = Room(name=name, owner_id=owner.idx)
+    dummy_db.rooms.add(room)
+    return room
+
+
+def add_room_member(room: Room, user: User) -> None:
+    dummy_db.rooms.add_member(room, user.idx)
+
+
+def request_room_join(room: Room, user: User) -> bool:
+    """Returns False if the user has asked already, so the owner is not notified again"""
+    if user.idx in room.join_requests:
+        return False
+    room.join_requests.add(user.idx)
+    return True
+
+
+def get_room_owner(room: Room) -> User | None:
+    return dummy_db.users.get_by_id(room.owner_id)
+
+
+def leave_room(room: Room, user: User) -> None:
+    dummy_db.rooms.remove_member(room, user.idx)
+
+
+def parse_send_at(value: str) -> datetime:
+    """
+    Parse send time of a scheduled message: "+<seconds>", "HH:MM[:SS]" of today or ISO date and time.
+    Raises ValueError for an invalid or not a future time.
+    """
+    now = datetime.now()
+    try:
+        if value.startswith("+"):
+            send_at = now + timedelta(seconds=float(value[1:]))
+        elif "-" not in value:
+            send_at = datetime.combine(now.date(), day_time.fromisoformat(value))
+        else:
+            send_at = datetime.fromisoformat(value)
+    except OverflowError:
+        raise ValueError("Send time is out of range: %s" % value)
+
+    if send_at.tzinfo is not None:
+        send_at = send_at.astimezone().replace(tzinfo=None)
+    if send_at <= now:
+        raise ValueError("Send time is not in the future: %s" % value)
+    return send_at
+
+
+def schedule_message(sender: User, content: str, send_at: datetime, receiver: User | None = None) -> ScheduledMessage:
+    scheduled = ScheduledMessage(sender=sender, content=content, send_at=send_at, receiver=receiver)
+    dummy_db.scheduled.add(scheduled)
+    message_scheduler.notify(scheduled)
+    if chat_log.is_running:
+        chat_log.append_scheduled(scheduled)
+    return scheduled
+
+
+def cancel_scheduled_message(user: User, idx: str) -> ScheduledMessage | None:
+    """Only the sender can cancel a message. Returns None if the user has no such pending message"""
+    scheduled = dummy_db.scheduled.get_by_id(idx)
+    if scheduled is None or scheduled.sender.idx != user.idx:
+        return None
+
+    dummy_db.scheduled.cancel(idx)
+    if chat_log.is_running:
+        chat_log.append_scheduled_removal(scheduled)
+    return scheduled
+
+
+async def deliver_scheduled_message(scheduled: ScheduledMessage) -> None:
+    if chat_log.is_running:
+        chat_log.append_scheduled_removal(scheduled)
+
+    sender, receiver = scheduled.sender, scheduled.receiver
+    if sender.is_banned:
+        logger.info("Drop %s of blocked %s" % (scheduled, sender))
+        return
+    if receiver is not None and dummy_db.users.get_by_id(receiver.idx) is None:
+        logger.info("Drop %s to removed %s" % (scheduled, receiver))
+        return
+
+    if is_clustered():
+        message = Message(sender=sender, content=scheduled.content, receiver=receiver)
+        cluster_link.publish(MESSAGE_EVENT, message_to_record(message))
+        return
+
+    message = await create_message(sender=sender, content=scheduled.content, receiver=receiver)
+    receivers_count = publish_message(message)
+    logger.info("%s is delivered as Message[%s] to %s users" % (scheduled, message.idx, receivers_count))
+
+
 async def report_on_user(user: User) -> None:
     user.reports_count += 1
     if user.reports_count < MAX_REPORTS_COUNT:
+        # Offline user of SQLite storage is not kept in memory, the count lives in its saved state
+        dummy_db.users.save(user)
         return
 
     logger.info("%s reports count is %s. Ban!" % (user, user.reports_count))
     user.is_banned = True
     user.banned_to = get_now_with_delta(seconds=BAN_LIFETIME_SECONDS)
+    dummy_db.users.save(user)
+    expiry_sweeper.schedule_ban(user)
+
+
+def is_clustered() -> bool:
+    return cluster_link.is_connected
+
+
+def submit_message(origin: Connection, content: str, receiver: User | None = None) -> None:
+    """Send a new message to the broker. Every worker stores and publishes it when the broker sends it back"""
+    message = Message(sender=origin.user, content=content, receiver=receiver)
+    _origin_connections[message.idx] = origin
+    cluster_link.publish(MESSAGE_EVENT, message_to_record(message))
+
+
+def submit_report(user: User) -> None:
+    cluster_link.publish(REPORT_EVENT, {"id": user.idx})
 
-    asyncio.get_running_loop().call_later(
-        BAN_LIFETIME_SECONDS,
-        remove_user_ban,
-        user,
+
+def _get_or_create_user(user_id: str) -> User:
+    user = dummy_db.users.get_by_id(user_id)
+    # The user could be removed already on this worker
+    return user if user is not None else User(idx=user_id)
+
+
+def _message_from_record(record: dict, sender: User) -> Message:
+    receiver_id = record["receiver"]
+    message = Message(
+        sender=sender,
+        content=record["content"],
+        receiver=_get_or_create_user(receiver_id) if receiver_id is not None else None,
     )
+    message.idx = record["id"]
+    message.seq = record["seq"]
+    message.restore_created_at(datetime.fromisoformat(record["created_at"]))
+    return message
+
+
+async def _apply_message_event(record: dict) -> None:
+    origin = _origin_connections.pop(record["id"], None)
+    sender = _get_or_create_user(record["sender"])
+    # The sender could be banned by an earlier event which was not applied yet when the message was sent
+    if sender.is_banned:
+        logger.info("Drop Message[%s] of blocked %s" % (record["id"], sender))
+        return
+
+    message = _message_from_record(record, sender)
+    _store_message(message)
+    receivers_count = publish_message(message, origin=origin)
+    if origin is not None:
+        logger.info("Message[%s] published to %s users" % (message.idx, receivers_count))
+
+
+def _apply_presence_event(event_type: int, payload: dict) -> None:
+    # Local connections are tracked by the worker itself
+    if payload["worker"] == cluster_link.worker_id:
+        return
+
+    user = dummy_db.users.get_by_id(payload["id"])
+    if user is None and event_type == ATTACH_EVENT:
+        # The session has been purged here after it was attached on the other worker
+        user = User.from_state(payload["state"])
+        dummy_db.users.add(user)
+    if user is None:
+        return
+
+    if event_type == ATTACH_EVENT:
+        user.remote_connections_count += 1
+        user.session_expires_at = None
+        return
+
+    user.remote_connections_count = max(user.remote_connections_count - 1, 0)
+    user.last_seq = max(user.last_seq, payload["last_seq"])
+    if not user.connections and user.remote_connections_count == 0 and payload["expires_at"] is not None:
+        expiry_sweeper.schedule_session_expiry(user, datetime.fromisoformat(payload["expires_at"]))
+
+
+def _apply_limit_event(payload: dict) -> None:
+    user = dummy_db.users.get_by_id(payload["id"])
+    # The origin worker has taken the token when the request came
+    if user is not None and payload["worker"] != cluster_link.worker_id:
+        rate_limiter.consume(user, payload["command"])
+
+
+def _apply_purge_event(payload: dict) -> None:
+    user = dummy_db.users.get_by_id(payload["id"])
+    if user is None or user.connections or user.remote_connections_count:
+        return
+    # The session has been attached and closed again after the event was sent, so it has a new deadline
+    if _get_session_deadline(user) != payload["expires_at"]:
+        return
+
+    remove_session(user)
+    logger.info("Purge %s" % user)
+
+
+def get_cluster_state() -> dict:
+    """State of this worker for a worker which joins the cluster. All connections are remote for that worker"""
+    users = []
+    for user in dummy_db.users.get_all():
+        state = user.to_state()
+        state["connections"] = len(user.connections) + user.remote_connections_count
+        state["session_expires_at"] = _get_session_deadline(user)
+        users.append(state)
+
+    messages = _merge_by_seq(dummy_db.messages.get_all(limit=None), dummy_db.inboxes.get_all())
+    return {"users": users, "messages": [message_to_record(message) for message in messages]}
+
+
+def restore_cluster_state(state: dict) -> None:
+    """
+    Replace the state restored by this worker with the state of a running worker.
+    Users are updated in place, so the deadlines scheduled for them stay valid.
+    """
+    restored_user_ids = set()
+    for user_state in state["users"]:
+        restored_user_ids.add(user_state["id"])
+        user = dummy_db.users.get_by_id(user_state["id"])
+        if user is None:
+            user = User.from_state(user_state)
+            dummy_db.users.add(user)
+        else:
+            user.load_state(user_state)
+
+        user.remote_connections_count = user_state["connections"]
+        if user.is_banned:
+            expiry_sweeper.schedule_ban(user)
+        user.session_expires_at = None
+        if user_state["session_expires_at"] is not None:
+            expiry_sweeper.schedule_session_expiry(user, datetime.fromisoformat(user_state["session_expires_at"]))
+
+    for user in dummy_db.users.get_all():
+        if user.idx not in restored_user_ids:
+            remove_session(user)
+
+    # The first worker writes the chat log, it has to get the messages which came while it was away
+    known_message_ids = {message.idx for message in dummy_db.messages.get_all(limit=None)}
+    known_message_ids.update(message.idx for message in dummy_db.inboxes.get_all())
+    dummy_db.messages.clear()
+    dummy_db.inboxes.clear()
+    for record in state["messages"]:
+        message = _message_from_record(record, _get_or_create_user(record["sender"]))
+        if message.receiver is not None:
+            dummy_db.inboxes.restore(message)
+        else:
+            dummy_db.messages.restore(message)
+        expiry_sweeper.notify_message(message)
+        if chat_log.is_running and message.idx not in known_message_ids:
+            chat_log.append_message(message)
+    logger.info("Restored %s users and %s messages of the cluster" % (len(state["users"]), len(state["messages"])))
+
+
+async def apply_cluster_event(event_type: int, payload: dict) -> None:
+    """Apply state change which came from the broker. All workers apply the same events in the same order"""
+    if event_type == USER_EVENT:
+        if dummy_db.users.get_by_id(payload["id"]) is None:
+            dummy_db.users.add(User.from_state(payload))
+    elif event_type in (ATTACH_EVENT, DETACH_EVENT):
+        _apply_presence_event(event_type, payload)
+    elif event_type == MESSAGE_EVENT:
+        await _apply_message_event(payload)
+    elif event_type == REPORT_EVENT:
+        user = dummy_db.users.get_by_id(payload["id"])
+        if user is not None:
+            await report_on_user(user)
+    elif event_type == LIMIT_EVENT:
+        _apply_limit_event(payload)
+    elif event_type == PURGE_EVENT:
+        _apply_purge_event(payload)
+    elif event_type == SNAPSHOT_REQUEST_EVENT:
+        cluster_link.publish(SNAPSHOT_EVENT, {"worker": payload["worker"], "state": get_cluster_state()})
+    else:
+        logger.error("Unknown cluster event %s" % event_type)
@@ -1,29 +1,337 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
 import logging
+import time
+import typing as tp
+from datetime import datetime, timedelta
 
-from config import USER_MESSAGE_LIMIT
+from config import (
+    MESSAGE_LIFETIME_SECONDS,
+    EXPIRY_RESOLUTION_SECONDS,
+    SESSION_LIFETIME_SECONDS,
+    PERSISTENCE_DIR,
+    PERSISTENCE_FLUSH_INTERVAL_SECONDS,
+    PERSISTENCE_SNAPSHOT_INTERVAL_SECONDS,
+    METRICS_ENABLED,
+    ADMISSION_KEEPALIVE_INTERVAL_SECONDS,
+    ADMISSION_IDLE_TIMEOUT_SECONDS,
+)
 from core import DummyDatabase
-from core.schemas import Message, User
+from core.cluster import PURGE_EVENT, ClusterLink
+from core.metrics import Metrics
+from core.persistence import ChatLog
+from core.schemas import Connection, Message, ScheduledMessage, StoredFile, User
+from core.utils import get_now_with_delta
 
-__all__ = ("remove_user_chating_block", "remove_user_ban", "remove_expired_message")
+__all__ = (
+    "remove_user_bans",
+    "remove_expired_messages",
+    "remove_expired_files",
+    "remove_session",
+    "remove_expired_sessions",
+    "ExpirySweeper",
+    "expiry_sweeper",
+    "IdleReaper",
+    "idle_reaper",
+    "MessageScheduler",
+    "message_scheduler",
+    "chat_log",
+    "cluster_link",
+    "metrics",
+)
 
 logger = logging.getLogger(__name__)
 
 dummy_db = DummyDatabase()
 
 
-def remove_user_chating_block(user: User) -> None:
-    user.message_limit = USER_MESSAGE_LIMIT
-    user.is_chating_blocked = False
-    user.chating_blocked_to = None
-    logger.info("Remove messaging block for %s" % user)
+def remove_user_bans(users: list[User]) -> None:
+    for user in users:
+        user.is_banned = False
+        user.banned_to = None
+        dummy_db.users.save(user)
+    logger.info("Ban is expired for %s users" % len(users))
 
 
-def remove_user_ban(user: User) -> None:
-    user.is_banned = False
-    user.banned_to = None
-    logger.info("%s ban is expired" % user)
+def remove_expired_messages(created_before: datetime) -> list[Message]:
+    messages = dummy_db.messages.pop_created_before(created_before)
+    messages.extend(dummy_db.inboxes.pop_created_before(created_before))
+    messages.extend(dummy_db.rooms.pop_created_before(created_before))
+    if messages:
+        logger.info("Delete %s expired messages" % len(messages))
+    return messages
 
 
-def remove_expired_message(message: Message) -> None:
-    logger.info("Delete expired Message<%s>" % message.idx)
-    dummy_db.messages.delete(message)
+def remove_expired_files(created_before: datetime) -> list[StoredFile]:
+    stored_files = dummy_db.files.pop_created_before(created_before)
+    if stored_files:
+        logger.info("Delete %s expired files" % len(stored_files))
+    return stored_files
+
+
+def remove_session(user: User) -> None:
+    # The pending session expiry becomes stale
+    user.session_expires_at = None
+    dummy_db.users.delete(user.idx)
+    dummy_db.inboxes.delete_inbox(user.idx)
+    dummy_db.rooms.remove_user(user.idx)
+
+
+def remove_expired_sessions(sessions: list[tuple[User, datetime]]) -> None:
+    """Sessions are users with the deadlines they expired at"""
+    if cluster_link.is_connected:
+        # Workers remove the session when the broker sends the event back,
+        # so a session attached on another worker in the meantime is kept by all of them
+        for user, deadline in sessions:
+            cluster_link.publish(PURGE_EVENT, {"id": user.idx, "expires_at": deadline.isoformat()})
+        return
+
+    for user, _ in sessions:
+        remove_session(user)
+    logger.info("Session is expired for %s users" % len(sessions))
+
+
+class ExpirySweeper:
+    """
+    Single background task which expires messages, bans and abandoned sessions in batches.
+
+    Messages and files are stored in creation order, so they expire from the head of the storage
+    and need no timers at all.
+    User deadlines (bans and abandoned sessions) live in one heap
+    instead of a loop.call_later handle per user.
+    Everything that becomes due within ``resolution`` seconds is handled in the same sweep.
+    """
+
+    BAN = "ban"
+    SESSION = "session"
+
+    def __init__(self, resolution: float = EXPIRY_RESOLUTION_SECONDS) -> None:
+        self._resolution = timedelta(seconds=resolution)
+        self._message_lifetime = timedelta(seconds=MESSAGE_LIFETIME_SECONDS)
+        self._deadlines: list[tuple[datetime, int, str, User]] = []
+        self._counter: tp.Iterator[int] = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._next_run: datetime | None = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def _notify(self, deadline: datetime) -> None:
+        if self._next_run is None or deadline + self._resolution < self._next_run:
+            self._wakeup.set()
+
+    def _schedule(self, kind: str, user: User, deadline: datetime) -> None:
+        heapq.heappush(self._deadlines, (deadline, next(self._counter), kind, user))
+        self._notify(deadline)
+
+    def schedule_ban(self, user: User) -> None:
+        if user.banned_to is not None:
+            self._schedule(self.BAN, user, user.banned_to)
+
+    def schedule_session_expiry(self, user: User, expires_at: datetime | None = None) -> None:
+        """Cluster workers take the deadline of the worker where the session was closed, so it is equal on all"""
+        user.session_expires_at = expires_at or get_now_with_delta(seconds=SESSION_LIFETIME_SECONDS)
+        self._schedule(self.SESSION, user, user.session_expires_at)
+
+    def notify_message(self, message: Message) -> None:
+        self._notify(message.created_at + self._message_lifetime)
+
+    def notify_file(self, stored_file: StoredFile) -> None:
+        self._notify(stored_file.created_at + self._message_lifetime)
+
+    def _next_deadline(self) -> datetime | None:
+        deadlines = []
+        first_items = (
+            dummy_db.messages.get_first(),
+            dummy_db.inboxes.get_first(),
+            dummy_db.rooms.get_first(),
+            dummy_db.files.get_first(),
+        )
+        for first_item in first_items:
+            if first_item is not None:
+                deadlines.append(first_item.created_at + self._message_lifetime)
+        if self._deadlines:
+            deadlines.append(self._deadlines[0][0])
+        return min(deadlines, default=None)
+
+    @staticmethod
+    def _has_connections(user: User) -> bool:
+        return bool(user.connections) or user.remote_connections_count > 0
+
+    def _pop_due_users(self, now: datetime) -> dict[str, list[tuple[User, datetime]]]:
+        due_users: dict[str, list[tuple[User, datetime]]] = {self.BAN: [], self.SESSION: []}
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, _, kind, user = heapq.heappop(self._deadlines)
+            # The user could have been blocked again or reconnected later, then the entry is stale
+            if kind == self.BAN and user.banned_to == deadline:
+                due_users[kind].append((user, deadline))
+            elif kind == self.SESSION and user.session_expires_at == deadline and not self._has_connections(user):
+                due_users[kind].append((user, deadline))
+        return due_users
+
+    def sweep(self, now: datetime) -> None:
+        remove_expired_messages(created_before=now - self._message_lifetime)
+        remove_expired_files(created_before=now - self._message_lifetime)
+        due_users = self._pop_due_users(now)
+        if due_users[self.BAN]:
+            remove_user_bans([user for user, _ in due_users[self.BAN]])
+        if due_users[self.SESSION]:
+            remove_expired_sessions(due_users[self.SESSION])
+
+    async def run(self) -> None:
+        logger.info("Expiry sweeper is running")
+        while True:
+            now = datetime.now()
+            self.sweep(now)
+
+            next_deadline = self._next_deadline()
+            timeout = None
+            self._next_run = None
+            if next_deadline is not None:
+                self._next_run = next_deadline + self._resolution
+                timeout = max((self._next_run - now).total_seconds(), 0)
+
+            self._wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+
+
+class IdleReaper:
+    """
+    Single background task which pings quiet connections and closes connections which stay silent.
+
+    Connections wait in one heap by the time of their next check. A request only updates
+    ``connection.last_active_at`` and the heap entry is moved forward lazily when it comes due,
+    so requests never touch the heap. Closed connections are dropped from the heap by their next check.
+    """
+
+    def __init__(
+        self,
+        keepalive_interval: float = ADMISSION_KEEPALIVE_INTERVAL_SECONDS,
+        idle_timeout: float = ADMISSION_IDLE_TIMEOUT_SECONDS,
+        resolution: float = EXPIRY_RESOLUTION_SECONDS,
+    ) -> None:
+        self._keepalive_interval = keepalive_interval
+        self._idle_timeout = idle_timeout
+        self._resolution = resolution
+        self._checks: list[tuple[float, int, Connection]] = []
+        self._counter: tp.Iterator[int] = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._checks)
+
+    @property
+    def is_enabled(self) -> bool:
+        return bool(self._idle_timeout)
+
+    @property
+    def _check_interval(self) -> float:
+        return min(self._keepalive_interval or self._idle_timeout, self._idle_timeout)
+
+    def _push(self, deadline: float, connection: Connection) -> None:
+        heapq.heappush(self._checks, (deadline, next(self._counter), connection))
+
+    def track(self, connection: Connection) -> None:
+        if not self.is_enabled:
+            return
+        self._push(connection.last_active_at + self._check_interval, connection)
+        # Checks in the heap are due not later than the new one, so only an empty heap has to wake the task up
+        if len(self._checks) == 1:
+            self._wakeup.set()
+
+    @staticmethod
+    def _is_closed(connection: Connection) -> bool:
+        return connection.writer is None or connection.writer.is_closing()
+
+    def check(
+        self,
+        now: float,
+        ping: tp.Callable[[Connection], None],
+        reap: tp.Callable[[Connection], None],
+    ) -> None:
+        while self._checks and self._checks[0][0] <= now:
+            _, _, connection = heapq.heappop(self._checks)
+            if self._is_closed(connection):
+                continue
+
+            silent_for = now - connection.last_active_at
+            if silent_for >= self._idle_timeout:
+                reap(connection)
+            elif self._keepalive_interval and silent_for >= self._keepalive_interval:
+                ping(connection)
+                self._push(
+                    min(now + self._keepalive_interval, connection.last_active_at + self._idle_timeout),
+                    connection,
+                )
+            else:
+                self._push(connection.last_active_at + self._check_interval, connection)
+
+    async def run(self, ping: tp.Callable[[Connection], None], reap: tp.Callable[[Connection], None]) -> None:
+        logger.info("Idle reaper is running")
+        while True:
+            now = time.monotonic()
+            self.check(now, ping, reap)
+
+            timeout = None
+            if self._checks:
+                timeout = max(self._checks[0][0] - now, 0) + self._resolution
+
+            self._wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+
+
+class MessageScheduler:
+    """
+    Single background task which delivers scheduled messages.
+
+    Pending messages live in one heap of DummyDatabase instead of a loop.call_later handle per message,
+    the task sleeps until the earliest send time. Due messages are delivered in batches
+    with a yield to the event loop between them, so a burst of them does not stall connections.
+    """
+
+    def __init__(self, batch_size: int = 1000) -> None:
+        self._batch_size = batch_size
+        self._wakeup = asyncio.Event()
+        self._next_run: datetime | None = None
+
+    def notify(self, scheduled: ScheduledMessage) -> None:
+        if self._next_run is None or scheduled.send_at < self._next_run:
+            self._wakeup.set()
+
+    async def run(self, deliver: tp.Callable[[ScheduledMessage], tp.Awaitable[None]]) -> None:
+        logger.info("Message scheduler is running with %s pending messages" % len(dummy_db.scheduled))
+        while True:
+            due = dummy_db.scheduled.pop_due(datetime.now(), limit=self._batch_size)
+            for scheduled in due:
+                await deliver(scheduled)
+            if due:
+                logger.info("Delivered %s scheduled messages" % len(due))
+                await asyncio.sleep(0)
+                continue
+
+            first_scheduled = dummy_db.scheduled.get_first()
+            timeout = None
+            self._next_run = None
+            if first_scheduled is not None:
+                self._next_run = first_scheduled.send_at
+                timeout = max((self._next_run - datetime.now()).total_seconds(), 0)
+
+            self._wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+
+
+expiry_sweeper = ExpirySweeper()
+idle_reaper = IdleReaper()
+message_scheduler = MessageScheduler()
+chat_log = ChatLog(
+    directory=PERSISTENCE_DIR,
+    flush_interval=PERSISTENCE_FLUSH_INTERVAL_SECONDS,
+    snapshot_interval=PERSISTENCE_SNAPSHOT_INTERVAL_SECONDS,
+)
+cluster_link = ClusterLink()
+metrics = Metrics(enabled=METRICS_ENABLED)
@@ -0,0 +1,322 @@
+"""
+Нагрузочные сценарии для сервера.
+
+Сервер запускается в том же процессе, клиенты - это N одновременных подключений client.Client.
+Запуск из каталога src:
+
+    python -m tests.benchmark --scenario send_storm --clients 50 --output results.json
+
+Результаты (сообщений в секунду, p50/p99 задержки, RSS) печатаются и сохраняются в JSON,
+чтобы сравнивать прогоны между коммитами. Время жизни сообщений, размеры очередей и т.д. берутся из config.yml.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import resource
+import subprocess
+import time
+import typing as tp
+import uuid
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+
+import services
+from client import Client
+from config import (
+    SESSION_TOKEN_MESSAGE_TEMPLATE,
+    STATUS_SUMMARY_MESSAGE_TEMPLATE,
+    STATUS_CURSOR_MESSAGE_TEMPLATE,
+    BAN_MESSAGE_TEMPLATE,
+)
+from core import DummyDatabase
+from core.rate_limit import RateLimiter
+from server import create_server
+
+# Начала ответов сервера, по которым сценарии понимают, что ответ на команду получен
+TOKEN_PREFIX = SESSION_TOKEN_MESSAGE_TEMPLATE.split("{")[0]
+SUMMARY_PREFIX = STATUS_SUMMARY_MESSAGE_TEMPLATE.split("{")[0]
+CURSOR_PREFIX = STATUS_CURSOR_MESSAGE_TEMPLATE.split("{")[0]
+BAN_PREFIX = BAN_MESSAGE_TEMPLATE.split("{")[0]
+
+dummy_db = DummyDatabase()
+
+
+@dataclass
+class BenchmarkResult:
+    scenario: str
+    clients: int
+    parameters: dict
+    operations: int = 0
+    # Ожидаемые, но не выполненные операции (например, сообщения, которые сервер не доставил)
+    lost_operations: int = 0
+    elapsed_seconds: float = 0.0
+    operations_per_second: float = 0.0
+    latency_ms: dict = field(default_factory=dict)
+    rss_bytes: int = 0
+    max_rss_bytes: int = 0
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def get_rss_bytes() -> int:
+    """Текущий RSS процесса (Linux), иначе пиковый"""
+    with contextlib.suppress(OSError):
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    return get_max_rss_bytes()
+
+
+def get_max_rss_bytes() -> int:
+    # ru_maxrss в килобайтах на Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def finish(result: BenchmarkResult, started_at: float, latencies: list[float]) -> BenchmarkResult:
+    result.elapsed_seconds = time.perf_counter() - started_at
+    result.operations_per_second = result.operations / result.elapsed_seconds if result.elapsed_seconds else 0.0
+    result.latency_ms = {
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "max": max(latencies, default=0.0) * 1000,
+    }
+    result.rss_bytes = get_rss_bytes()
+    result.max_rss_bytes = get_max_rss_bytes()
+    return result
+
+
+async def read_until(client: Client, prefix: str | tuple[str, ...]) -> list[str]:
+    """Читаем ответы, пока не встретим строку с префиксом. Возвращаем строки до нее"""
+    lines = []
+    while True:
+        line = await client.read_line()
+        if not line:
+            raise ConnectionError("Server closed the connection")
+        if line.startswith(prefix):
+            return lines
+        lines.append(line)
+
+
+async def fence(client: Client) -> list[str]:
+    """
+    Ответы на команды одного подключения приходят по порядку,
+    поэтому /status summary дочитывает все, что сервер отправил до него. Забаненный юзер вместо сводки получает бан.
+    """
+    await client.status_summary()
+    return await read_until(client, (SUMMARY_PREFIX, BAN_PREFIX))
+
+
+async def connect(client: Client, token: str | None = None) -> str:
+    await client.connect(token)
+    line = ""
+    while not line.startswith(TOKEN_PREFIX):
+        line = await client.read_line()
+        if not line:
+            raise ConnectionError("Server closed the connection")
+    await fence(client)
+    return line.removeprefix(TOKEN_PREFIX)
+
+
+async def open_clients(stack: contextlib.AsyncExitStack, count: int, port: int) -> list[Client]:
+    clients = [await stack.enter_async_context(Client(server_port=port)) for _ in range(count)]
+    await asyncio.gather(*(connect(client) for client in clients))
+    return clients
+
+
+async def send_storm(port: int, clients_count: int, messages: int, timeout: float) -> BenchmarkResult:
+    """Каждый клиент отправляет messages сообщений в общий чат, все остальные клиенты их получают"""
+    result = BenchmarkResult("send_storm", clients_count, {"messages": messages})
+    run_id = uuid.uuid4().hex
+    expected = messages * (clients_count - 1)
+    latencies: list[float] = []
+
+    async def receive(client: Client) -> None:
+        received = 0
+        while received < expected:
+            line = await client.read_line()
+            if not line:
+                return
+            _, marker, sent_at = line.rpartition(run_id + " ")
+            if marker:
+                latencies.append(time.perf_counter() - float(sent_at))
+                received += 1
+
+    async def send(client: Client) -> None:
+        for _ in range(messages):
+            await client.send("%s %s" % (run_id, time.perf_counter()))
+
+    async with contextlib.AsyncExitStack() as stack:
+        clients = await open_clients(stack, clients_count, port)
+        started_at = time.perf_counter()
+        receivers = [asyncio.create_task(receive(client)) for client in clients]
+        await asyncio.gather(*(send(client) for client in clients))
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.gather(*receivers), timeout=timeout)
+        for receiver in receivers:
+            receiver.cancel()
+        result.operations = len(latencies)
+        result.lost_operations = expected * clients_count - result.operations
+        return finish(result, started_at, latencies)
+
+
+async def reconnect_storm(port: int, clients_count: int, rounds: int) -> BenchmarkResult:
+    """Клиенты подключаются, закрывают соединение и восстанавливают сессию по токену rounds раз"""
+    result = BenchmarkResult("reconnect_storm", clients_count, {"rounds": rounds})
+    latencies: list[float] = []
+
+    async def reconnect() -> None:
+        token = None
+        for _ in range(rounds):
+            async with Client(server_port=port) as client:
+                started_at = time.perf_counter()
+                token = await connect(client, token)
+                latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(reconnect() for _ in range(clients_count)))
+    result.operations = len(latencies)
+    return finish(result, started_at, latencies)
+
+
+async def status_replay(port: int, clients_count: int, history: int, limit: int, rounds: int) -> BenchmarkResult:
+    """История из history сообщений, каждый клиент rounds раз запрашивает /status limit. Операция - одно сообщение"""
+    result = BenchmarkResult("status_replay", clients_count, {"history": history, "limit": limit, "rounds": rounds})
+    latencies: list[float] = []
+    replayed = 0
+
+    async def replay(client: Client) -> None:
+        nonlocal replayed
+        for _ in range(rounds):
+            started_at = time.perf_counter()
+            await client.status(limit=limit)
+            messages = await read_until(client, CURSOR_PREFIX)
+            latencies.append(time.perf_counter() - started_at)
+            replayed += len(messages)
+
+    async with contextlib.AsyncExitStack() as stack:
+        clients = await open_clients(stack, clients_count, port)
+        sender = dummy_db.users.get_connected()[0]
+        for number in range(history):
+            await services.create_message(sender=sender, content="History message %s" % number)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(replay(client) for client in clients))
+        result.operations = replayed
+        return finish(result, started_at, latencies)
+
+
+async def report_flood(port: int, clients_count: int, reports: int) -> BenchmarkResult:
+    """Каждый клиент отправляет reports жалоб на соседа. Задержка - время пачки жалоб до ответа на /status summary"""
+    result = BenchmarkResult("report_flood", clients_count, {"reports": reports})
+    latencies: list[float] = []
+
+    async def flood(client: Client, target_id: str) -> None:
+        started_at = time.perf_counter()
+        for _ in range(reports):
+            await client.report(target_id)
+        await fence(client)
+        latencies.append(time.perf_counter() - started_at)
+
+    async with contextlib.AsyncExitStack() as stack:
+        clients = [await stack.enter_async_context(Client(server_port=port)) for _ in range(clients_count)]
+        tokens = await asyncio.gather(*(connect(client) for client in clients))
+        user_ids = [dummy_db.users.get_by_token(token).idx for token in tokens]
+
+        started_at = time.perf_counter()
+        await asyncio.gather(
+            *(flood(client, user_ids[(number + 1) % clients_count]) for number, client in enumerate(clients))
+        )
+        result.operations = reports * clients_count
+        return finish(result, started_at, latencies)
+
+
+async def wait_disconnected(timeout: float = 5) -> None:
+    """Ждем, пока сервер закроет подключения клиентов, иначе их обработчики будут отменены при остановке loop"""
+    deadline = time.perf_counter() + timeout
+    while dummy_db.users.get_connected() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)
+
+
+async def run_benchmark(arguments: argparse.Namespace) -> list[BenchmarkResult]:
+    if not arguments.rate_limits:
+        services.rate_limiter = RateLimiter({})
+
+    server = create_server(host="127.0.0.1", port=arguments.port)
+    server_task = asyncio.create_task(server.run())
+    # Ждем, пока сервер начнет принимать подключения
+    await asyncio.sleep(0.2)
+
+    scenarios: dict[str, tp.Callable[[], tp.Awaitable[BenchmarkResult]]] = {
+        "send_storm": lambda: send_storm(arguments.port, arguments.clients, arguments.messages, arguments.timeout),
+        "reconnect_storm": lambda: reconnect_storm(arguments.port, arguments.clients, arguments.rounds),
+        "status_replay": lambda: status_replay(
+            arguments.port, arguments.clients, arguments.history, arguments.limit, arguments.rounds
+        ),
+        "report_flood": lambda: report_flood(arguments.port, arguments.clients, arguments.reports),
+    }
+    names = list(scenarios) if arguments.scenario == "all" else [arguments.scenario]
+    results = []
+    try:
+        for name in names:
+            result = await scenarios[name]()
+            print(json.dumps(asdict(result)))
+            results.append(result)
+    finally:
+        await wait_disconnected()
+        server_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await server_task
+    return results
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Chat server benchmark")
+    parser.add_argument(
+        "--scenario",
+        choices=("send_storm", "reconnect_storm", "status_replay", "report_flood", "all"),
+        default="all",
+    )
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=50, help="messages per client in send_storm")
+    parser.add_argument("--rounds", type=int, default=10, help="reconnects or /status requests per client")
+    parser.add_argument("--history", type=int, default=10000, help="stored messages for status_replay")
+    parser.add_argument("--limit", type=int, default=500, help="/status page size for status_replay")
+    parser.add_argument("--reports", type=int, default=50, help="reports per client in report_flood")
+    parser.add_argument("--timeout", type=float, default=60, help="max seconds to wait for deliveries")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rate-limits", action="store_true", help="keep rate limits from config.yml")
+    parser.add_argument("--output", type=Path, help="save results to JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show server warnings")
+    return parser.parse_args()
+
+
+def main() -> None:
+    arguments = parse_arguments()
+    # Логи сервера на каждый запрос (и на каждое недоставленное сообщение) сильно искажают результаты
+    logging.disable(logging.INFO if arguments.verbose else logging.WARNING)
+    results = asyncio.run(run_benchmark(arguments))
+    if arguments.output is not None:
+        report = {
+            "commit": get_git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": [asdict(result) for result in results],
+        }
+        arguments.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,20 @@
 import asyncio
-
-from client import Client
+import hashlib
+import multiprocessing
+import tempfile
+from pathlib import Path
+
+from client import Client, BinaryClient
+from core import binary
+from core.admission import HOST_LIMIT, SERVER_FULL, AdmissionControl
+from core.schemas import Connection, Message, User
+from core.sqlite_storage import SqliteMessagesStorage, SqliteUsersStorage, SqliteWriter, connect
+from launcher import run_broker, run_worker
+from tasks import IdleReaper
 from config import (
+    SERVER_HOST,
+    SERVER_PORT,
+    RATE_LIMITS,
     NO_MESSAGE_TEMPLATE,
     SHOW_LAST_MESSAGES_COUNT,
     NOT_CONNECTED_MESSAGE_TEMPLATE,
@@ -57,7 +70,8 @@ async def report_case_with_expire_ban():
 async def message_block_case():
     """
     Кейс с блокировкой отправки сообщения по истечению лимита.
-    Когда лимит исчерпан, то юзе будет получать сообщения типа [*] You have no message limit. Try again at {block_to}.
+    Когда лимит исчерпан, то юзе будет получать сообщения типа
+    [*] Too many /send requests. Try again in {retry_after} seconds.
     """
     async with Client() as client1:
         await client1.connect()
@@ -65,14 +79,13 @@ async def message_block_case():
         _ = await client1.read()
         await asyncio.sleep(0.25)
 
-        await client1.send(message="Message 1")
-        await asyncio.sleep(0.25)
-
-        await client1.send(message="Message 1")
+        # Сообщения отправляются без пауз, чтобы лимит не успел восстановиться
+        for _ in range(RATE_LIMITS["/send"]["capacity"] + 1):
+            await client1.send(message="Message 1")
         await asyncio.sleep(0.25)
 
         answer = await client1.read()
-        assert answer.startswith("[*] You have no message limit.")
+        assert answer.startswith("[*] Too many /send requests.")
 
 
 async def unconnected_case():
@@ -151,7 +164,9 @@ async def first_connect_case():
         await client2.connect()
         await asyncio.sleep(0.25)
         answer = await client2.read()
-        assert len(answer) == SHOW_LAST_MESSAGES_COUNT
+        # Первой строкой приходит токен сессии, за ней последние сообщения
+        messages = [line for line in answer.splitlines() if not line.startswith("[*]")]
+        assert len(messages) == SHOW_LAST_MESSAGES_COUNT
 
 
 async def first_connect_case_with_no_message():
@@ -163,7 +178,445 @@ async def first_connect_case_with_no_message():
         await client.connect()
         await asyncio.sleep(0.25)
         answer = await client.read()
-        assert len(answer) == NO_MESSAGE_TEMPLATE
+        assert answer.splitlines()[-1] == NO_MESSAGE_TEMPLATE
+
+
+async def status_pagination_case():
+    """
+    Кейс постраничного запроса истории командой /status.
+    На каждую страницу после сообщений приходит курсор типа "[*] Cursor: before {before} after {after}.",
+    по которому можно запросить предыдущую страницу.
+    """
+    async with Client() as client1:
+        await client1.connect()
+        await asyncio.sleep(0.25)
+        _ = await client1.read()
+        await asyncio.sleep(0.25)
+
+        await client1.send(message="message 1")
+        await client1.send(message="message 2")
+        await client1.send(message="message 3")
+        await asyncio.sleep(0.25)
+
+        await client1.status(limit=2)
+        await asyncio.sleep(0.25)
+        *messages, cursor = (await client1.read()).splitlines()
+        assert len(messages) == 2
+        assert cursor.startswith("[*] Cursor: before")
+        before_seq = int(cursor.split()[3])
+
+        await client1.status(limit=2, before=before_seq)
+        await asyncio.sleep(0.25)
+        *messages, _ = (await client1.read()).splitlines()
+        assert messages[-1].endswith("message 1")
+
+
+async def private_message_case():
+    """
+    Кейс отправки приватного сообщения командой /send @<user_id>.
+    Сообщение сразу приходит получателю и не попадает остальным участникам общего чата.
+    """
+    async with Client() as client1, Client() as client2, Client() as client3:
+        for client in (client1, client2, client3):
+            await client.connect()
+            await asyncio.sleep(0.25)
+            _ = await client.read()
+
+        await client2.send(message="Hello")
+        await asyncio.sleep(0.25)
+        answer = await client1.read()
+        _, _, user_obj, *_ = answer.split()
+        user_id = user_obj.removeprefix("<User[").removesuffix("]>")
+        _ = await client3.read()
+
+        await client1.send(message="Secret", user_id=user_id)
+        await asyncio.sleep(0.25)
+        answer = await client2.read()
+        assert answer.endswith("(private) Secret")
+
+        answer = await client3.read()
+        assert answer == "No data"
+
+
+async def session_case():
+    """
+    Кейс подключения к одной сессии с нескольких клиентов.
+    На /connect сервер выдает токен сессии. С этим токеном можно подключиться с другого клиента:
+    сообщения доставляются на все подключения юзера, а после переподключения приходят непрочитанные сообщения.
+    """
+    async with Client() as other_client:
+        await other_client.connect()
+        await asyncio.sleep(0.25)
+        _ = await other_client.read()
+
+        async with Client() as device1, Client() as device2:
+            await device1.connect()
+            await asyncio.sleep(0.25)
+            token_line, *_ = (await device1.read()).splitlines()
+            token = token_line.split()[-1]
+
+            await device2.connect(token)
+            await asyncio.sleep(0.25)
+            _ = await device2.read()
+
+            await other_client.send(message="Hello")
+            await asyncio.sleep(0.25)
+            assert (await device1.read()).endswith("Hello")
+            assert (await device2.read()).endswith("Hello")
+
+            await device1.send(message="From device 1")
+            await asyncio.sleep(0.25)
+            assert (await device2.read()).endswith("From device 1")
+            assert await device1.read() == "No data"
+
+        await asyncio.sleep(0.25)
+        await other_client.send(message="While you were away")
+        await asyncio.sleep(0.25)
+
+        async with Client() as device3:
+            await device3.connect(token)
+            await asyncio.sleep(0.25)
+            _, *unread_messages = (await device3.read()).splitlines()
+            assert len(unread_messages) == 1
+            assert unread_messages[0].endswith("While you were away")
+
+
+async def pipelined_requests_case():
+    """
+    Кейс с командами, отправленными с идентификатором (#<id> /command).
+    Клиент отправляет несколько команд подряд, не дожидаясь ответов, и получает каждый ответ в своем future.
+    Сообщения чата приходят отдельно, в async for по client.messages().
+    """
+    async with Client() as client1, Client() as client2:
+        token_line, *_ = await client1.request("/connect")
+        assert token_line.startswith("[*] Your session token")
+        _ = await client2.request("/connect")
+
+        first, second = await asyncio.gather(client1.request("/status 1"), client1.request("/status summary"))
+        assert first[-1] == NO_MESSAGE_TEMPLATE or first[-1].startswith("[*] Cursor")
+        assert second[0].startswith("[*] Users online")
+
+        assert await client2.request("/send Hello") == []
+        async for message in client1.messages():
+            assert message.endswith("Hello")
+            break
+
+
+async def binary_protocol_case():
+    """
+    Кейс бинарного протокола.
+    Айди отправителя и содержимое сообщения приходят отдельными полями кадра, текст не нужно разбирать.
+    Клиенты текстового и бинарного протоколов находятся в одном чате.
+    """
+    async with BinaryClient() as binary_client, Client() as text_client:
+        reply = await binary_client.connect()
+        assert reply[0].payload.decode().startswith("[*] Your session token")
+        await text_client.connect()
+        await asyncio.sleep(0.25)
+        _ = await text_client.read()
+
+        await text_client.send(message="Hello binary")
+        async for frame in binary_client.messages():
+            assert frame.opcode == binary.MESSAGE
+            _, content = binary.split_message_payload(frame.payload)
+            assert content == "Hello binary"
+            sender_id = binary.decode_user_id(frame.user_id)
+            break
+
+        assert await binary_client.send(message="Secret", user_id=sender_id) == []
+        await asyncio.sleep(0.25)
+        answer = await text_client.read()
+        assert answer.endswith("(private) Secret")
+
+
+async def compression_case():
+    """
+    Кейс со сжатием ответов сервера.
+    Клиент просит сжатие при подключении, история и сообщения приходят так же, как без сжатия.
+    """
+    async with Client(compression=True) as client1, Client() as client2:
+        await client1.connect()
+        await client2.connect()
+        await asyncio.sleep(0.25)
+        _ = await client1.read()
+        _ = await client2.read()
+
+        for number in range(3):
+            await client2.send(message=f"Message {number}")
+        await asyncio.sleep(0.25)
+        answer = await client1.read()
+        assert answer.splitlines()[-1].endswith("Message 2")
+
+        lines = await client1.request("/status 3")
+        assert [line.split()[-1] for line in lines[:-1]] == ["0", "1", "2"]
+
+
+async def file_transfer_case():
+    """
+    Кейс с отправкой файла.
+    Файл загружается потоком, остальные участники чата получают сообщение с айди файла и скачивают его целиком.
+    """
+    async with Client() as client1, Client() as client2:
+        await client1.request("/connect")
+        await client2.request("/connect")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "notes.txt"
+            path.write_bytes(b"first line\nsecond line\n" * 1000)
+            lines = await client1.upload(path)
+        file_id = lines[0].split()[2]
+        assert lines[0].endswith("sha256 %s." % hashlib.sha256(b"first line\nsecond line\n" * 1000).hexdigest())
+
+        answer = await client2.read()
+        assert answer.endswith("Request /download %s" % file_id)
+
+        lines, content = await client2.download(file_id)
+        assert lines[0].endswith(": notes.txt")
+        assert content == b"first line\nsecond line\n" * 1000
+
+
+async def scheduled_message_case():
+    """
+    Кейс с отложенным сообщением командой /send --at <time>.
+    Сообщение приходит участникам чата в указанное время, а еще не отправленное сообщение можно отменить.
+    """
+    async with Client() as client1, Client() as client2:
+        await client1.request("/connect")
+        await client2.request("/connect")
+
+        lines = await client1.request("/send --at +1 Later")
+        message_id = lines[0].split()[2]
+        assert lines[0].endswith("Request /cancel %s to cancel it." % message_id)
+        answer = await client2.read()
+        assert answer == "No data"
+
+        await asyncio.sleep(1.5)
+        answer = await client2.read()
+        assert answer.endswith("Later")
+
+        lines = await client1.request("/send --at +60 Never")
+        message_id = lines[0].split()[2]
+        lines = await client1.cancel(message_id)
+        assert lines == ["[*] Scheduled message %s is cancelled." % message_id]
+        lines = await client1.cancel(message_id)
+        assert lines[0].endswith("does not exist or is already sent.")
+
+
+async def room_case():
+    """
+    Кейс с комнатой командой /room.
+    Владелец приглашает участника, гость входит по ссылке после подтверждения владельца.
+    Сообщения комнаты получают только ее участники.
+    """
+    async with Client() as owner, Client() as member, Client() as guest:
+        for client in (owner, member, guest):
+            await client.request("/connect")
+        await member.request("/send I am member")
+        answer = await owner.read()
+        member_id = answer.split()[2].removeprefix("<User[").removesuffix("]>")
+        _ = await guest.read()
+
+        lines = await owner.room("create", "Team")
+        room_id, invite_code = lines[0].split()[2], lines[0].split()[-1]
+        lines = await owner.room("invite", room_id, "@" + member_id)
+        assert lines == ["[*] User %s is a member of room %s now." % (member_id, room_id)]
+        answer = await member.read()
+        assert answer.startswith("[*] You are a member of room %s (Team) now." % room_id)
+
+        lines = await guest.room("join", invite_code)
+        assert lines == ["[*] Request to join room %s (Team) is sent to its owner." % room_id]
+        answer = await owner.read()
+        guest_id = answer.split()[2]
+        await owner.room("invite", room_id, "@" + guest_id)
+        _ = await guest.read()
+
+        await member.room("send", room_id, "Hi team")
+        answer = await owner.read()
+        assert answer.endswith("(Room[%s] Team) Hi team" % room_id)
+        answer = await guest.read()
+        assert answer.endswith("Hi team")
+
+        await guest.room("leave", room_id)
+        await member.room("send", room_id, "Bye")
+        answer = await guest.read()
+        assert answer == "No data"
+        lines = await guest.room("send", room_id, "Wait")
+        assert lines == ["[*] Room %s does not exist or you are not its member." % room_id]
+
+
+async def _start_worker(worker_id: int, port: int, broker_path: Path) -> multiprocessing.Process:
+    """Запускает воркер кластера и ждет, пока он получит состояние и начнет принимать подключения"""
+    # Форкнутый процесс унаследовал бы сокеты открытых клиентов, и сервер не увидел бы их закрытия
+    worker = multiprocessing.get_context("spawn").Process(
+        target=run_worker,
+        args=(worker_id, SERVER_HOST, port, broker_path),
+    )
+    worker.start()
+    for _ in range(50):
+        try:
+            _, writer = await asyncio.open_connection(SERVER_HOST, port)
+        except ConnectionRefusedError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        await writer.wait_closed()
+        return worker
+    raise ConnectionError("Worker %s is not available on %s port" % (worker_id, port))
+
+
+async def cluster_case():
+    """
+    Кейс с кластером из брокера и воркеров на одной машине.
+    Воркеры слушают разные порты, поэтому клиент сам выбирает воркер.
+    Лимиты запросов общие для всего кластера, а воркер, запущенный позже, получает состояние от работающих.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        broker_path = Path(directory) / "broker.sock"
+        broker = multiprocessing.Process(target=run_broker, args=(broker_path,))
+        broker.start()
+        workers = []
+        try:
+            workers.append(await _start_worker(0, SERVER_PORT + 1, broker_path))
+            workers.append(await _start_worker(1, SERVER_PORT + 2, broker_path))
+
+            async with Client(server_port=SERVER_PORT + 1) as client1, Client(server_port=SERVER_PORT + 2) as client2:
+                token_line, *_ = await client1.request("/connect")
+                token = token_line.split()[-1]
+                await client2.request("/connect")
+
+                for _ in range(RATE_LIMITS["/report"]["capacity"]):
+                    await client1.request("/report nobody")
+                await client1.request("/send Hello")
+                async for message in client2.messages():
+                    assert message.endswith("Hello")
+                    break
+
+                # Сессия первого клиента на втором воркере: его лимит /report уже исчерпан
+                async with Client(server_port=SERVER_PORT + 2) as device:
+                    await device.request("/connect %s" % token)
+                    lines = await device.request("/report nobody")
+                    assert lines[0].startswith("[*] Too many /report requests")
+
+                workers.append(await _start_worker(2, SERVER_PORT + 3, broker_path))
+                async with Client(server_port=SERVER_PORT + 3) as client3:
+                    lines = await client3.request("/connect")
+                    assert lines[-1].endswith("Hello")
+                    async with Client(server_port=SERVER_PORT + 3) as device:
+                        await device.request("/connect %s" % token)
+                        lines = await device.request("/report nobody")
+                        assert lines[0].startswith("[*] Too many /report requests")
+
+                    await client3.request("/send From late worker")
+                    async for message in client1.messages():
+                        assert message.endswith("From late worker")
+                        break
+            # Воркеры успевают закрыть подключения клиентов до остановки
+            await asyncio.sleep(0.25)
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+            broker.terminate()
+            broker.join()
+
+
+async def sqlite_storage_case():
+    """
+    Кейс с хранилищем SQLite, без сервера.
+    Офлайн-юзер, найденный по id, не остается в памяти, а сессия, найденная по токену, остается.
+    Сообщение находится по id и до записи в базу, и после вытеснения из кэша.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "chat.sqlite3"
+        writer = SqliteWriter(path)
+        writer.start()
+        reader = connect(path)
+        users = SqliteUsersStorage(reader=reader, writer=writer)
+        messages = SqliteMessagesStorage(reader=reader, writer=writer, users=users, cache_size=1)
+        try:
+            offline_user = User()
+            users.save(offline_user)
+            await asyncio.sleep(0.25)
+
+            found_user = users.get_by_id(offline_user.idx)
+            assert found_user is not None and found_user.idx == offline_user.idx
+            assert len(users) == 0
+
+            session_user = users.get_by_token(offline_user.token)
+            assert session_user is not None
+            assert users.get_by_id(offline_user.idx) is session_user
+            assert len(users) == 1
+
+            first_message = Message(sender=session_user, content="First")
+            messages.add(first_message)
+            assert messages.get_by_id(first_message.idx) is first_message
+            # Из кэша вытесняются только сообщения, уже записанные в базу
+            await asyncio.sleep(0.25)
+
+            last_message = Message(sender=session_user, content="Last")
+            messages.add(last_message)
+            await asyncio.sleep(0.25)
+            assert writer.committed_seq >= last_message.seq
+
+            loaded_message = messages.get_by_id(first_message.idx)
+            assert loaded_message is not None and loaded_message is not first_message
+            assert loaded_message.content == "First"
+            first_stored = messages.get_first()
+            assert first_stored is not None and first_stored.idx == first_message.idx
+        finally:
+            writer.close()
+            reader.close()
+
+
+async def admission_case():
+    """Кейс с лимитами подключений, без сервера: общий лимит и лимит на один адрес"""
+    admission = AdmissionControl(max_connections=3, max_connections_per_host=2)
+    assert admission.admit("10.0.0.1") is None
+    assert admission.admit("10.0.0.1") is None
+    assert admission.admit("10.0.0.1") == HOST_LIMIT
+    assert admission.admit("10.0.0.2") is None
+    assert admission.admit("10.0.0.3") == SERVER_FULL
+
+    admission.release("10.0.0.1")
+    assert admission.get_host_count("10.0.0.1") == 1
+    assert admission.admit("10.0.0.3") is None
+    assert len(admission) == 3
+
+
+async def idle_reaper_case():
+    """
+    Кейс с молчащим подключением, без сервера чата.
+    Подключение сначала получает пинг, а если так ничего и не отправило, закрывается после таймаута.
+    """
+    reaper = IdleReaper(keepalive_interval=0.1, idle_timeout=0.3, resolution=0.05)
+    reaped = []
+
+    def ping(connection: Connection) -> None:
+        connection.writer.write(b"ping\n")
+
+    def reap(connection: Connection) -> None:
+        reaped.append(connection)
+        connection.writer.transport.abort()
+
+    async def accept(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        host, port, *_ = writer.get_extra_info("peername")
+        reaper.track(Connection(host=host, port=port, reader=reader, writer=writer, user=User()))
+
+    server = await asyncio.start_server(accept, host=SERVER_HOST, port=0)
+    reaper_task = asyncio.create_task(reaper.run(ping, reap))
+    try:
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection(SERVER_HOST, port)
+        started_at = asyncio.get_running_loop().time()
+        assert await asyncio.wait_for(reader.readline(), timeout=1) == b"ping\n"
+        assert await asyncio.wait_for(reader.read(), timeout=1) == b""
+        assert asyncio.get_running_loop().time() - started_at >= 0.3
+        assert len(reaped) == 1
+        writer.close()
+    finally:
+        reaper_task.cancel()
+        server.close()
+        await server.wait_closed()
 
 
 if __name__ == "__main__":
@@ -174,3 +627,16 @@ if __name__ == "__main__":
     # asyncio.run(unconnected_case())
     # asyncio.run(message_block_case())
     # asyncio.run(report_case_with_expire_ban())
+    # asyncio.run(status_pagination_case())
+    # asyncio.run(private_message_case())
+    # asyncio.run(session_case())
+    # asyncio.run(pipelined_requests_case())
+    # asyncio.run(binary_protocol_case())
+    # asyncio.run(compression_case())
+    # asyncio.run(file_transfer_case())
+    # asyncio.run(scheduled_message_case())
+    # asyncio.run(room_case())
+    # asyncio.run(cluster_case())
+    # asyncio.run(sqlite_storage_case())
+    # asyncio.run(admission_case())
+    # asyncio.run(idle_reaper_case())